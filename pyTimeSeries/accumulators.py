@@ -0,0 +1,160 @@
+"""
+Online statistics for time series that grow one point at a time
+
+A StatsAccumulator holds enough state to give the count, mean, standard
+deviation, zscore, min/max (with dates) and latest point of everything it
+has seen. Adding a point is O(1), and accumulators built on separate
+partitions of a series can be merged. Missing (NaN) points are skipped.
+"""
+from pyTimeSeries import timeseries
+
+################################################################################
+
+class StatsAccumulator(object):
+    """
+    Welford style mean/variance accumulator that also tracks the min, max
+    and latest point (by date) of the values it has seen
+    """
+
+    fields = ('count', 'mean', 'm2',
+              'min_date', 'min_value', 'max_date', 'max_value',
+              'last_date', 'last_value')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min_date = None
+        self.min_value = None
+        self.max_date = None
+        self.max_value = None
+        self.last_date = None
+        self.last_value = None
+
+    def update(self, dte, val):
+        """
+        Add a single (date, value) point, unless the value is missing
+        """
+        if val != val:
+            return self
+        self.count += 1
+        delta = val - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (val - self.mean)
+
+        if self.min_value is None or val < self.min_value:
+            self.min_date, self.min_value = dte, val
+        if self.max_value is None or val > self.max_value:
+            self.max_date, self.max_value = dte, val
+        if self.last_date is None or dte >= self.last_date:
+            self.last_date, self.last_value = dte, val
+        return self
+
+    def update_series(self, ts):
+        """
+        Add every point of a time series (list of tuples or TimeSeries)
+        """
+        if timeseries.is_columnar(ts):
+            return self.merge(from_columnar(ts))
+        for dte, val in ts:
+            self.update(dte, val)
+        return self
+
+    def merge(self, other):
+        """
+        Combine the statistics of another accumulator into this one, as if
+        all its points had been added here
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            for field in self.fields:
+                setattr(self, field, getattr(other, field))
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+        if other.min_value < self.min_value:
+            self.min_date, self.min_value = other.min_date, other.min_value
+        if other.max_value > self.max_value:
+            self.max_date, self.max_value = other.max_date, other.max_value
+        if other.last_date >= self.last_date:
+            self.last_date, self.last_value = other.last_date, other.last_value
+        return self
+
+    @property
+    def variance(self):
+        """
+        Population variance, consistent with timeseries.sd
+        """
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
+
+    @property
+    def sd(self):
+        if self.count == 0:
+            return None
+        return self.variance ** 0.5
+
+    @property
+    def zscore(self):
+        """
+        The zscore of the latest point against all points seen
+        """
+        if self.count == 0:
+            return None
+        return (self.last_value - self.mean) / self.sd
+
+    def to_dict(self):
+        """
+        Plain dictionary of the accumulator state, suitable for pickling
+        or storing in the db
+        """
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        for field in cls.fields:
+            setattr(acc, field, state[field])
+        return acc
+
+################################################################################
+
+def from_columnar(ts):
+    """
+    Build an accumulator from a TimeSeries in one vectorized pass
+    """
+    acc = StatsAccumulator()
+    ts = ts.dropna()
+    if len(ts) == 0:
+        return acc
+
+    values = ts.values
+    acc.count = len(values)
+    acc.mean = float(values.mean())
+    acc.m2 = float(((values - acc.mean) ** 2).sum())
+
+    acc.min_date, acc.min_value = ts[values.argmin()]
+    acc.max_date, acc.max_value = ts[values.argmax()]
+    # Take the last occurrence of the latest date, as update would
+    acc.last_date, acc.last_value = ts[len(values) - 1 - ts.dates[::-1].argmax()]
+    acc.min_value = float(acc.min_value)
+    acc.max_value = float(acc.max_value)
+    acc.last_value = float(acc.last_value)
+    return acc
+
+################################################################################
+
+def accumulate(ts):
+    """
+    Build an accumulator over a whole time series
+    """
+    return StatsAccumulator().update_series(ts)
+
+################################################################################
@@ -0,0 +1,219 @@
+"""
+Benchmarks of the cache file formats on the test data
+
+    python benchmarks.py [repeat]
+
+For each serialiser and compression codec, reports the file size, the
+compression ratio against the uncompressed file, and the write and read
+throughput in MB/s of uncompressed data. The series are tiled repeat
+times (default 20) so the timings aren't dominated by file opening.
+
+Then, for the date columns of the yahoo, google and treasuries test data
+and of the csv cache, reports the dates parsed per second by strptime
+and by dateparse's memoized and array parsers.
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import functools
+
+import data_loader
+from pyTimeSeries import utils
+from pyTimeSeries import compression
+from pyTimeSeries import timeseries
+from pyTimeSeries import dateparse
+
+################################################################################
+
+TEST_DATA_FOLDER = 'testdata'
+TIMINGS = 3
+
+################################################################################
+
+def load_test_series():
+    """
+    Return the series in the test data, transformed as the loaders do
+    """
+    def load(name):
+        return utils.deserialise_obj(
+            os.path.join(TEST_DATA_FOLDER, name + '.data.py'))
+
+    series = [
+        data_loader.transform_yahoo_timeseries(
+            load('test_transform_yahoo_timeseries')),
+        data_loader.transform_google_timeseries(
+            load('test_transform_google_timeseries'))
+    ]
+    for record in data_loader.transform_treasuries_data(
+            load('test_transform_treasuries_data')):
+        series.append(record['timeseries'])
+    return series
+
+################################################################################
+
+def tile(series, repeat):
+    """
+    Concatenate repeat copies of the series into one list of tuples, each
+    copy shifted after the last so the dates stay distinct
+    """
+    tuples = []
+    for ts in series:
+        tuples.extend(timeseries.as_columnar(ts).to_tuples())
+    span = max(d for d, _ in tuples) - min(d for d, _ in tuples)
+    tiled = []
+    for i in range(repeat):
+        tiled.extend((d + i * span, v) for d, v in tuples)
+    return tiled
+
+################################################################################
+
+def best_time(f):
+    best = None
+    for _ in range(TIMINGS):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+################################################################################
+
+def run(obj, folder):
+    """
+    Return a list of rows (serialiser, codec, bytes, ratio, write MB/s,
+    read MB/s)
+    """
+    serialisers = [
+        ('pickle', utils.serialise_obj, utils.deserialise_obj),
+        ('spickle', utils.s_serialise_obj, utils.s_deserialise_obj),
+        ('csv', utils.serialise_csv, utils.deserialise_csv)
+    ]
+
+    rows = []
+    for name, serialise, deserialise in serialisers:
+        raw_size = None
+        for codec in compression.available_codecs():
+            opener = compression.opener(codec)
+            filename = os.path.join(
+                folder, name + compression.extension(codec))
+
+            def write():
+                if os.path.exists(filename):
+                    os.remove(filename)
+                serialise(obj, filename, opener=opener)
+
+            write_time = best_time(write)
+            read_time = best_time(
+                functools.partial(deserialise, filename, opener=opener))
+            size = os.path.getsize(filename)
+            if raw_size is None:
+                raw_size = size
+
+            mb = raw_size / 1e6
+            rows.append((name, codec, size, float(raw_size) / size,
+                         mb / write_time, mb / read_time))
+
+    # The columnar formats, which take a TimeSeries and have no codec. The
+    # ratio and throughputs are against the uncompressed npy file
+    ts = timeseries.TimeSeries.from_tuples(obj)
+    raw_size = None
+    for name, serialise, deserialise in [
+            ('npy', utils.npy_serialise_obj, utils.npy_deserialise_obj),
+            ('gorilla', utils.gorilla_serialise_obj,
+             utils.gorilla_deserialise_obj)]:
+        filename = os.path.join(folder, 'series.' + name)
+        write_time = best_time(functools.partial(serialise, ts, filename))
+        read_time = best_time(lambda: deserialise(filename).values.sum())
+        size = os.path.getsize(filename)
+        if raw_size is None:
+            raw_size = size
+        mb = raw_size / 1e6
+        rows.append((name, compression.NONE, size, float(raw_size) / size,
+                     mb / write_time, mb / read_time))
+    return rows
+
+################################################################################
+
+def load_test_dates(obj):
+    """
+    Return (name, format, date strings) for the date columns of the raw
+    test data and of a csv cache file of obj
+    """
+    def load(name):
+        return utils.deserialise_obj(
+            os.path.join(TEST_DATA_FOLDER, name + '.data.py'))
+
+    columns = []
+    for name, config in [('yahoo', data_loader.yahoo_config),
+                         ('google', data_loader.google_config)]:
+        data = load('test_transform_{0}_timeseries'.format(name))
+        date = data[0].index(config['DATE_COL'])
+        columns.append((name, config['DATEFMT'],
+                        [row[date] for row in data[1:]]))
+
+    columns.append(('fed', dateparse.ISO_DATE, [
+        row[0] for row in load('test_transform_treasuries_data')
+        if re.match(data_loader.treasuries_config['DATE_REGEX'], row[0])]))
+    columns.append(('csv', dateparse.ISO_DATETIME,
+                    [str(d) for d, _ in obj]))
+    return columns
+
+################################################################################
+
+def run_dates(columns, repeat):
+    """
+    Return a list of rows (column, dates, strptime, memoized, array), the
+    last three in thousands of dates per second. The raw columns are
+    tiled repeat times
+    """
+    rows = []
+    for name, format, texts in columns:
+        if name != 'csv':
+            texts = texts * repeat
+
+        def memoized():
+            parse = dateparse.parser(format)
+            return [parse(text) for text in texts]
+
+        times = [
+            best_time(lambda: [datetime.datetime.strptime(text, format)
+                               for text in texts]),
+            best_time(memoized),
+            best_time(lambda: dateparse.parse_array(texts, format))
+        ]
+        rows.append(tuple([name, len(texts)] +
+                          [len(texts) / t / 1e3 for t in times]))
+    return rows
+
+################################################################################
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    obj = tile(load_test_series(), repeat)
+
+    folder = tempfile.mkdtemp()
+    try:
+        rows = run(obj, folder)
+    finally:
+        shutil.rmtree(folder)
+
+    print '{0} points'.format(len(obj))
+    print '{0:<8} {1:<6} {2:>10} {3:>6} {4:>10} {5:>10}'.format(
+        'format', 'codec', 'bytes', 'ratio', 'write MB/s', 'read MB/s')
+    for row in rows:
+        print '{0:<8} {1:<6} {2:>10} {3:>6.2f} {4:>10.1f} {5:>10.1f}'.format(
+            *row)
+
+    print
+    print '{0:<8} {1:>8} {2:>10} {3:>10} {4:>10}'.format(
+        'dates', 'count', 'strptime', 'memoized', 'array')
+    for row in run_dates(load_test_dates(obj), repeat):
+        print '{0:<8} {1:>8} {2:>10.0f} {3:>10.0f} {4:>10.0f}'.format(*row)
+    print '(thousands of dates parsed per second)'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Business day calendar
+
+The calendar precomputes the ordinal of every business day (weekdays
+that aren't holidays) between two bounds, along with a running count of
+business days. Offsets, counts and ranges are then index arithmetic on
+those arrays: O(1) for a single date and vectorized for arrays of dates.
+
+(Named business_calendar rather than calendar so it doesn't shadow the
+standard library module for the other modules in this folder)
+"""
+import datetime
+
+import numpy
+
+from pyTimeSeries import timeseries
+
+################################################################################
+
+DEFAULT_START = datetime.date(1950, 1, 1)
+DEFAULT_END = datetime.date(2100, 12, 31)
+
+# Ordinal of the numpy datetime64 epoch, 1970-01-01
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+################################################################################
+
+class BusinessCalendar(object):
+    """
+    Weekday calendar with an optional list of holidays, valid for dates
+    between start and end
+    """
+
+    def __init__(self, holidays=(), start=DEFAULT_START, end=DEFAULT_END):
+        self.first = start.toordinal()
+        self.last = end.toordinal()
+
+        ordinals = numpy.arange(self.first, self.last + 1, dtype=numpy.int64)
+        # date.fromordinal(1) is a monday
+        self.is_business_day_array = (ordinals - 1) % 7 < 5
+        for holiday in holidays:
+            k = holiday.toordinal() - self.first
+            if 0 <= k < len(ordinals):
+                self.is_business_day_array[k] = False
+
+        self.business_days = ordinals[self.is_business_day_array]
+        # count[k] is the number of business days strictly before the
+        # k-th day of the calendar
+        self.count_before = numpy.concatenate(
+            ([0], numpy.cumsum(self.is_business_day_array)))
+
+    #
+    # Single dates
+    #
+
+    def position(self, dte):
+        ordinal = dte.toordinal()
+        if not self.first <= ordinal <= self.last:
+            raise ValueError('Date {0} is outside the calendar range '
+                             '{1} to {2}'.format(
+                                 dte,
+                                 datetime.date.fromordinal(self.first),
+                                 datetime.date.fromordinal(self.last)))
+        return ordinal - self.first
+
+    def is_business_day(self, dte):
+        return bool(self.is_business_day_array[self.position(dte)])
+
+    def offset(self, dte, off):
+        """
+        Move dte by off business days. From a non business day, +1 is the
+        following business day and -1 the preceding one, while 0 rolls
+        forward to the following business day. The time of day is kept
+        """
+        k = self.position(dte)
+        i = self.count_before[k]
+        if off > 0 and not self.is_business_day_array[k]:
+            i -= 1
+        i += off
+        if not 0 <= i < len(self.business_days):
+            raise ValueError('Offsetting {0} by {1} business days leaves the '
+                             'calendar range'.format(dte, off))
+
+        moved = datetime.date.fromordinal(int(self.business_days[i]))
+        if isinstance(dte, datetime.datetime):
+            return datetime.datetime.combine(moved, dte.time())
+        return moved
+
+    def count(self, start, end):
+        """
+        Number of business days d with start <= d < end
+        """
+        return int(self.count_before[self.position(end)] -
+                   self.count_before[self.position(start)])
+
+    def range(self, start, end):
+        """
+        List of the business days from start to end inclusive, as
+        datetime.datetime objects
+        """
+        return self.range_array(start, end).astype(object).tolist()
+
+    def range_array(self, start, end):
+        """
+        Array of the business days from start to end inclusive, in the
+        TimeSeries date format
+        """
+        i = self.count_before[self.position(start)]
+        j = self.count_before[self.position(end) + 1]
+        return to_datetime64(self.business_days[i:j])
+
+    #
+    # Arrays of dates
+    #
+
+    def offset_array(self, dates, off):
+        """
+        Vectorized offset: move every date in the array by off business
+        days (off may be a scalar or an array of the same length), with
+        the same conventions as offset
+        """
+        dates = numpy.asarray(dates, dtype=timeseries.DATE_DTYPE)
+        days = dates.astype('datetime64[D]')
+        k = days.astype(numpy.int64) + EPOCH_ORDINAL - self.first
+        if (k < 0).any() or (k > self.last - self.first).any():
+            raise ValueError('Dates outside the calendar range')
+
+        off = numpy.asarray(off, dtype=numpy.int64)
+        i = self.count_before[k] + off
+        i -= (off > 0) & ~self.is_business_day_array[k]
+        if (i < 0).any() or (i >= len(self.business_days)).any():
+            raise ValueError('Offset leaves the calendar range')
+
+        return to_datetime64(self.business_days[i]) + (dates - days)
+
+################################################################################
+
+def to_datetime64(ordinals):
+    days = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+    return days.astype(timeseries.DATE_DTYPE)
+
+################################################################################
+
+WEEKDAYS = None
+
+def weekdays():
+    """
+    Shared calendar of weekdays with no holidays, built on first use
+    """
+    global WEEKDAYS
+    if WEEKDAYS is None:
+        WEEKDAYS = BusinessCalendar()
+    return WEEKDAYS
+
+################################################################################
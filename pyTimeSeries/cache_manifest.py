@@ -0,0 +1,408 @@
+"""
+Manifest of the files in the file cache
+
+The manifest maps (id, format) to an entry describing the cached file:
+    path      - relative to the cache folder
+    format    - serialiser (pickle, spickle, npy, csv) or sidecar kind
+                (stats, coverage)
+    size      - in bytes
+    checksum  - crc32 of the file contents
+    loader    - loader name, if known
+    coverage  - list of (start, end) date intervals the series covers
+    written   - time the file was written, in seconds since the epoch
+    accessed  - time the file was last read, to ACCESS_RESOLUTION
+
+It's held in memory once read, so lookups answered from it cost no
+filesystem access. On disk it is a pickled snapshot plus a journal of the
+changes made since, appended as length prefixed pickles. Processes
+sharing the cache folder see each other's changes: each reads what's
+been appended to the journal since it last looked when a lookup misses,
+when listing the entries, and when asked to (update), and writes the
+journal or a snapshot holding a lock file, after catching up. The
+journal is folded into a new snapshot once it has more records than
+COMPACT_THRESHOLD and than half the number of entries, so rewriting the
+snapshot costs a constant per record.
+
+Reads only change access times in memory. They're written with the next
+snapshot (see compact), and until then other processes don't see them.
+
+The manifest only knows about the files written through it. If the cache
+folder is changed by hand, rebuild it from the files on disk with
+
+    python cache_manifest.py
+
+and move the files of a cache to the layout of the configured number of
+subdirectory levels, and to the current file extensions, with
+
+    python cache_manifest.py migrate
+"""
+import os
+import sys
+import threading
+import zlib
+import cPickle as pickle
+
+from pyTimeSeries import spickle
+from pyTimeSeries import single_flight
+
+################################################################################
+
+MANIFEST_FILENAME = 'manifest'
+JOURNAL_FILENAME = 'manifest.journal'
+# Held by a process while it writes the journal or a snapshot
+LOCK_FILENAME = 'manifest.lock'
+COMPACT_THRESHOLD = 1000
+
+# Access times are updated at most this often per entry, in seconds
+ACCESS_RESOLUTION = 60
+
+PUT = 'put'
+REMOVE = 'remove'
+TOUCH = 'touch'
+CLEAR = 'clear'
+
+################################################################################
+
+def file_identity(filename):
+    """
+    (inode, modification time, size) of a file, to tell when it's been
+    replaced or grown, or None if there's no such file
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+################################################################################
+
+def file_checksum(filename):
+    checksum = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+################################################################################
+
+class Manifest(object):
+    """
+    Manifest of the cache folder
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        # Formats of the entries of each id
+        self.formats = {}
+        self.bytes = 0
+        self.journal_length = 0
+        # Identity of the snapshot read, and of the journal file and how
+        # much of it has been replayed
+        self.snapshot = None
+        self.journal_inode = None
+        self.offset = 0
+        # Access times of the reads since the last snapshot, by key
+        self.touched = {}
+        self.lock = threading.Lock()
+
+    def filename(self):
+        return os.path.join(self.folder, MANIFEST_FILENAME)
+
+    def journal_filename(self):
+        return os.path.join(self.folder, JOURNAL_FILENAME)
+
+    def lock_filename(self):
+        return os.path.join(self.folder, LOCK_FILENAME)
+
+    def exists(self):
+        return os.path.exists(self.filename())
+
+    def path(self, entry):
+        """
+        Filename of the cached file described by entry
+        """
+        return os.path.normpath(os.path.join(self.folder, entry['path']))
+
+    #
+    # Persistence
+    #
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal. A record cut short at the
+        end of the journal (from a crash mid write) is ignored
+        """
+        with self.lock:
+            self.read_snapshot(file_identity(self.filename()))
+            self.refresh()
+
+    def update(self):
+        """
+        Catch up with the changes made by other processes
+        """
+        with self.lock:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Catch up with the changes made by other processes: read the
+        snapshot again if it's been replaced, and replay the journal
+        records appended since the last call. A record cut short at the
+        end (from a crash, or a write in progress) is read once it's whole
+        """
+        # Callers hold the lock
+        snapshot = file_identity(self.filename())
+        journal = file_identity(self.journal_filename())
+        if (snapshot != self.snapshot or journal is None or
+                journal[0] != self.journal_inode or journal[2] < self.offset):
+            # Snapshotted or cleared since: start again from the snapshot
+            if snapshot != self.snapshot or self.offset > 0:
+                self.read_snapshot(snapshot)
+                self.apply_touched()
+            if journal is None:
+                return
+            self.journal_inode = journal[0]
+        if journal[2] == self.offset:
+            return
+
+        with open(self.journal_filename(), 'rb') as f:
+            f.seek(self.offset)
+            while True:
+                try:
+                    op, found = spickle.s_load_elt_v2(f)
+                except (IOError, EOFError, pickle.UnpicklingError):
+                    break
+                if not found:
+                    break
+                self.apply(op)
+                self.journal_length += 1
+                self.offset = f.tell()
+
+    def read_snapshot(self, snapshot):
+        # Callers hold the lock
+        self.entries = {}
+        if snapshot is not None:
+            with open(self.filename(), 'rb') as f:
+                self.entries = pickle.load(f)
+        self.index()
+        self.snapshot = snapshot
+        self.journal_inode = None
+        self.offset = 0
+        self.journal_length = 0
+
+    def index(self):
+        # Callers hold the lock
+        self.bytes = sum(e['size'] for e in self.entries.itervalues())
+        self.formats = {}
+        for id, format in self.entries:
+            self.formats.setdefault(id, set()).add(format)
+
+    def apply_touched(self):
+        # Callers hold the lock
+        for key, accessed in self.touched.iteritems():
+            entry = self.entries.get(key)
+            if entry is not None and entry['accessed'] < accessed:
+                self.apply((TOUCH, key, accessed))
+
+    def apply(self, op):
+        if op[0] == PUT:
+            self.apply((REMOVE, op[1]))
+            self.entries[op[1]] = op[2]
+            self.formats.setdefault(op[1][0], set()).add(op[1][1])
+            self.bytes += op[2]['size']
+        elif op[0] == REMOVE:
+            entry = self.entries.pop(op[1], None)
+            if entry is not None:
+                self.bytes -= entry['size']
+                formats = self.formats[op[1][0]]
+                formats.discard(op[1][1])
+                if not formats:
+                    del self.formats[op[1][0]]
+        elif op[0] == TOUCH:
+            # Entries are replaced rather than changed, as callers may hold
+            # on to them
+            if op[1] in self.entries:
+                entry = dict(self.entries[op[1]])
+                entry['accessed'] = op[2]
+                self.entries[op[1]] = entry
+        elif op[0] == CLEAR:
+            self.entries.clear()
+            self.formats.clear()
+            self.bytes = 0
+
+    def record(self, *ops):
+        """
+        Apply the operations and append them to the journal, after the
+        ones other processes have appended meanwhile
+        """
+        # Callers hold the lock
+        with single_flight.FileLock(self.lock_filename()):
+            self.refresh()
+            with open(self.journal_filename(), 'ab') as f:
+                # Drop a record cut short by a crash, which nothing is
+                # still writing now the lock is held
+                if os.fstat(f.fileno()).st_size > self.offset:
+                    f.truncate(self.offset)
+                for op in ops:
+                    self.apply(op)
+                    spickle.s_dump_elt_v2(op, f)
+                f.flush()
+                stat = os.fstat(f.fileno())
+            self.journal_inode = stat.st_ino
+            self.offset = stat.st_size
+            self.journal_length += len(ops)
+            if self.journal_length > max(COMPACT_THRESHOLD,
+                                         len(self.entries) // 2):
+                self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Write the entries, with the access times of the reads since the
+        last snapshot, to a new snapshot, swapped in with a rename so
+        readers never see a partial file, and empty the journal
+        """
+        # Callers hold the lock and the lock file
+        tmp_filename = self.filename() + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(self.filename()):
+            os.remove(self.filename())
+        os.rename(tmp_filename, self.filename())
+        if os.path.exists(self.journal_filename()):
+            os.remove(self.journal_filename())
+        self.snapshot = file_identity(self.filename())
+        self.journal_inode = None
+        self.offset = 0
+        self.journal_length = 0
+        self.touched = {}
+
+    def compact(self):
+        with self.lock:
+            with single_flight.FileLock(self.lock_filename()):
+                self.refresh()
+                self.write_snapshot()
+
+    def replace(self, entries):
+        """
+        Replace every entry, e.g. after a rebuild from the files on disk
+        """
+        with self.lock:
+            with single_flight.FileLock(self.lock_filename()):
+                self.entries = dict(entries)
+                self.index()
+                self.write_snapshot()
+
+    #
+    # Entries
+    #
+
+    def get(self, id, format, refresh=True):
+        """
+        Return the entry of id in format, or None. A miss catches up with
+        the changes of other processes first, unless refresh is False
+        """
+        with self.lock:
+            entry = self.entries.get((id, format))
+            if entry is None and refresh:
+                self.refresh()
+                entry = self.entries.get((id, format))
+            return entry
+
+    def put(self, id, format, entry):
+        with self.lock:
+            self.record((PUT, (id, format), entry))
+
+    def touch(self, id, format, now):
+        """
+        Record a read of the entry at time now, in memory until the next
+        snapshot
+        """
+        with self.lock:
+            entry = self.entries.get((id, format))
+            if entry is None or now - entry['accessed'] < ACCESS_RESOLUTION:
+                return
+            self.apply((TOUCH, (id, format), now))
+            self.touched[(id, format)] = now
+
+    def get_id(self, id):
+        """
+        Dictionary of the entries of id by format. A miss catches up with
+        the changes of other processes first
+        """
+        with self.lock:
+            if id not in self.formats:
+                self.refresh()
+            return dict((format, self.entries[(id, format)])
+                        for format in self.formats.get(id, ()))
+
+    def remove(self, id, format):
+        with self.lock:
+            self.refresh()
+            if (id, format) in self.entries:
+                self.record((REMOVE, (id, format)))
+
+    def remove_ids(self, ids):
+        """
+        Remove the entries of every format for each of the ids, with one
+        journal write, returning them
+        """
+        with self.lock:
+            self.refresh()
+            removed = [((id, format), self.entries[(id, format)])
+                       for id in set(ids)
+                       for format in self.formats.get(id, ())]
+            if removed:
+                self.record(*[(REMOVE, key) for key, _ in removed])
+            return [entry for _, entry in removed]
+
+    def remove_id(self, id):
+        """
+        Remove the entries of every format for id, returning them
+        """
+        return self.remove_ids([id])
+
+    def clear(self):
+        with self.lock:
+            self.record((CLEAR,))
+
+    def items(self, format=None):
+        """
+        List of ((id, format), entry) pairs, optionally of one format only
+        """
+        with self.lock:
+            self.refresh()
+            return [(key, entry) for key, entry in self.entries.items()
+                    if format is None or key[1] == format]
+
+    def stats(self):
+        """
+        Number of files and bytes in the cache, in total and per format
+        """
+        stats = {'files': 0, 'bytes': 0, 'formats': {}}
+        for (_, format), entry in self.items():
+            per_format = stats['formats'].setdefault(format,
+                                                     {'files': 0, 'bytes': 0})
+            for s in (stats, per_format):
+                s['files'] += 1
+                s['bytes'] += entry['size']
+        return stats
+
+################################################################################
+
+def main():
+    import data_retrieval
+    if sys.argv[1:] == ['migrate']:
+        moved = data_retrieval.migrate_cache()
+        print 'Moved {0} files in {1}'.format(
+            moved, data_retrieval.get_manifest().folder)
+        return
+    manifest = data_retrieval.rebuild_manifest()
+    print 'Rebuilt manifest of {0}: {1}'.format(manifest.folder,
+                                                manifest.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Retention policies for the file cache
+
+Series are evicted when they are older than the time to live of their
+loader, and, while the cache holds more than a cap in bytes, in order of
+least recent access, down to LOW_WATER of the cap so that the writes
+that follow don't each go over it again. A time to live or byte cap of 0
+means no limit.
+
+Evictions work on whole series: a series' sidecar files (stats, coverage)
+go with it. The policy only chooses what to evict, from the manifest
+entries; data_retrieval.enforce_retention does the removal, either when
+called or periodically from a Compactor thread.
+"""
+import logging
+import threading
+
+################################################################################
+
+# Fraction of the byte cap the cache is brought down to once it's over it
+LOW_WATER = 0.9
+
+################################################################################
+
+def is_expired(ttl, written, now):
+    """
+    True if a file written at time written has outlived ttl seconds
+    """
+    return ttl > 0 and now - written > ttl
+
+################################################################################
+
+def series_written(entries):
+    """
+    Time the files of a series (the manifest entries of one id) were last
+    written: appending to its log keeps the whole series current
+    """
+    return max(entry['written'] for entry in entries)
+
+################################################################################
+
+def group_by_id(items):
+    """
+    Summarise the manifest items of each id: its loader, total size, and
+    latest write (see series_written) and access times
+    """
+    groups = {}
+    for (id, _), entry in items:
+        group = groups.setdefault(id, {'loader': None, 'bytes': 0,
+                                       'written': 0, 'accessed': 0})
+        group['loader'] = group['loader'] or entry['loader']
+        group['bytes'] += entry['size']
+        group['written'] = max(group['written'], entry['written'])
+        group['accessed'] = max(group['accessed'], entry['accessed'])
+    return groups
+
+################################################################################
+
+def select_evictions(items, now, max_bytes, ttl):
+    """
+    Return the ids to evict from the manifest items: every expired id,
+    then, if the rest are over max_bytes, the least recently accessed
+    until they fit in LOW_WATER of it. ttl is a function giving the time
+    to live of a loader's series
+    """
+    groups = group_by_id(items)
+    evict = [id for id, g in groups.iteritems()
+             if is_expired(ttl(g['loader']), g['written'], now)]
+
+    expired = set(evict)
+    remaining = [(id, g) for id, g in groups.iteritems() if id not in expired]
+    total = sum(g['bytes'] for _, g in remaining)
+    if max_bytes > 0 and total > max_bytes:
+        target = int(max_bytes * LOW_WATER)
+        for id, g in sorted(remaining, key=lambda (id, g): g['accessed']):
+            if total <= target:
+                break
+            evict.append(id)
+            total -= g['bytes']
+
+    return evict
+
+################################################################################
+
+class Compactor(threading.Thread):
+    """
+    Daemon thread calling compaction_pass every interval seconds until
+    stopped
+    """
+
+    def __init__(self, compaction_pass, interval):
+        threading.Thread.__init__(self, name='cache-compactor')
+        self.daemon = True
+        self.compaction_pass = compaction_pass
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.compaction_pass()
+            except Exception:
+                logging.exception('Cache compaction pass failed')
+
+    def stop(self):
+        self.stopped.set()
+
+################################################################################
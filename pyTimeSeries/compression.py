@@ -0,0 +1,101 @@
+"""
+Compression codecs for cache files
+
+A codec wraps any of the stream serialisers in utils (pickle, spickle,
+csv): each takes an opener, and the opener of a codec returns a file
+object that compresses on write and decompresses on read. Compressed
+files get the codec's extension after the serialiser's, e.g.
+id.pickle.gz.
+
+    none - no compression
+    gzip - zlib's deflate, in the gzip container
+    bz2  - bzip2
+    lzma - xz, if the lzma module (or backports.lzma on python 2) is
+           installed
+
+See benchmarks.py for the size and speed of each on the test data.
+"""
+import bz2
+import gzip
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+################################################################################
+
+NONE = 'none'
+GZIP = 'gzip'
+BZ2 = 'bz2'
+LZMA = 'lzma'
+
+EXTENSIONS = {
+    NONE: '',
+    GZIP: '.gz',
+    BZ2: '.bz2',
+    LZMA: '.xz'
+}
+
+GZIP_LEVEL = 6
+
+################################################################################
+
+def available_codecs():
+    """
+    List of the codecs that can be used with the modules installed
+    """
+    codecs = [NONE, GZIP, BZ2]
+    if lzma is not None:
+        codecs.append(LZMA)
+    return codecs
+
+################################################################################
+
+def check_codec(codec):
+    if codec not in EXTENSIONS:
+        raise ValueError('Unrecognised compression codec "{0}". Use one of '
+                         '{1}'.format(codec, ', '.join(sorted(EXTENSIONS))))
+    if codec not in available_codecs():
+        raise ValueError('Compression codec "{0}" needs the lzma module'
+                         .format(codec))
+
+################################################################################
+
+def opener(codec):
+    """
+    Return a function (filename, mode) -> file object, compressing with
+    codec
+    """
+    check_codec(codec)
+    if codec == GZIP:
+        return lambda filename, mode: gzip.GzipFile(
+            filename, mode[0] + 'b', compresslevel=GZIP_LEVEL)
+    elif codec == BZ2:
+        return lambda filename, mode: bz2.BZ2File(filename, mode[0])
+    elif codec == LZMA:
+        return lambda filename, mode: lzma.LZMAFile(filename, mode[0] + 'b')
+    return open
+
+################################################################################
+
+def extension(codec):
+    check_codec(codec)
+    return EXTENSIONS[codec]
+
+################################################################################
+
+def split_extension(filename):
+    """
+    Split a filename into the filename without its codec extension and
+    the codec
+    """
+    for codec, ext in EXTENSIONS.iteritems():
+        if ext and filename.endswith(ext):
+            return filename[:-len(ext)], codec
+    return filename, NONE
+
+################################################################################
@@ -4,9 +4,22 @@ import os
 SERIALISER = 'pickle'
 CACHE_FOLDER = 'cache'
 CSV_FOLDER = 'csv'
+CACHE_SHARD_LEVELS = 2
 FILEID_TYPE = 'sha1'
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+WRITE_BEHIND = False
+COMPRESSION = 'none'
+LOG_COMPACT_BYTES = 1024 * 1024
+WRITE_BEHIND_QUEUE = 64
+
+CACHE_DEFAULT_TTL = 0
+CACHE_TTL = {}
+CACHE_MAX_BYTES = 0
+CACHE_COMPACTION_INTERVAL = 0
+NEGATIVE_TTL = {'empty': 86400, 'failed': 3600}
 
 DB = 'mongo'
+SQLITE_FILE = 'timeseries.sqlite'
 
 MONGO_FOLDER = 'mongo'
 MONGOD_PORT = 27017
@@ -14,13 +27,27 @@ MONGO_LOG = 'mongo.log'
 MONGO_TIMESERIES_DB = 'timeseries_db'
 
 def set_args(cp):
-    global SERIALISER, CACHE_FOLDER, CSV_FOLDER, FILEID_TYPE, DB, MONGO_FOLDER, MONGOD_PORT, MONGO_LOG, MONGO_TIMESERIES_DB
+    global SERIALISER, CACHE_FOLDER, CACHE_SHARD_LEVELS, CSV_FOLDER, FILEID_TYPE, MEMORY_CACHE_BYTES, WRITE_BEHIND, WRITE_BEHIND_QUEUE, COMPRESSION, LOG_COMPACT_BYTES, CACHE_DEFAULT_TTL, CACHE_TTL, CACHE_MAX_BYTES, CACHE_COMPACTION_INTERVAL, NEGATIVE_TTL, DB, SQLITE_FILE, MONGO_FOLDER, MONGOD_PORT, MONGO_LOG, MONGO_TIMESERIES_DB
     SERIALISER = cp.get('serialisation', 'serialiser')
     CACHE_FOLDER = cp.get('serialisation', 'cache_folder')
+    CACHE_SHARD_LEVELS = cp.getint('serialisation', 'cache_shard_levels')
     CSV_FOLDER = cp.get('serialisation', 'csv_folder')
     FILEID_TYPE = cp.get('serialisation', 'fileid_type')
+    MEMORY_CACHE_BYTES = cp.getint('serialisation', 'memory_cache_bytes')
+    WRITE_BEHIND = cp.getboolean('serialisation', 'write_behind')
+    WRITE_BEHIND_QUEUE = cp.getint('serialisation', 'write_behind_queue')
+    COMPRESSION = cp.get('serialisation', 'compression')
+    LOG_COMPACT_BYTES = cp.getint('serialisation', 'log_compact_bytes')
+
+    CACHE_DEFAULT_TTL = cp.getint('retention', 'default_ttl')
+    CACHE_TTL = dict((loader, int(ttl)) for loader, ttl in cp.items('ttl'))
+    CACHE_MAX_BYTES = cp.getint('retention', 'max_cache_bytes')
+    CACHE_COMPACTION_INTERVAL = cp.getint('retention', 'compaction_interval')
+    NEGATIVE_TTL = dict((reason, int(ttl))
+                        for reason, ttl in cp.items('negative_ttl'))
 
     DB = cp.get('database', 'db')
+    SQLITE_FILE = cp.get('database', 'sqlite_file')
 
     MONGO_FOLDER = cp.get('mongo', 'mongo_folder')
     MONGOD_PORT = cp.getint('mongo', 'mongod_port')
@@ -8,7 +8,11 @@ import datetime
 import re
 import warnings
 
+import numpy
+
 import data_structure
+from pyTimeSeries import timeseries
+from pyTimeSeries import dateparse
 
 
 
@@ -395,22 +399,41 @@ def transform_timeseries_table(data, config):
     2012-11-12, 125, 634, 234.2, 623.52, 26642, ...
     ...
 
-    into an array of tuples of the form
-        [(date1, close1), (date2, close2), ...], 
+    into a TimeSeries of the dates and close values in ascending date
+    order, with the values parsed to floats (NaN if missing)
     """
     if len(data) == 0:
-        return {}
+        return timeseries.TimeSeries([], [])
 
     date = data[0].index(config['DATE_COL'])
     close = data[0].index(config['CLOSE_COL'])
 
-    def timepoint(data_row):
-        dte = datetime.datetime.strptime(data_row[date], config['DATEFMT'])
-        return dte, data_row[close]
+    dates = dateparse.parse_array([row[date] for row in data[1:]],
+                                  config['DATEFMT'])
+    values = parse_values([row[close] for row in data[1:]])
+
+    return timeseries.TimeSeries(dates, values).sorted()
+
+################################################################################
+
+def parse_values(raw_values):
+    """
+    Parse a list of strings into a float64 array. Anything that isn't a
+    number (e.g. 'ND' or '' in the fed data) is stored as NaN
+    """
+    try:
+        return numpy.array(raw_values, dtype=timeseries.VALUE_DTYPE)
+    except ValueError:
+        pass
 
-    timeseries = [timepoint(row) for row in data[1:]]
+    def parse(raw):
+        try:
+            return float(raw)
+        except ValueError:
+            return numpy.nan
 
-    return timeseries
+    return numpy.array([parse(raw) for raw in raw_values],
+                       dtype=timeseries.VALUE_DTYPE)
 
 ################################################################################
 
@@ -481,20 +504,22 @@ def transform_treasuries_data(data):
 
     # Initialise the return object - this will by an array of 
     # dictionaries, Each dictionary is an individual time series with 2 keys:
-    #   timeseries: an array of (date, val) tuples
+    #   timeseries: a TimeSeries of the dates and float values
     #   id: a dictionary of metadata associated with each time series
     #   source: an array of metadata associated with series updates
-    time_series = [data_structure.create_time_series({}, [], {})
+    time_series = [data_structure.create_time_series({}, None, {})
                    for _ in range(1, nb_time_series)]
+    dates = []
+    raw_values = [[] for _ in range(1, nb_time_series)]
 
     # Parse the csv data
     for row in data:
         if re.match(treasuries_config['DATE_REGEX'], row[0]) is not None:
-            # The row is time series data: add it to the array of tuples
-            year, month, day = row[0].split('-')
-            dte = datetime.datetime(int(year), int(month), int(day))
+            # The row is time series data: collect the raw dates and
+            # values, they're parsed a column at a time below
+            dates.append(row[0])
             for s in range(1, nb_time_series):
-                time_series[s-1][data_structure.TIMESERIES].append((dte, row[s]))
+                raw_values[s - 1].append(row[s])
         else:
             # The row is metadata: add it to the id entry
             # Use the key we get back from the input data as the
@@ -502,6 +527,11 @@ def transform_treasuries_data(data):
             for s in range(1, nb_time_series):
                 time_series[s - 1][data_structure.ID][row[0]] = row[s]
 
+    dates = dateparse.parse_array(dates, dateparse.ISO_DATE)
+    for s in range(1, nb_time_series):
+        time_series[s - 1][data_structure.TIMESERIES] = timeseries.TimeSeries(
+            dates, parse_values(raw_values[s - 1]))
+
     # Finally create a list of symbols we've retrieved for the logs 
     symbols = [
         t[data_structure.ID][treasuries_config['ID_FIELD']]
@@ -528,6 +558,36 @@ def download_mock_series(symbol, start, end):
 
 ################################################################################
 
+def download_mock_daily_series(symbol, start, end):
+    """
+    Mock query for unit testing - a point for every day from start to end,
+    valued at the day of the month
+    """
+    id = {
+        'symbol': symbol,
+        'start': start,
+        'end': end
+    }
+    dates = [start + datetime.timedelta(days=n)
+             for n in range((end - start).days + 1)]
+
+    return [data_structure.create_time_series(
+        id, timeseries.TimeSeries(dates, [float(d.day) for d in dates]), {})]
+
+################################################################################
+
+def download_mock_daily_tuples(symbol, start, end):
+    """
+    Mock query for unit testing - as download_mock_daily_series, but a
+    list of (date, value) tuples like download_bbg_historicaldatarequest
+    """
+    dates = [start + datetime.timedelta(days=n)
+             for n in range((end - start).days + 1)]
+
+    return [(d, float(d.day)) for d in dates]
+
+################################################################################
+
 if __name__ == '__main__':
     logging.basicConfig(level='DEBUG')
     # utils.serialise_obj(
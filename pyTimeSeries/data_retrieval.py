@@ -1,9 +1,28 @@
 import os
+import time
+import functools
+import threading
 import hashlib
 import logging
+import collections
+from multiprocessing.pool import ThreadPool
+
+import numpy
 
 import data_structure
+from pyTimeSeries import timeseries
 from pyTimeSeries import utils
+from pyTimeSeries import accumulators
+from pyTimeSeries import memory_cache
+from pyTimeSeries import range_cache
+from pyTimeSeries import cache_manifest
+from pyTimeSeries import cache_retention
+from pyTimeSeries import write_behind
+from pyTimeSeries import compression
+from pyTimeSeries import segment_store
+from pyTimeSeries import sqlite_db
+from pyTimeSeries import single_flight
+from pyTimeSeries import negative_cache
 import data_loader
 import config
 import db
@@ -17,9 +36,117 @@ import db
 
 CACHE_EXT_PICKLE = '.pickle'
 CACHE_EXT_SPICKLE = '.spickle'
+CACHE_EXT_STATS = '.stats'
+CACHE_EXT_NPY = '.tsn'
+CACHE_EXT_GORILLA = '.gorilla'
+CACHE_EXT_COVERAGE = '.coverage'
+CACHE_EXT_LOG = '.log'
+CACHE_EXT_LOCK = '.lock'
 CSV_EXT = '.csv'
 MONGO_DB = 'mongo'
+SQLITE_DB = 'sqlite'
+
+SERIALISERS = ('pickle', 'spickle', 'csv', 'npy', 'gorilla')
+
+# Format of each kind of file kept in the cache folder, by extension
+CACHE_FORMATS = {
+    CACHE_EXT_PICKLE: 'pickle',
+    CACHE_EXT_SPICKLE: 'spickle',
+    CACHE_EXT_NPY: 'npy',
+    CACHE_EXT_GORILLA: 'gorilla',
+    CACHE_EXT_STATS: 'stats',
+    CACHE_EXT_COVERAGE: 'coverage',
+    CACHE_EXT_LOG: 'log'
+}
+
+# Extensions of files written by earlier versions, found by scan_cache and
+# renamed by migrate_cache. npy files used numpy's own extension, although
+# numpy.load can't read them
+LEGACY_CACHE_FORMATS = {
+    '.npy': 'npy'
+}
+
+# Loader arguments giving the date range of a request rather than the
+# identity of the series
+RANGE_ARGS = ('start', 'end')
+
+# Loader calls made at once by get_time_series_many
+FETCH_THREADS = 8
+
+# Requests looked up per mongo query by get_time_series_many
+MONGO_BATCH = 500
+
+# In-process tier in front of the file cache and the db, keyed by cache id
+memory_tier = memory_cache.LRUCache()
+
+# Manifest of each cache folder used in this process, read on first use
+manifests = {}
+
+# Client of each sqlite database used in this process
+sqlite_clients = {}
+
+# Loader misses remembered in each cache folder used in this process
+negative_caches = {}
+
+# Background thread enforcing the retention policies, if started
+compactor = None
+
+# Background writer of the file cache, started on the first write behind
+write_behind_queue = None
+
+# Held while appending to or compacting a series log
+log_lock = threading.Lock()
+
+# Fetches in progress in this process, by cache id
+flights = single_flight.SingleFlight()
+
+# Hex digits of the name of each level of cache subdirectories
+SHARD_WIDTH = 2
+
+# Subdirectory of the cache folder holding the lock files of fetches
+LOCK_FOLDER = 'locks'
+
+################################################################################
+
+def get_cache_path(id):
+    """
+    Path of the files of id in the cache, without an extension. The files
+    are spread over config.CACHE_SHARD_LEVELS levels of subdirectories
+    named after the leading hex digits of the sha1 of the id, e.g.
+    cache/3f/a2/<id>, so no one directory holds too many files
+    """
+    digest = hashlib.sha1(id).hexdigest()
+    shards = [digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+              for level in range(config.CACHE_SHARD_LEVELS)]
+    return os.path.join(config.CACHE_FOLDER, *(shards + [id]))
+
+################################################################################
+
+def get_lock_filename(key):
+    """
+    Lock file held while fetching the series with this key. Series share
+    lock files by the leading hex digits of the sha1 of their key, as for
+    the cache subdirectories, so there are at most 16 ** SHARD_WIDTH of
+    them whatever the number of series or the db
+    """
+    digest = hashlib.sha1(key).hexdigest()
+    return os.path.join(config.CACHE_FOLDER, LOCK_FOLDER,
+                        digest[:SHARD_WIDTH] + CACHE_EXT_LOCK)
+
+################################################################################
 
+def make_cache_dir(filename):
+    """
+    Create the subdirectory of the cache a file is about to be written to
+    """
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Created by another writer meanwhile
+            if not os.path.isdir(folder):
+                raise
 
 ################################################################################
 
@@ -27,7 +154,7 @@ def get_cache_filename_pickle(id):
     """
     Get the filename in the cache associated with id
     """
-    return os.path.join(config.CACHE_FOLDER, id) + CACHE_EXT_PICKLE
+    return get_cache_path(id) + CACHE_EXT_PICKLE
 
 ################################################################################
 
@@ -35,7 +162,50 @@ def get_cache_filename_spickle(id):
     """
     Get the filename in the cache associated with id
     """
-    return os.path.join(config.CACHE_FOLDER, id) + CACHE_EXT_SPICKLE
+    return get_cache_path(id) + CACHE_EXT_SPICKLE
+
+################################################################################
+
+def get_cache_filename_npy(id):
+    """
+    Get the filename in the cache associated with id
+    """
+    return get_cache_path(id) + CACHE_EXT_NPY
+
+################################################################################
+
+def get_cache_filename_gorilla(id):
+    """
+    Get the filename in the cache associated with id
+    """
+    return get_cache_path(id) + CACHE_EXT_GORILLA
+
+################################################################################
+
+def get_cache_filename_stats(id):
+    """
+    Get the filename of the statistics accumulator stored alongside the
+    cached series with this id
+    """
+    return get_cache_path(id) + CACHE_EXT_STATS
+
+################################################################################
+
+def get_cache_filename_coverage(id):
+    """
+    Get the filename of the list of date intervals covered by the cached
+    series with this id
+    """
+    return get_cache_path(id) + CACHE_EXT_COVERAGE
+
+################################################################################
+
+def get_cache_filename_log(id):
+    """
+    Get the filename of the log of points appended to the cached series
+    with this id
+    """
+    return get_cache_path(id) + CACHE_EXT_LOG
 
 ################################################################################
 
@@ -47,6 +217,344 @@ def get_cache_filename_csv(id):
 
 ################################################################################
 
+def get_cache_filename(id, format):
+    """
+    Get the filename in the cache of the given format associated with id
+    """
+    if format == 'csv':
+        return get_cache_filename_csv(id)
+    for ext, f in CACHE_FORMATS.iteritems():
+        if f == format:
+            return get_cache_path(id) + ext
+    raise Exception('invalid cache format ' + format)
+
+################################################################################
+
+def get_manifest():
+    """
+    Return the manifest of the current cache folder. It's read on first
+    use, or built from the files in the folder if there isn't one yet
+    """
+    folder = os.path.abspath(config.CACHE_FOLDER)
+    manifest = manifests.get(folder)
+    if manifest is None:
+        manifest = cache_manifest.Manifest(folder)
+        if manifest.exists():
+            manifest.load()
+        elif os.path.isdir(folder):
+            manifest.replace(scan_cache(manifest))
+        manifests[folder] = manifest
+        if config.CACHE_COMPACTION_INTERVAL > 0:
+            start_compaction()
+    return manifest
+
+################################################################################
+
+def cache_entry(manifest, filename, format, loader=None, coverage=None,
+                written=None, codec=compression.NONE):
+    """
+    Describe a file in the cache for the manifest
+    """
+    if written is None:
+        written = time.time()
+    return {
+        'path': os.path.relpath(os.path.abspath(filename), manifest.folder),
+        'format': format,
+        'codec': codec,
+        'size': os.path.getsize(filename),
+        'checksum': cache_manifest.file_checksum(filename),
+        'loader': loader,
+        'coverage': coverage,
+        'written': written,
+        'accessed': written
+    }
+
+################################################################################
+
+def register_cache_file(id, format, filename, loader=None, coverage=None):
+    manifest = get_manifest()
+    manifest.put(id, format,
+                 cache_entry(manifest, filename, format, loader, coverage))
+
+################################################################################
+
+def get_write_behind_queue():
+    global write_behind_queue
+    if write_behind_queue is None:
+        write_behind_queue = write_behind.WriteBehindQueue(
+            config.WRITE_BEHIND_QUEUE)
+    return write_behind_queue
+
+################################################################################
+
+def get_pending_write(id):
+    """
+    Return the (ts, coverage) of a write of id to the current cache folder
+    that's still queued, or None
+    """
+    if write_behind_queue is None:
+        return None
+    return write_behind_queue.get((os.path.abspath(config.CACHE_FOLDER), id))
+
+################################################################################
+
+def after_cache_write(id, f):
+    """
+    Call f() once the queued writes of id to the current cache folder are
+    done, in the background, or at once if there are none
+    """
+    if write_behind_queue is None:
+        f()
+    else:
+        write_behind_queue.after((os.path.abspath(config.CACHE_FOLDER), id), f)
+
+################################################################################
+
+def flush_cache_writes():
+    """
+    Wait for the queued writes to the file cache to be done
+    """
+    if write_behind_queue is not None:
+        write_behind_queue.flush()
+
+################################################################################
+
+def scan_cache(manifest):
+    """
+    Build the manifest entries of the files found in the cache and csv
+    folders. The loader of each file isn't known
+    """
+    found = []
+    for folder, _, files in os.walk(config.CACHE_FOLDER):
+        for f in files:
+            name, codec = compression.split_extension(f)
+            id, ext = os.path.splitext(name)
+            format = CACHE_FORMATS.get(ext, LEGACY_CACHE_FORMATS.get(ext))
+            if format is not None:
+                found.append((id, format, codec, os.path.join(folder, f)))
+    if os.path.isdir(config.CSV_FOLDER):
+        for f in os.listdir(config.CSV_FOLDER):
+            name, codec = compression.split_extension(f)
+            id, ext = os.path.splitext(name)
+            if ext == CSV_EXT:
+                found.append((id, 'csv', codec,
+                              os.path.join(config.CSV_FOLDER, f)))
+
+    coverage = {}
+    for id, format, _, filename in found:
+        if format == 'coverage':
+            coverage[id] = utils.deserialise_obj(filename)
+
+    entries = {}
+    for id, format, codec, filename in found:
+        entries[(id, format)] = cache_entry(
+            manifest, filename, format,
+            coverage=coverage.get(id) if format in SERIALISERS else None,
+            written=os.path.getmtime(filename), codec=codec)
+    return entries
+
+################################################################################
+
+def rebuild_manifest():
+    """
+    Rebuild the manifest of the current cache folder from the files in it,
+    to recover from files being added or removed by hand
+    """
+    manifest = cache_manifest.Manifest(os.path.abspath(config.CACHE_FOLDER))
+    manifest.replace(scan_cache(manifest))
+    manifests[manifest.folder] = manifest
+    return manifest
+
+################################################################################
+
+def migrate_cache():
+    """
+    Move the files of the current cache folder to the layout of
+    config.CACHE_SHARD_LEVELS, e.g. a flat cache to a sharded one, rename
+    files with a legacy extension, and remove the subdirectories left
+    empty. Returns the number of files
+    moved. Run it while no other process uses the cache
+    """
+    flush_cache_writes()
+    manifest = get_manifest()
+    moved = 0
+    with log_lock:
+        for (id, format), entry in manifest.items():
+            if format == 'csv':
+                continue
+            source = manifest.path(entry)
+            target = os.path.abspath(
+                get_cache_filename(id, format) +
+                compression.extension(entry.get('codec', compression.NONE)))
+            if source == target:
+                continue
+
+            make_cache_dir(target)
+            try:
+                os.rename(source, target)
+            except OSError:
+                manifest.remove(id, format)
+                continue
+            if os.path.exists(source + segment_store.COMPACTING_SUFFIX):
+                os.rename(source + segment_store.COMPACTING_SUFFIX,
+                          target + segment_store.COMPACTING_SUFFIX)
+            entry = dict(entry)
+            entry['path'] = os.path.relpath(target, manifest.folder)
+            manifest.put(id, format, entry)
+            moved += 1
+
+    # Lock files, e.g. the one per series of earlier versions next to the
+    # series files, are recreated in LOCK_FOLDER when they're needed next
+    for folder, _, files in os.walk(manifest.folder, topdown=False):
+        for f in files:
+            if (f.endswith(CACHE_EXT_LOCK) and
+                    f != cache_manifest.LOCK_FILENAME):
+                os.remove(os.path.join(folder, f))
+        if folder != manifest.folder and not os.listdir(folder):
+            os.rmdir(folder)
+    manifest.compact()
+    return moved
+
+################################################################################
+
+def verify_cache():
+    """
+    Return the (id, format) keys of the manifest whose file is missing or
+    doesn't match the recorded size and checksum
+    """
+    manifest = get_manifest()
+    bad = []
+    for key, entry in manifest.items():
+        filename = manifest.path(entry)
+        if (not os.path.exists(filename) or
+                os.path.getsize(filename) != entry['size'] or
+                cache_manifest.file_checksum(filename) != entry['checksum']):
+            bad.append(key)
+    return bad
+
+################################################################################
+
+def get_negative_cache():
+    """
+    Return the loader misses remembered in the current cache folder
+    """
+    folder = os.path.abspath(config.CACHE_FOLDER)
+    cache = negative_caches.get(folder)
+    if cache is None:
+        cache = negative_caches[folder] = negative_cache.NegativeCache(
+            os.path.join(folder, negative_cache.JOURNAL_FILENAME))
+    return cache
+
+################################################################################
+
+def record_miss(loader, loader_args, reason):
+    """
+    Remember that the loader had nothing for the series in the requested
+    dates, so it isn't asked again for them for config.NEGATIVE_TTL[reason]
+    seconds (if that's > 0)
+    """
+    ttl = config.NEGATIVE_TTL.get(reason, 0)
+    if ttl > 0:
+        logging.getLogger('root').info('Remembering miss ({0}) for {1} '
+                                       'seconds'.format(reason, ttl))
+        make_cache_dir(get_negative_cache().filename)
+        get_negative_cache().put(get_series_key(loader, loader_args), loader,
+                                 reason, ttl, loader_args.get('start'),
+                                 loader_args.get('end'))
+
+################################################################################
+
+def clear_misses(reason=None):
+    """
+    Forget the remembered loader misses, or only the series with a miss
+    with the reason code given, so they're asked for again
+    """
+    misses = get_negative_cache()
+    if reason is None:
+        misses.clear()
+        return
+    misses.remove(*set(id for id, entry in misses.items()
+                       if entry['reason'] == reason))
+
+################################################################################
+
+def get_ttl(loader):
+    """
+    Time to live in seconds of the cached series of loader, 0 for no limit
+    """
+    return config.CACHE_TTL.get(loader, config.CACHE_DEFAULT_TTL)
+
+################################################################################
+
+def enforce_retention(now=None):
+    """
+    Remove the expired series from the cache and, if it's over the byte
+    cap, the least recently used ones. Returns the ids removed.
+    Safe to run while other threads read the cache: a series removed
+    under a reader is a cache miss
+    """
+    if now is None:
+        now = time.time()
+    manifest = get_manifest()
+    evicted = cache_retention.select_evictions(manifest.items(), now,
+                                               config.CACHE_MAX_BYTES, get_ttl)
+    if evicted:
+        get_negative_cache().remove(*evicted)
+        for id in evicted:
+            memory_tier.invalidate(id)
+        remove_cache_files(manifest, manifest.remove_ids(evicted))
+    manifest.compact()
+    return evicted
+
+################################################################################
+
+def compaction_pass():
+    enforce_retention()
+    compact_logs()
+    get_negative_cache().compact()
+
+################################################################################
+
+def start_compaction(interval=None):
+    """
+    Start a background thread enforcing the retention policies and
+    compacting the series logs every interval seconds
+    (config.CACHE_COMPACTION_INTERVAL by default)
+    """
+    global compactor
+    if compactor is None:
+        compactor = cache_retention.Compactor(
+            compaction_pass, interval or config.CACHE_COMPACTION_INTERVAL)
+        compactor.start()
+    return compactor
+
+################################################################################
+
+def stop_compaction():
+    global compactor
+    if compactor is not None:
+        compactor.stop()
+        compactor.join()
+        compactor = None
+
+################################################################################
+
+def list_cache(format=None):
+    """
+    List of ((id, format), entry) pairs for the files in the cache
+    """
+    return get_manifest().items(format)
+
+################################################################################
+
+def cache_stats():
+    """
+    Number of files and bytes in the cache, in total and per format
+    """
+    return get_manifest().stats()
+
+################################################################################
+
 def get_from_file_cache(id):
     """
     Check whether the series with the input id is present in the cache
@@ -55,63 +563,155 @@ def get_from_file_cache(id):
     if id is None:
         return False
 
-    if (config.SERIALISER == 'pickle'):
-        cache_file = get_cache_filename_pickle(id)
-        if os.path.exists(cache_file):
-            logger.info("cached file found {0}".format(cache_file))
-            return utils.deserialise_obj(cache_file)
-        else:
-            logger.info("cached file NOT found {0}".format(cache_file))
-    elif (config.SERIALISER == 'spickle'):
-        cache_file = get_cache_filename_spickle(id)
-        if os.path.exists(cache_file):
-            logger.info("cached file found {0}".format(cache_file))
-            return utils.s_deserialise_obj(cache_file)
-        else:
-            logger.info("cached file NOT found {0}".format(cache_file))
-    elif (config.SERIALISER == 'csv'):
-        cache_file = get_cache_filename_csv(id)
-        if os.path.exists(cache_file):
-            logger.info("cached file found {0}".format(cache_file))
-            return utils.deserialise_csv(cache_file)
-        else:
-            logger.info("cached file NOT found {0}".format(cache_file))
-    else:
+    if config.SERIALISER not in SERIALISERS:
         raise Exception('invalid serialiser' + config.SERIALISER)
 
-    return None
-    
+    # The log is read before the series: if a compaction folds it into
+    # the series in between, its points are merged twice, which is harmless
+    log = read_log(id)
+
+    pending = get_pending_write(id)
+    if pending is not None:
+        logger.info("cached write pending for {0}".format(id))
+        return segment_store.merge(pending[0], log)
+
+    manifest = get_manifest()
+    entry = manifest.get(id, config.SERIALISER)
+    if entry is None:
+        logger.info("cached file NOT found for {0}".format(id))
+        return None
+
+    # Expired as a whole series, as for the retention pass
+    now = time.time()
+    written = cache_retention.series_written(
+        manifest.get_id(id).itervalues())
+    if cache_retention.is_expired(get_ttl(entry['loader']), written, now):
+        logger.info("cached file expired for {0}".format(id))
+        clear_cache(id)
+        return None
+    manifest.touch(id, config.SERIALISER, now)
+
+    logger.info("cached file found {0}".format(manifest.path(entry)))
+    try:
+        ts = read_cache_file(manifest, entry)
+    except IOError:
+        # The file has been removed without going through the manifest
+        logger.warning("cached file missing {0}".format(manifest.path(entry)))
+        manifest.remove(id, config.SERIALISER)
+        return None
+
+    return segment_store.merge(ts, log)
+
+################################################################################
+
+def read_cache_file(manifest, entry):
+    """
+    Deserialise the cached file described by a manifest entry
+    """
+    cache_file = manifest.path(entry)
+    opener = compression.opener(entry.get('codec', compression.NONE))
+    if (entry['format'] == 'pickle'):
+        return utils.deserialise_obj(cache_file, opener)
+    elif (entry['format'] == 'spickle'):
+        return utils.s_deserialise_obj(cache_file, opener)
+    elif (entry['format'] == 'csv'):
+        return utils.deserialise_csv(cache_file, opener)
+    elif (entry['format'] == 'npy'):
+        return utils.npy_deserialise_obj(cache_file)
+    elif (entry['format'] == 'gorilla'):
+        return utils.gorilla_deserialise_obj(cache_file)
+    else:
+        raise Exception('invalid serialiser' + entry['format'])
+
+################################################################################
+
+def read_log(id):
+    """
+    The records of the log of points appended to the series with this id
+    """
+    manifest = get_manifest()
+    # Most series have no log, so a miss doesn't catch up with the other
+    # processes: the lookup of the series or the fetch lock does
+    entry = manifest.get(id, 'log', refresh=False)
+    if entry is None:
+        return numpy.empty(0, dtype=segment_store.LOG_DTYPE)
+    return segment_store.read_all(manifest.path(entry))
+
 ################################################################################
 
 def clear_cache(id=None):
     """
-    Remove all cache files in the cache folder, or just the specified id
+    Remove all cache files in the cache folder, or just the specified id,
+    and the loader misses remembered for them
     """
     if id is not None:
+        get_negative_cache().remove(id)
+    else:
+        get_negative_cache().clear()
+
+    if config.DB == SQLITE_DB:
+        if id is not None:
+            memory_tier.invalidate(id)
+            get_sqlite().remove(id)
+        else:
+            memory_tier.clear()
+            get_sqlite().clear()
+        return
+
+    flush_cache_writes()
+    manifest = get_manifest()
+    if id is not None:
+        memory_tier.invalidate(id)
+        entries = manifest.remove_id(id)
+    else:
+        memory_tier.clear()
+        entries = [entry for _, entry in manifest.items()]
+        manifest.clear()
+
+    remove_cache_files(manifest, entries)
+    if id is None:
+        manifest.compact()
+
+################################################################################
+
+def remove_cache_files(manifest, entries):
+    """
+    Remove the files of manifest entries already taken out of it
+    """
+    for entry in entries:
         try:
-            os.remove(get_cache_filename_pickle(id))
-        except OSError:
-            pass
-        try:
-            os.remove(get_cache_filename_spickle(id))
+            os.remove(manifest.path(entry))
         except OSError:
             pass
-    else:
-        for root, dirs, files in os.walk(config.CACHE_FOLDER):
-            for f in files:
-                if f.endswith(CACHE_EXT_PICKLE):
-                    os.remove(f)
-                if f.endswith(CACHE_EXT_SPICKLE):
-                    os.remove(f)
+        # and what's left of an interrupted log compaction
+        if entry['format'] == 'log':
+            try:
+                os.remove(manifest.path(entry) +
+                          segment_store.COMPACTING_SUFFIX)
+            except OSError:
+                pass
+
+################################################################################
+
+def clear_loader_cache(loader):
+    """
+    Remove every cached series fetched with the loader
+    """
+    ids = set(id for (id, _), entry in get_manifest().items()
+              if entry['loader'] == loader)
+    for id in ids:
+        clear_cache(id)
 
 ################################################################################
 
 def get_id(loader, loader_args):
     """
-    Create the hash of the loader function name and its arguments
+    Create the hash of the loader function name and its arguments. The
+    date range arguments are left out, so every request for a series
+    shares one cache entry
     """
     if (config.FILEID_TYPE == 'sha1'):
-        return hashlib.sha1('{0}{1}'.format(loader, loader_args)).hexdigest()
+        return get_sha1_id(loader, loader_args)
     elif (config.FILEID_TYPE == 'explicit'):
         return '$$'.join((loader_args['symbol'], loader_args['field']))
     else:
@@ -119,6 +719,26 @@ def get_id(loader, loader_args):
 
 ################################################################################
 
+def get_sha1_id(loader, loader_args):
+    identity = sorted((k, v) for k, v in loader_args.iteritems()
+                      if k not in RANGE_ARGS)
+    return hashlib.sha1('{0}{1}'.format(loader, identity)).hexdigest()
+
+################################################################################
+
+def get_series_key(loader, loader_args):
+    """
+    Key of the series in the memory tier, the negative cache and the
+    fetches in flight: its cache id, except with the mongo db, which
+    doesn't name series by id. The explicit id needs a symbol and field
+    that not every loader takes, so the db uses the sha1 one
+    """
+    if config.DB == MONGO_DB:
+        return get_sha1_id(loader, loader_args)
+    return get_id(loader, loader_args)
+
+################################################################################
+
 def get_db():
     if config.DB == MONGO_DB:
         return db.MongoClient()
@@ -127,10 +747,22 @@ def get_db():
 
 ################################################################################
 
+def get_sqlite():
+    """
+    Return the client of the current sqlite database
+    """
+    filename = os.path.abspath(config.SQLITE_FILE)
+    client = sqlite_clients.get(filename)
+    if client is None:
+        client = sqlite_clients[filename] = sqlite_db.SQLiteClient(filename)
+    return client
+
+################################################################################
+
 def db_query_string(timeseries_id):
     query = {}
     for k, v in timeseries_id.iteritems():
-        if k not in ('start', 'end'):
+        if k not in RANGE_ARGS:
             query['{0}.{1}'.format(data_structure.ID, k)] = v
 
     return query
@@ -145,45 +777,450 @@ def get_from_cache(loader, loader_args):
     """
 
     logger = logging.getLogger('root')
+    key = get_series_key(loader, loader_args)
+    ts = memory_tier.get(key)
+    if ts is not None:
+        logger.info('found in memory cache')
+        return ts
+
     client = get_db()
     if client is not None:
         # Get the time series from the db
         query = db_query_string(loader_args)
         match = client.find(db.TIMESERIES_COLLECTION, query)
         if len(match) > 0:
+            memory_tier.put(key, match)
             return match
         else:
             logger.info('could not find in MONGO cache')
             return None
 
+    elif config.DB == SQLITE_DB:
+        ts = get_sqlite().get(key)
+        if not ts:
+            logger.info('could not find in SQLITE cache')
+            return None
+
+        memory_tier.put(key, ts)
+        return ts
+
     else:
         # Get the time series from the cache
-        id = get_id(loader, loader_args)
-        ts = get_from_file_cache(id)
+        ts = get_from_file_cache(key)
 
         # If the time series is not in the cache/db, load it using the loader
         # function
         if not ts:
             return None
 
+        memory_tier.put(key, ts)
         return ts
 
 ################################################################################
 
-def write_to_cache(loader, loader_args, ts):
+def write_to_cache(loader, loader_args, ts, coverage=None):
+    """
+    Store ts in the cache. coverage is the list of date intervals it holds
+    all the points of, if known
+    """
+    memory_tier.invalidate(get_series_key(loader, loader_args))
     client = get_db()
     if client is not None:
         client.insert(db.TIMESERIES_COLLECTION, ts)
+    elif config.DB == SQLITE_DB:
+        id = get_id(loader, loader_args)
+        get_sqlite().put(id, loader, loader_args, ts, coverage)
+        refresh_stats(id, loader, ts)
     else:
         id = get_id(loader, loader_args)
-        if (config.SERIALISER == 'pickle'):
-            utils.serialise_obj(ts, get_cache_filename_pickle(id))
-        elif (config.SERIALISER == 'spickle'):
-            utils.s_serialise_obj(ts, get_cache_filename_spickle(id))
-        elif (config.SERIALISER == 'csv'):
-            utils.serialise_csv(ts, get_cache_filename_csv(id))
-        else:
+        refresh_stats(id, loader, ts)
+        if config.SERIALISER not in SERIALISERS:
             raise Exception('invalid serialiser')
+        # npy files are memory mapped and gorilla files already compressed,
+        # so neither go through a codec
+        codec = config.COMPRESSION
+        if config.SERIALISER in ('npy', 'gorilla'):
+            codec = compression.NONE
+        cache_file = (get_cache_filename(id, config.SERIALISER) +
+                      compression.extension(codec))
+        write = functools.partial(
+            write_cache_files, get_manifest(), id, config.SERIALISER,
+            cache_file, ts, loader, coverage, codec)
+        if config.WRITE_BEHIND:
+            get_write_behind_queue().put(
+                (os.path.abspath(config.CACHE_FOLDER), id), (ts, coverage),
+                write)
+        else:
+            write()
+
+################################################################################
+
+def write_cache_files(manifest, id, format, cache_file, ts, loader, coverage,
+                      codec=compression.NONE):
+    """
+    write_cache_file, then the coverage file of the series if coverage is
+    given, so a write behind does both off the caller's thread
+    """
+    write_cache_file(manifest, id, format, cache_file, ts, loader, coverage,
+                     codec)
+    if coverage is not None:
+        write_coverage(id, coverage)
+
+################################################################################
+
+def write_cache_file(manifest, id, format, cache_file, ts, loader, coverage,
+                     codec=compression.NONE):
+    """
+    Serialise ts to cache_file, compressed with codec, atomically, and add
+    it to the manifest
+    """
+    opener = compression.opener(codec)
+    if (format == 'pickle'):
+        serialise = functools.partial(utils.serialise_obj, opener=opener)
+    elif (format == 'spickle'):
+        serialise = functools.partial(utils.s_serialise_obj, opener=opener)
+    elif (format == 'csv'):
+        serialise = functools.partial(utils.serialise_csv, opener=opener)
+    elif (format == 'npy'):
+        serialise = utils.npy_serialise_obj
+    elif (format == 'gorilla'):
+        serialise = utils.gorilla_serialise_obj
+    make_cache_dir(cache_file)
+    utils.atomic_serialise(serialise, ts, cache_file)
+
+    previous = manifest.get(id, format)
+    manifest.put(id, format,
+                 cache_entry(manifest, cache_file, format, loader, coverage,
+                             codec=codec))
+    # A change of codec leaves the file written with the old one behind
+    if (previous is not None and
+            manifest.path(previous) != os.path.abspath(cache_file)):
+        try:
+            os.remove(manifest.path(previous))
+        except OSError:
+            pass
+    # Retention brings the cache well under the cap, so this is only
+    # every so many writes
+    if 0 < config.CACHE_MAX_BYTES < manifest.bytes:
+        enforce_retention()
+
+################################################################################
+
+def append_to_cache(loader, loader_args, records, coverage=None):
+    """
+    Append the points of newly fetched records, or a bare series, to the
+    log of the cached series, lined up with the cached records (see
+    segment_store), at a cost in the number of new points. coverage, if
+    given, replaces the coverage of the cached series. The log is
+    compacted into the series once it's over config.LOG_COMPACT_BYTES
+    """
+    id = get_id(loader, loader_args)
+    memory_tier.invalidate(id)
+    manifest = get_manifest()
+    log_file = get_cache_filename_log(id)
+    make_cache_dir(log_file)
+    with log_lock:
+        segment_store.append(log_file, segment_store.record_series(records))
+        manifest.put(id, 'log', cache_entry(manifest, log_file, 'log', loader))
+    update_stats(id, loader, records)
+
+    if coverage is not None:
+        set_coverage(id, coverage)
+
+    if manifest.get(id, 'log')['size'] > config.LOG_COMPACT_BYTES:
+        compact_log(id)
+
+################################################################################
+
+def compact_log(id):
+    """
+    Fold the log of points appended to the cached series with this id into
+    the cached file
+    """
+    flush_cache_writes()
+    manifest = get_manifest()
+    with log_lock:
+        log_entry = manifest.get(id, 'log')
+        entry = manifest.get(id, config.SERIALISER)
+        if log_entry is None or entry is None:
+            return
+
+        log_file = manifest.path(log_entry)
+        compacting = segment_store.start_compaction(log_file)
+        ts = segment_store.merge(read_cache_file(manifest, entry),
+                                 segment_store.read(compacting))
+        write_cache_file(manifest, id, config.SERIALISER, manifest.path(entry),
+                         ts, entry['loader'], entry['coverage'],
+                         entry.get('codec', compression.NONE))
+        os.remove(compacting)
+        manifest.remove(id, 'log')
+    memory_tier.invalidate(id)
+
+################################################################################
+
+def compact_logs():
+    """
+    Compact the logs of every cached series
+    """
+    for (id, _), _ in get_manifest().items('log'):
+        compact_log(id)
+
+################################################################################
+
+def get_stats_from_cache(loader, loader_args):
+    """
+    Return the statistics accumulator stored next to the cached series,
+    or None if there isn't one
+    """
+    return read_stats(get_series_key(loader, loader_args))
+
+################################################################################
+
+def write_stats_to_cache(loader, loader_args, acc):
+    """
+    Store the statistics accumulator of the cached series (a bare series,
+    or a list of one record) next to it. It's kept up to date as the
+    series is written and appended to, see update_stats and refresh_stats
+    """
+    write_stats(get_series_key(loader, loader_args), loader, acc)
+
+################################################################################
+
+def read_stats(id):
+    manifest = get_manifest()
+    entry = manifest.get(id, 'stats')
+    if entry is None:
+        return None
+    return accumulators.StatsAccumulator.from_dict(
+        utils.deserialise_obj(manifest.path(entry)))
+
+################################################################################
+
+def write_stats(id, loader, acc):
+    stats_file = get_cache_filename_stats(id)
+    make_cache_dir(stats_file)
+    utils.atomic_serialise(utils.serialise_obj, acc.to_dict(), stats_file)
+    register_cache_file(id, 'stats', stats_file, loader)
+
+################################################################################
+
+def remove_stats(id):
+    manifest = get_manifest()
+    entry = manifest.get(id, 'stats')
+    if entry is not None:
+        manifest.remove(id, 'stats')
+        try:
+            os.remove(manifest.path(entry))
+        except OSError:
+            pass
+
+################################################################################
+
+def single_series(obj):
+    """
+    The series of a loader result that holds one: a bare series, or a list
+    of one record. None otherwise
+    """
+    if range_cache.is_series(obj):
+        return obj
+    if len(obj) == 1 and data_structure.is_time_series_record(obj[0]):
+        return obj[0][data_structure.TIMESERIES]
+    return None
+
+################################################################################
+
+def update_stats(id, loader, fetched):
+    """
+    Add the points of a fetched result appended to the cached series with
+    this id to its statistics accumulator, if it has one, at a cost in the
+    number of new points. Points that don't all come after those already
+    counted may replace some of them, so the accumulator is removed then
+    """
+    acc = read_stats(id)
+    if acc is None:
+        return
+    ts = single_series(fetched)
+    if ts is not None:
+        ts = timeseries.as_columnar(ts)
+    if ts is None or (acc.last_date is not None and len(ts) > 0 and
+                      ts.dates.min() <= numpy.datetime64(acc.last_date, 'us')):
+        remove_stats(id)
+        return
+    write_stats(id, loader, acc.update_series(ts))
+
+################################################################################
+
+def refresh_stats(id, loader, ts):
+    """
+    Recompute the statistics accumulator of the cached series with this
+    id, if it has one, after the series is rewritten as ts
+    """
+    if get_manifest().get(id, 'stats') is None:
+        return
+    series = single_series(ts)
+    if series is None:
+        remove_stats(id)
+    else:
+        write_stats(id, loader, accumulators.accumulate(series))
+
+################################################################################
+
+def get_coverage(id):
+    """
+    Return the list of (start, end) date intervals the cached series with
+    this id has been fetched for
+    """
+    if config.DB == SQLITE_DB:
+        return get_sqlite().get_coverage(id)
+
+    pending = get_pending_write(id)
+    if pending is not None:
+        return pending[1] or []
+
+    entry = get_manifest().get(id, config.SERIALISER)
+    if entry is None or entry['coverage'] is None:
+        return []
+    return entry['coverage']
+
+################################################################################
+
+def set_coverage(id, coverage):
+    """
+    Replace the coverage of the cached series in the manifest
+    """
+    manifest = get_manifest()
+    entry = manifest.get(id, config.SERIALISER)
+    if entry is not None:
+        entry = dict(entry)
+        entry['coverage'] = coverage
+        manifest.put(id, config.SERIALISER, entry)
+
+################################################################################
+
+def write_coverage(id, coverage):
+    """
+    Keep the coverage in a file next to the cached series as well as in
+    the manifest, so a rebuilt manifest still knows it
+    """
+    coverage_file = get_cache_filename_coverage(id)
+    make_cache_dir(coverage_file)
+    utils.atomic_serialise(utils.serialise_obj, coverage, coverage_file)
+    register_cache_file(id, 'coverage', coverage_file)
+
+################################################################################
+
+def get_time_series_range(loader, loader_args):
+    """
+    Return the series for the requested date range from the file cache,
+    calling the loader only for the parts of the range that haven't been
+    fetched before and merging them into the cached series
+    """
+    logger = logging.getLogger('root')
+    start = loader_args['start']
+    end = loader_args['end']
+
+    id = get_id(loader, loader_args)
+    ts = get_from_cache(loader, loader_args)
+    coverage = get_coverage(id) if ts else []
+
+    # New points for an already cached series go to its log, unless a
+    # series can't be logged, in which case the whole series is rewritten
+    stored = ts
+    stored_coverage = coverage
+    appended = []
+    miss = negative_cache.EMPTY
+    missing = range_cache.missing_intervals(coverage, start, end)
+    for missing_start, missing_end in missing:
+        logger.info('fetching {0} to {1}'.format(missing_start, missing_end))
+        args = dict(loader_args)
+        args['start'] = missing_start
+        args['end'] = missing_end
+        fetched = getattr(data_loader, loader)(**args)
+        # An empty interval in the past, e.g. a weekend, is covered too so
+        # it isn't asked for again
+        covered = range_cache.covered_interval(missing_start, missing_end)
+        if covered is not None and fetched is not None:
+            coverage = range_cache.add_interval(coverage, *covered)
+        if not fetched:
+            miss = negative_cache.reason(fetched)
+            continue
+
+        ts = range_cache.merge_results(ts, fetched) if ts else fetched
+        appended.append(fetched)
+
+    if not ts:
+        record_miss(loader, loader_args, miss)
+        return None
+
+    if appended:
+        if stored and all(segment_store.can_append(stored, fetched)
+                          for fetched in appended):
+            write_coverage(id, coverage)
+            for fetched in appended:
+                append_to_cache(loader, loader_args, fetched, coverage)
+        else:
+            write_to_cache(loader, loader_args, ts, coverage)
+    elif coverage != stored_coverage:
+        write_coverage(id, coverage)
+        set_coverage(id, coverage)
+    else:
+        logger.info('Found in cache')
+
+    return data_structure.slice_time_series(ts, start, end)
+
+################################################################################
+
+def get_time_series_range_sqlite(loader, loader_args):
+    """
+    As get_time_series_range, for the sqlite database: fetched points are
+    added to the stored series, and only the requested dates are read
+    back
+    """
+    logger = logging.getLogger('root')
+    start = loader_args['start']
+    end = loader_args['end']
+
+    id = get_id(loader, loader_args)
+    client = get_sqlite()
+    coverage = client.get_coverage(id)
+    # The number of records fetched must match the stored ones to add to
+    # them, otherwise the series is merged and rewritten
+    count = client.record_count(id)
+    miss = negative_cache.EMPTY
+
+    missing = range_cache.missing_intervals(coverage, start, end)
+    for missing_start, missing_end in missing:
+        logger.info('fetching {0} to {1}'.format(missing_start, missing_end))
+        args = dict(loader_args)
+        args['start'] = missing_start
+        args['end'] = missing_end
+        fetched = getattr(data_loader, loader)(**args)
+        covered = range_cache.covered_interval(missing_start, missing_end)
+        if covered is not None and fetched is not None:
+            coverage = range_cache.add_interval(coverage, *covered)
+        if not fetched:
+            miss = negative_cache.reason(fetched)
+            # An empty interval of a stored series is covered as well
+            if count is not None:
+                client.set_coverage(id, coverage)
+            continue
+
+        memory_tier.invalidate(id)
+        if count is not None and count == range_cache.record_count(fetched):
+            client.append(id, fetched, coverage)
+            update_stats(id, loader, fetched)
+        else:
+            stored = client.get(id)
+            ts = (range_cache.merge_results(stored, fetched) if stored
+                  else fetched)
+            client.put(id, loader, loader_args, ts, coverage)
+            refresh_stats(id, loader, ts)
+            count = range_cache.record_count(fetched)
+
+    if count is None:
+        record_miss(loader, loader_args, miss)
+        return None
+    return client.get(id, start, end)
 
 ################################################################################
 
@@ -192,8 +1229,83 @@ def get_time_series(loader, loader_args):
     Interrogate the cache for the requested series
     If it doesn't exit, call the loader function from the data_loader module
     with the dictionary args and add it to the cache
+
+    Only one thread and process at a time fetches a series: the others
+    wait for it, then take its result or find the series in the cache
     """
     logger = logging.getLogger('root')
+    id = get_series_key(loader, loader_args)
+    if is_range_request(loader_args):
+        start = loader_args['start']
+        end = loader_args['end']
+        if not range_cache.missing_intervals(get_coverage(id), start, end):
+            return get_time_series_cached(loader, loader_args)
+    else:
+        ts = get_from_cache(loader, loader_args)
+        if ts:
+            logger.info('Found in cache')
+            return data_structure.slice_time_series(ts,
+                                                    loader_args.get('start'),
+                                                    loader_args.get('end'))
+
+    miss = get_negative_cache().get(id, loader_args.get('start'),
+                                    loader_args.get('end'))
+    if miss is not None:
+        logger.info('Known miss ({0}) until {1}'.format(
+            miss['reason'], time.ctime(miss['expires'])))
+        return None
+
+    return flights.do(id, request_key(loader, loader_args),
+                      functools.partial(fetch_time_series, loader, loader_args))
+
+################################################################################
+
+def is_range_request(loader_args):
+    """
+    True if the request is answered by the range aware cache: the file
+    cache or sqlite, with both a start and end date
+    """
+    return (config.DB != MONGO_DB and
+            all(loader_args.get(k) is not None for k in RANGE_ARGS))
+
+################################################################################
+
+def fetch_time_series(loader, loader_args):
+    """
+    get_time_series for a series that wasn't in the cache, holding the
+    lock file of the series so other processes wait for it
+    """
+    id = get_series_key(loader, loader_args)
+    lock_file = get_lock_filename(id)
+    make_cache_dir(lock_file)
+    lock = single_flight.FileLock(lock_file)
+    lock.acquire()
+    try:
+        # Another process may have fetched the series meanwhile, so the
+        # cache is looked at again, with the manifest brought up to date
+        if config.DB not in (MONGO_DB, SQLITE_DB):
+            get_manifest().update()
+        ts = get_time_series_cached(loader, loader_args)
+    except BaseException:
+        lock.release()
+        raise
+    # The lock is let go once a series written behind is on disk, so the
+    # next process finds it there, while the caller goes on
+    after_cache_write(id, lock.release)
+    return ts
+
+################################################################################
+
+def get_time_series_cached(loader, loader_args):
+    """
+    The series from the cache, calling the loader for what's missing
+    """
+    logger = logging.getLogger('root')
+    if is_range_request(loader_args):
+        if config.DB == SQLITE_DB:
+            return get_time_series_range_sqlite(loader, loader_args)
+        return get_time_series_range(loader, loader_args)
+
     ts = get_from_cache(loader, loader_args)
 
     if not ts:
@@ -201,10 +1313,141 @@ def get_time_series(loader, loader_args):
         if ts:
             write_to_cache(loader, loader_args, ts)
         else:
+            record_miss(loader, loader_args, negative_cache.reason(ts))
             return None
     else:
         logger.info('Found in cache')
 
-    return ts
+    # The stored series may cover a wider range than requested (the mongo
+    # query ignores start and end), so return a view of the requested dates
+    return data_structure.slice_time_series(ts,
+                                            loader_args.get('start'),
+                                            loader_args.get('end'))
+
+################################################################################
+
+def request_key(loader, loader_args):
+    """
+    Key telling apart the requests get_time_series_many has to answer
+    separately: the series and the date range
+    """
+    return ((get_series_key(loader, loader_args),) +
+            tuple(loader_args.get(k) for k in RANGE_ARGS))
+
+################################################################################
+
+def query_values(document, paths):
+    """
+    Tuple of the values of the document at the dotted paths of a query
+    from db_query_string, or None if it lacks one
+    """
+    values = []
+    for path in paths:
+        field = document
+        for key in path.split('.'):
+            if not isinstance(field, dict) or key not in field:
+                return None
+            field = field[key]
+        values.append(field)
+    return tuple(values)
+
+################################################################################
+
+def index_documents(documents, paths):
+    """
+    Dictionary of the documents by their query_values at paths, so each
+    query of a batch finds its matches without a scan of the documents
+    """
+    index = {}
+    for document in documents:
+        values = query_values(document, paths)
+        if values is not None:
+            index.setdefault(values, []).append(document)
+    return index
+
+################################################################################
+
+def find_many_in_cache(requests):
+    """
+    Return {key: series} for the requests, a dictionary of request_key to
+    (loader, loader_args), that can be answered from the cache alone. The
+    db is asked with one $or query per MONGO_BATCH requests; the file
+    cache and sqlite are looked up by id, a date range only if the cached
+    series covers it
+    """
+    found = {}
+    client = get_db()
+    if client is not None:
+        items = requests.items()
+        for i in range(0, len(items), MONGO_BATCH):
+            batch = [(key, db_query_string(loader_args))
+                     for key, (_, loader_args) in items[i:i + MONGO_BATCH]]
+            documents = client.find(db.TIMESERIES_COLLECTION,
+                                    {'$or': [query for _, query in batch]})
+            # Indexed by the fields of each shape of query in the batch
+            indexes = {}
+            for key, query in batch:
+                paths = tuple(sorted(query))
+                if paths not in indexes:
+                    indexes[paths] = index_documents(documents, paths)
+                match = indexes[paths].get(tuple(query[p] for p in paths))
+                if match:
+                    memory_tier.put(key[0], match)
+                    found[key] = data_structure.slice_time_series(
+                        match, key[1], key[2])
+        return found
+
+    for key, (loader, loader_args) in requests.iteritems():
+        id, start, end = key
+        if start is not None and end is not None:
+            if range_cache.missing_intervals(get_coverage(id), start, end):
+                continue
+            ts = get_time_series(loader, loader_args)
+        else:
+            ts = get_from_cache(loader, loader_args)
+            if ts:
+                ts = data_structure.slice_time_series(ts, start, end)
+        if ts:
+            found[key] = ts
+    return found
+
+################################################################################
+
+def get_time_series_many(requests, threads=FETCH_THREADS):
+    """
+    Return the series of each (loader, loader_args) request, in request
+    order, as get_time_series would. Repeated requests are answered once
+    (and share the result), the cache is asked for all the requests
+    together, and the misses are fetched by up to threads loader calls at
+    a time. Use threads=1 for loaders that must be called from the calling
+    thread only
+    """
+    logger = logging.getLogger('root')
+    keys = [request_key(loader, loader_args)
+            for loader, loader_args in requests]
+    unique = collections.OrderedDict(zip(keys, requests))
+
+    results = find_many_in_cache(unique)
+    misses = [(key, request) for key, request in unique.iteritems()
+              if key not in results]
+    logger.info('{0} series requested, {1} found in cache, {2} to fetch'
+                .format(len(unique), len(results), len(misses)))
+
+    def fetch(request):
+        loader, loader_args = request
+        return get_time_series(loader, loader_args)
+
+    if threads <= 1 or len(misses) <= 1:
+        fetched = [fetch(request) for _, request in misses]
+    else:
+        pool = ThreadPool(min(threads, len(misses)))
+        try:
+            fetched = pool.map(fetch, [request for _, request in misses])
+        finally:
+            pool.close()
+            pool.join()
+    results.update(zip([key for key, _ in misses], fetched))
+
+    return [results[key] for key in keys]
 
 ################################################################################
@@ -1,3 +1,7 @@
+import bisect
+
+from pyTimeSeries import timeseries
+
 
 ################################################################################
 
@@ -16,6 +20,80 @@ def create_time_series(id, timeseries, source):
 
 ################################################################################
 
+def is_time_series_record(obj):
+    return isinstance(obj, dict) and TIMESERIES in obj
+
+################################################################################
+
+def is_point_list(obj):
+    """
+    True for a list of (date, value) tuples, the plain form of a series,
+    judged by its first point
+    """
+    return (isinstance(obj, (list, tuple)) and
+            (len(obj) == 0 or
+             isinstance(obj[0], (list, tuple)) and len(obj[0]) >= 2))
+
+################################################################################
+
+class PointDates(object):
+    """
+    The dates of a list of (date, value) tuples as a sequence, to bisect
+    without building a list of them
+    """
+
+    def __init__(self, ts):
+        self.ts = ts
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, i):
+        return self.ts[i][0]
+
+################################################################################
+
+def slice_series(ts, start, end):
+    """
+    The points of a series with start <= date <= end, None leaving that
+    end open, found by binary search of the dates. The series must be
+    sorted. A TimeSeries gives a view of the range, a list of (date,
+    value) tuples a slice of it
+    """
+    if timeseries.is_columnar(ts):
+        return ts.between(start, end)
+    dates = PointDates(ts)
+    i = 0 if start is None else bisect.bisect_left(dates, start)
+    j = len(ts) if end is None else bisect.bisect_right(dates, end)
+    return ts[i:j]
+
+################################################################################
+
+def slice_time_series(obj, start, end):
+    """
+    Restrict a list of time series records, or a bare series (TimeSeries
+    or list of (date, value) tuples), to the dates from start to end.
+    TimeSeries are sliced without copying (see slice_series). Records
+    whose series is neither are returned as they are
+    """
+    if start is None and end is None:
+        return obj
+
+    def slice_record(record):
+        if not (is_time_series_record(record) and
+                (timeseries.is_columnar(record[TIMESERIES]) or
+                 is_point_list(record[TIMESERIES]))):
+            return record
+        sliced = dict(record)
+        sliced[TIMESERIES] = slice_series(record[TIMESERIES], start, end)
+        return sliced
+
+    if timeseries.is_columnar(obj) or is_point_list(obj):
+        return slice_series(obj, start, end)
+    return [slice_record(record) for record in obj]
+
+################################################################################
+
 def time_series_record(f):
 
     def wrap(*args, **kwargs):
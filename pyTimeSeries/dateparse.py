@@ -0,0 +1,234 @@
+"""
+Fast parsing of the date layouts found in the csv cache and loader data
+
+datetime.strptime interprets its format afresh for every string, which
+dominates the time to read long histories. These formats are parsed by
+slicing the numbers out at fixed offsets instead:
+
+    %Y-%m-%d %H:%M:%S   the csv cache, str() of a datetime
+    %Y-%m-%d            yahoo and the fed
+    %d-%b-%y            google, with the day not always zero padded
+
+Any other format, or a string that doesn't fit the layout of its format,
+is handed to strptime, so invalid dates raise strptime's errors.
+
+    parser(format)       function of one string, memoizing the dates it
+                         has seen, for columns with repeated dates
+    parse_array(texts)   a whole column into a datetime64 array, with
+                         numpy operations on the characters
+
+See benchmarks.py for the speed of each against strptime.
+"""
+import datetime
+
+import numpy
+
+from pyTimeSeries import timeseries
+
+################################################################################
+
+ISO_DATETIME = '%Y-%m-%d %H:%M:%S'
+ISO_DATE = '%Y-%m-%d'
+DAY_MONTH_YEAR = '%d-%b-%y'
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+          'Nov', 'Dec']
+MONTH_NUMBERS = dict((name, i + 1) for i, name in enumerate(MONTHS))
+
+# Two digit years below this are 20xx, as for strptime
+CENTURY_PIVOT = 69
+
+MICROSECONDS = numpy.timedelta64(1, 'us')
+
+################################################################################
+
+def parse_iso_datetime(text):
+    if (len(text) != 19 or text[4] != '-' or text[7] != '-' or
+            text[10] != ' ' or text[13] != ':' or text[16] != ':' or
+            not (text[0:4] + text[5:7] + text[8:10] + text[11:13] +
+                 text[14:16] + text[17:19]).isdigit()):
+        return None
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                             int(text[11:13]), int(text[14:16]),
+                             int(text[17:19]))
+
+
+def parse_iso_date(text):
+    if (len(text) != 10 or text[4] != '-' or text[7] != '-' or
+            not (text[0:4] + text[5:7] + text[8:10]).isdigit()):
+        return None
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+
+
+def parse_day_month_year(text):
+    parts = text.split('-')
+    if len(parts) != 3:
+        return None
+    day, month, year = parts
+    if (not 1 <= len(day) <= 2 or len(year) != 2 or month not in MONTH_NUMBERS
+            or not (day + year).isdigit()):
+        return None
+    year = int(year)
+    year += 2000 if year < CENTURY_PIVOT else 1900
+    return datetime.datetime(year, MONTH_NUMBERS[month], int(day))
+
+
+FAST_PARSERS = {
+    ISO_DATETIME: parse_iso_datetime,
+    ISO_DATE: parse_iso_date,
+    DAY_MONTH_YEAR: parse_day_month_year
+}
+
+################################################################################
+
+def parse(text, format):
+    """
+    Parse a string to a datetime, as datetime.strptime(text, format)
+    """
+    fast = FAST_PARSERS.get(format)
+    date = fast(text) if fast is not None else None
+    if date is None:
+        date = datetime.datetime.strptime(text, format)
+    return date
+
+################################################################################
+
+def parser(format):
+    """
+    Return a function parsing strings in format to datetimes, which
+    remembers the dates it has parsed
+    """
+    memo = {}
+
+    def parse_memoized(text):
+        try:
+            return memo[text]
+        except KeyError:
+            date = memo[text] = parse(text, format)
+            return date
+
+    return parse_memoized
+
+################################################################################
+
+def char_matrix(texts, width):
+    """
+    The characters of an array of byte strings as an n x width array of
+    uint8, padded with zeros
+    """
+    chars = numpy.zeros((len(texts), max(width, texts.dtype.itemsize)),
+                        dtype=numpy.uint8)
+    if texts.dtype.itemsize:
+        chars[:, :texts.dtype.itemsize] = texts.view(numpy.uint8).reshape(
+            len(texts), texts.dtype.itemsize)
+    return chars
+
+
+def numbers(chars, start, stop):
+    """
+    The numbers in columns start:stop of a character matrix, and whether
+    they are all digits
+    """
+    digits = chars[:, start:stop].astype(numpy.int64) - ord('0')
+    number = numpy.zeros(len(chars), dtype=numpy.int64)
+    for column in range(stop - start):
+        number = number * 10 + digits[:, column]
+    return number, ((digits >= 0) & (digits <= 9)).all()
+
+
+def separators(chars, layout):
+    """
+    True if every string has the character of layout at each of its
+    positions, and nothing after
+    """
+    for i, char in layout:
+        if not (chars[:, i] == ord(char)).all():
+            return False
+    return not chars[:, max(i for i, _ in layout) + 3:].any()
+
+
+def to_datetime64(year, month, day, seconds=None):
+    """
+    Combine arrays of dates and times of day into a datetime64 array, or
+    None if any of them isn't a valid date
+    """
+    if not ((month >= 1) & (month <= 12) & (day >= 1)).all():
+        return None
+    months = ((year - 1970) * 12 + month - 1).astype('M8[M]')
+    days = months.astype('M8[D]') + (day - 1).astype('m8[D]')
+    # A day past the end of its month spills into the next
+    if not (days.astype('M8[M]') == months).all():
+        return None
+    dates = days.astype(timeseries.DATE_DTYPE)
+    if seconds is not None:
+        dates = dates + seconds * 1000000 * MICROSECONDS
+    return dates
+
+
+def parse_array_fast(texts, format):
+    """
+    Parse a numpy array of byte strings in one of the fixed layouts, or
+    return None if any string doesn't fit it
+    """
+    if format == ISO_DATETIME or format == ISO_DATE:
+        chars = char_matrix(texts, 19)
+        layout = [(4, '-'), (7, '-')]
+        if format == ISO_DATETIME:
+            layout += [(10, ' '), (13, ':'), (16, ':')]
+        if not separators(chars, layout):
+            return None
+        fields = [numbers(chars, start, start + length) for start, length in
+                  [(0, 4), (5, 2), (8, 2), (11, 2), (14, 2), (17, 2)]
+                  [:len(layout) + 1]]
+        if not all(valid for _, valid in fields):
+            return None
+        values = [number for number, _ in fields]
+        seconds = None
+        if format == ISO_DATETIME:
+            hour, minute, second = values[3:]
+            if not ((hour < 24) & (minute < 60) & (second < 60)).all():
+                return None
+            seconds = hour * 3600 + minute * 60 + second
+        return to_datetime64(values[0], values[1], values[2], seconds)
+
+    elif format == DAY_MONTH_YEAR:
+        chars = char_matrix(texts, 9)
+        # Zero pad the single digit days: d-Mon-yy to 0d-Mon-yy
+        short = chars[:, 1] == ord('-')
+        chars[short, 1:9] = chars[short, 0:8].copy()
+        chars[short, 0] = ord('0')
+        if not separators(chars, [(2, '-'), (6, '-')]):
+            return None
+        day, day_valid = numbers(chars, 0, 2)
+        year, year_valid = numbers(chars, 7, 9)
+        if not (day_valid and year_valid):
+            return None
+        year += numpy.where(year < CENTURY_PIVOT, 2000, 1900)
+
+        key = chars[:, 3:6].copy().view('S3').ravel()
+        month = numpy.zeros(len(texts), dtype=numpy.int64)
+        for name, number in MONTH_NUMBERS.iteritems():
+            month[key == name] = number
+        return to_datetime64(year, month, day)
+
+    return None
+
+
+def parse_array(texts, format):
+    """
+    Parse a sequence of strings in format into a datetime64 array
+    """
+    texts = numpy.asarray(texts)
+    if len(texts) == 0:
+        return numpy.empty(0, dtype=timeseries.DATE_DTYPE)
+
+    dates = None
+    if texts.dtype.kind == 'S':
+        dates = parse_array_fast(texts, format)
+    if dates is None:
+        # Unusual strings, or an invalid date which strptime reports
+        dates = numpy.array([parse(text, format) for text in texts],
+                            dtype=timeseries.DATE_DTYPE)
+    return dates
+
+################################################################################
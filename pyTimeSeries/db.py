@@ -7,6 +7,7 @@ from pymongo.son_manipulator import SONManipulator
 
 ################################################################################
 from pyTimeSeries import config
+from pyTimeSeries import timeseries
 
 MONGO_SERVICE = 'mongod'
 MONGO_HOST = 'localhost'
@@ -64,10 +65,17 @@ def get():
 ################################################################################
 
 class TransformTuple(SONManipulator):
+    """
+    Store tuples and TimeSeries objects, which mongo doesn't support
+    natively, as tagged sub-documents
+    """
 
     type_key = '_type'
     tuple_type = 'tuple'
     container_key = 'as_list'
+    timeseries_type = 'timeseries'
+    dates_key = 'dates'
+    values_key = 'values'
 
     def encode_tuple(self, tup):
         return {
@@ -79,6 +87,25 @@ class TransformTuple(SONManipulator):
         assert document[self.type_key] == self.tuple_type
         return tuple(document[self.container_key])
 
+    def encode_timeseries(self, ts):
+        return {
+            self.type_key: self.timeseries_type,
+            self.dates_key: ts.dates.astype(object).tolist(),
+            self.values_key: ts.values.tolist()
+        }
+
+    def decode_timeseries(self, document):
+        assert document[self.type_key] == self.timeseries_type
+        return timeseries.TimeSeries(document[self.dates_key],
+                                     document[self.values_key])
+
+    def decode(self, document):
+        if document[self.type_key] == self.tuple_type:
+            return self.decode_tuple(document)
+        if document[self.type_key] == self.timeseries_type:
+            return self.decode_timeseries(document)
+        return document
+
     def transform_incoming(self, son, collection):
         if son is None:
             return son
@@ -87,6 +114,8 @@ class TransformTuple(SONManipulator):
         for (key, value) in copy.items():
             if isinstance(value, tuple):
                 copy[key] = self.encode_tuple(value)
+            elif timeseries.is_columnar(value):
+                copy[key] = self.encode_timeseries(value)
             # Make sure we recurse into sub-docs
             elif isinstance(value, dict):
                 copy[key] = self.transform_incoming(value, collection)
@@ -102,8 +131,7 @@ class TransformTuple(SONManipulator):
         for (key, value) in copy.items():
             if isinstance(value, dict):
                 if self.type_key in value:
-                    if value[self.type_key] == self.tuple_type:
-                        copy[key] = self.decode_tuple(value)
+                    copy[key] = self.decode(value)
                 else:
                     # Make sure we recurse into sub-docs
                     copy[key] = self.transform_outgoing(value, collection)
@@ -119,6 +147,8 @@ class TransformTuple(SONManipulator):
                 return self.transform_incoming_list(el, collection)
             elif isinstance(el, tuple):
                 return self.encode_tuple(el)
+            elif timeseries.is_columnar(el):
+                return self.encode_timeseries(el)
             return el
 
         return [transform_element(element) for element in lst]
@@ -127,8 +157,7 @@ class TransformTuple(SONManipulator):
         def transform_element(el):
             if isinstance(el, dict):
                 if self.type_key in el:
-                    if el[self.type_key] == self.tuple_type:
-                        return self.decode_tuple(el)
+                    return self.decode(el)
                 return self.transform_outgoing(el, collection)
             elif isinstance(el, list):
                 return self.transform_outgoing_list(el, collection)
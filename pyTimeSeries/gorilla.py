@@ -0,0 +1,351 @@
+"""
+Gorilla style compressed file format for cached time series
+
+Based on the encoding in Pelkonen et al, "Gorilla: A Fast, Scalable,
+In-Memory Time Series Database" (VLDB 2015):
+
+  - dates are stored as the delta of the delta between consecutive dates,
+    in a variable number of bits. The deltas are counted in a time unit,
+    the greatest common divisor of the gaps in the series (a day for
+    daily data), so a regular series costs 1 bit per date and a weekend
+    gap 9 bits
+
+  - values are XORed with the previous value. Equal values cost 1 bit;
+    otherwise only the bits between the leading and trailing zeros of
+    the XOR are stored, reusing the previous value's window when they fit.
+    Prices are decimals that doubles can't represent exactly, so their
+    XORs are mostly noise: a series whose values all have few decimal
+    places is scaled to whole numbers before encoding, which leaves long
+    runs of trailing zeros
+
+The file is a short header followed by the encoded series:
+
+    magic       8 bytes, 'PTSGRL01'
+    length      8 bytes, little endian length of the header
+    header      pickled dictionary describing the contents, as for npy
+                files (see npyfile), with the point count, time unit,
+                decimal scale and encoded length of each series
+    blocks      the encoded series, one after the other
+
+Encoder and decode work a point at a time, for streaming.
+"""
+import struct
+import cPickle as pickle
+
+import numpy
+
+import data_structure
+from pyTimeSeries import npyfile
+from pyTimeSeries import timeseries
+
+################################################################################
+
+MAGIC = 'PTSGRL01'
+LENGTH_FORMAT = '<Q'
+
+# (prefix, prefix length, value length) of the delta of delta buckets,
+# after the '0' of an unchanged delta
+DELTA_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+    (0b1111, 4, 64)
+]
+
+MAX_LEADING_ZEROS = 31
+
+MAX_DECIMAL_PLACES = 6
+
+################################################################################
+
+class BitWriter(object):
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, nbits):
+        """
+        Append the low nbits of value
+        """
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.out.append((self.acc >> self.nbits) & 0xff)
+        self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        """
+        The bits written so far, padded with zeros to a whole byte
+        """
+        out = bytearray(self.out)
+        if self.nbits:
+            out.append((self.acc << (8 - self.nbits)) & 0xff)
+        return str(out)
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.acc = 0
+        self.nbits = 0
+
+    def read(self, nbits):
+        while self.nbits < nbits:
+            if self.pos >= len(self.data):
+                raise IOError('gorilla block is truncated')
+            self.acc = (self.acc << 8) | self.data[self.pos]
+            self.pos += 1
+            self.nbits += 8
+        self.nbits -= nbits
+        value = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        return value
+
+    def read_signed(self, nbits):
+        value = self.read(nbits)
+        if value >= 1 << (nbits - 1):
+            value -= 1 << nbits
+        return value
+
+################################################################################
+
+def float_bits(value):
+    return struct.unpack('<Q', struct.pack('<d', value))[0]
+
+
+def bits_float(bits):
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
+
+################################################################################
+
+class Encoder(object):
+    """
+    Encode (date, value) points one at a time. Dates are integers (e.g.
+    microseconds since the epoch) spaced by multiples of unit, values
+    floats
+    """
+
+    def __init__(self, unit=1):
+        self.unit = unit
+        self.bits = BitWriter()
+        self.count = 0
+        self.previous_date = None
+        self.previous_delta = 0
+        self.previous_value = None
+        self.leading = None
+        self.trailing = None
+
+    def append(self, date, value):
+        self.append_bits(date, float_bits(value))
+
+    def append_bits(self, date, value_bits):
+        """
+        Append a point whose value is given as the 64 bits of the float
+        """
+        if self.count == 0:
+            self.bits.write(date, 64)
+            self.bits.write(value_bits, 64)
+        else:
+            self.write_date(date)
+            self.write_value(value_bits)
+        self.previous_date = date
+        self.previous_value = value_bits
+        self.count += 1
+
+    def write_date(self, date):
+        delta, remainder = divmod(date - self.previous_date, self.unit)
+        if remainder:
+            raise ValueError('Date {0} is not a whole number of units of {1} '
+                             'from the previous date'.format(date, self.unit))
+        dod = delta - self.previous_delta
+        self.previous_delta = delta
+
+        if dod == 0:
+            self.bits.write(0, 1)
+            return
+        for prefix, prefix_length, length in DELTA_BUCKETS:
+            if -(1 << (length - 1)) <= dod < 1 << (length - 1):
+                self.bits.write(prefix, prefix_length)
+                self.bits.write(dod, length)
+                return
+        raise ValueError('Date gap too large to encode: {0}'.format(dod))
+
+    def write_value(self, value_bits):
+        xor = value_bits ^ self.previous_value
+        if xor == 0:
+            self.bits.write(0, 1)
+            return
+
+        leading = min(64 - xor.bit_length(), MAX_LEADING_ZEROS)
+        trailing = (xor & -xor).bit_length() - 1
+        if (self.leading is not None and leading >= self.leading and
+                trailing >= self.trailing):
+            # Fits the window of the previous value
+            self.bits.write(0b10, 2)
+            self.bits.write(xor >> self.trailing,
+                            64 - self.leading - self.trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            self.bits.write(0b11, 2)
+            self.bits.write(leading, 5)
+            # A length of 64 is written as 0, which can't otherwise occur
+            self.bits.write(meaningful, 6)
+            self.bits.write(xor >> trailing, meaningful)
+            self.leading = leading
+            self.trailing = trailing
+
+    def getvalue(self):
+        return self.bits.getvalue()
+
+################################################################################
+
+def decode(data, count, unit=1):
+    """
+    Generator of the (date, value bits) points of an encoded block
+    """
+    if count == 0:
+        return
+    bits = BitReader(data)
+    date = bits.read_signed(64)
+    value = bits.read(64)
+    yield date, value
+
+    delta = 0
+    leading = trailing = 0
+    for _ in xrange(count - 1):
+        if bits.read(1):
+            # Each further 1 bit moves on to the next bucket
+            for _, _, length in DELTA_BUCKETS[:-1]:
+                if not bits.read(1):
+                    break
+            else:
+                length = DELTA_BUCKETS[-1][2]
+            delta += bits.read_signed(length)
+        date += delta * unit
+
+        if bits.read(1):
+            if bits.read(1):
+                leading = bits.read(5)
+                meaningful = bits.read(6) or 64
+                trailing = 64 - leading - meaningful
+            value ^= bits.read(64 - leading - trailing) << trailing
+        yield date, value
+
+################################################################################
+
+def time_unit(dates):
+    """
+    Greatest common divisor of the gaps between the dates, 1 if there are
+    none
+    """
+    if len(dates) < 2:
+        return 1
+    unit = int(numpy.gcd.reduce(numpy.abs(numpy.diff(dates))))
+    return unit or 1
+
+################################################################################
+
+def decimal_places(values):
+    """
+    The fewest decimal places, up to MAX_DECIMAL_PLACES, that the values
+    round trip through exactly when scaled to whole numbers, or None.
+    NaNs and infinities are unchanged by the scaling, so are left out
+    """
+    values = values[numpy.isfinite(values)]
+    for places in range(MAX_DECIMAL_PLACES + 1):
+        scale = 10.0 ** places
+        scaled = numpy.round(values * scale)
+        if (numpy.abs(scaled) < 2 ** 53).all() and (scaled / scale ==
+                                                    values).all():
+            return places
+    return None
+
+################################################################################
+
+def encode_series(ts):
+    """
+    Return (time unit, decimal places, encoded block) for a TimeSeries of
+    floats. Decimal places is None if the values weren't scaled
+    """
+    if ts.values.ndim != 1:
+        raise ValueError('gorilla files only store single column series')
+    dates = ts.dates.astype(timeseries.DATE_DTYPE).view(numpy.int64)
+    unit = time_unit(dates)
+    values = numpy.asarray(ts.values, dtype=numpy.float64)
+    places = decimal_places(values)
+    if places is not None:
+        values = numpy.round(values * 10.0 ** places)
+    values = numpy.ascontiguousarray(values)
+
+    encoder = Encoder(unit)
+    for date, value_bits in zip(dates.tolist(),
+                                values.view(numpy.uint64).tolist()):
+        encoder.append_bits(date, value_bits)
+    return unit, places, encoder.getvalue()
+
+
+def decode_series(data, count, unit, places):
+    dates = numpy.empty(count, dtype=numpy.int64)
+    values = numpy.empty(count, dtype=numpy.uint64)
+    for i, (date, value_bits) in enumerate(decode(data, count, unit)):
+        dates[i] = date
+        values[i] = value_bits
+    values = values.view(numpy.float64)
+    if places is not None:
+        values = values / 10.0 ** places
+    return timeseries.TimeSeries(dates.view(timeseries.DATE_DTYPE), values)
+
+################################################################################
+
+def dump(obj, filename):
+    """
+    Write obj (a TimeSeries, a list of (date, value) tuples or a list of
+    time series records) to filename
+    """
+    header, series = npyfile.split(obj)
+    blocks = []
+    layout = []
+    for s in series:
+        unit, places, block = encode_series(s)
+        blocks.append(block)
+        layout.append((len(s), unit, places, len(block)))
+    header['blocks'] = layout
+    pickled_header = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack(LENGTH_FORMAT, len(pickled_header)))
+        f.write(pickled_header)
+        for block in blocks:
+            f.write(block)
+
+################################################################################
+
+def load(filename):
+    """
+    Load the object stored in filename
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise IOError('Not a gorilla time series file: bad magic '
+                          '{0!r}'.format(magic))
+        length, = struct.unpack(LENGTH_FORMAT,
+                                f.read(struct.calcsize(LENGTH_FORMAT)))
+        header = pickle.loads(f.read(length))
+        series = [decode_series(f.read(nbytes), count, unit, places)
+                  for count, unit, places, nbytes in header['blocks']]
+
+    if header['kind'] == npyfile.RECORDS:
+        records = []
+        for metadata, ts in zip(header['records'], series):
+            record = dict(metadata)
+            record[data_structure.TIMESERIES] = ts
+            records.append(record)
+        return records
+    return series[0]
+
+################################################################################
@@ -115,17 +115,18 @@ class InfoPanel():
         return sizer
 
     def update(self, data, _):
-        ts = sorted(zip(data['dates'], data['values']))
-        self.current.SetLabel('{0}'.format(ts[-1][1]))
+        stats = timeseries.summary(
+            timeseries.TimeSeries(data['dates'], data['values']))
+        self.current.SetLabel('{0}'.format(stats['current']))
 
-        min = timeseries.min(ts)[0]
-        self.min_val.SetLabel('{0} ({1})'.format(min[1], min[0].strftime('%Y-%m-%d')))
-        max = timeseries.max(ts)[0]
-        self.max_val.SetLabel('{0} ({1})'.format(max[1], max[0].strftime('%Y-%m-%d')))
+        self.min_val.SetLabel('{0} ({1})'.format(
+            stats['min'], stats['min_date'].strftime('%Y-%m-%d')))
+        self.max_val.SetLabel('{0} ({1})'.format(
+            stats['max'], stats['max_date'].strftime('%Y-%m-%d')))
 
-        self.ave.SetLabel('{0:.2f}'.format(timeseries.mean(ts)[0][1]))
-        self.sd.SetLabel('{0:.2f}'.format(timeseries.sd(ts)[0][1]))
-        self.zscore.SetLabel('{0:.2f}'.format(timeseries.zscore(ts)[0][1]))
+        self.ave.SetLabel('{0:.2f}'.format(stats['mean']))
+        self.sd.SetLabel('{0:.2f}'.format(stats['sd']))
+        self.zscore.SetLabel('{0:.2f}'.format(stats['zscore']))
 
 ################################################################################
 
@@ -214,8 +215,8 @@ def get_data(date, symbol):
     loader = 'download_yahoo_timeseries'
 
     ts = data_retrieval.get_time_series(loader, args)
-    dates, values = zip(*ts[0][data_structure.TIMESERIES])
-    return dict(dates=dates, values=[float(v) for v in values])
+    series = ts[0][data_structure.TIMESERIES].dropna()
+    return dict(dates=series.dates.astype(object), values=series.values)
 
 ################################################################################
 
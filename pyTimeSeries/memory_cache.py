@@ -0,0 +1,152 @@
+"""
+In-process memory tier for the time series cache
+
+A size bounded LRU map from cache id to the deserialised series, so
+repeated reads of the same series within a process cost a dictionary
+lookup instead of a trip to disk or the db.
+
+Callers can't change what's cached through what they put or get: the
+cache keeps its own copy of the lists and dicts of a value, and hands
+out a fresh copy of them on each get. The (date, value) tuples of a
+series aren't copied, as they can't be changed, so a get costs the
+number of records rather than points. The arrays of TimeSeries aren't
+copied on get either but are read only, so changing them in place
+raises an error.
+"""
+import collections
+import sys
+import threading
+
+import config
+from pyTimeSeries import timeseries
+
+################################################################################
+
+def size_of(obj):
+    """
+    Rough estimate in bytes of the memory held by obj, counting the arrays
+    of TimeSeries objects and recursing into containers
+    """
+    if timeseries.is_columnar(obj):
+        return sys.getsizeof(obj) + obj.dates.nbytes + obj.values.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(size_of(k) + size_of(v) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(size_of(el) for el in obj)
+    return size
+
+################################################################################
+
+def read_only(array):
+    """
+    A read only version of array: the array itself if it already is, or
+    a read only copy
+    """
+    if array.flags.writeable:
+        array = array.copy()
+        array.setflags(write=False)
+    return array
+
+
+def copy_value(obj, array=lambda a: a):
+    """
+    Copy the lists and dicts of obj, down to the TimeSeries, whose arrays
+    are replaced by array(a). Anything else (tuples, dates, numbers,
+    strings) is shared, and a list of tuples, a series of (date, value)
+    points, is copied without looking at them
+    """
+    if timeseries.is_columnar(obj):
+        return timeseries.TimeSeries(array(obj.dates), array(obj.values))
+    if isinstance(obj, dict):
+        return dict((k, copy_value(v, array)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        if obj and isinstance(obj[0], tuple):
+            return list(obj)
+        return [copy_value(el, array) for el in obj]
+    return obj
+
+################################################################################
+
+class LRUCache(object):
+    """
+    Least recently used cache with a budget in bytes. If max_bytes is None
+    the budget is read from config.MEMORY_CACHE_BYTES on each insert
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def budget(self):
+        if self.max_bytes is None:
+            return config.MEMORY_CACHE_BYTES
+        return self.max_bytes
+
+    def get(self, key):
+        """
+        Return a copy of the value for key, or None if it isn't cached
+        """
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = (value, size)
+            self.hits += 1
+        return copy_value(value)
+
+    def put(self, key, value):
+        """
+        Cache value under key, evicting the least recently used entries to
+        stay within the budget. Values larger than the whole budget are
+        not cached
+        """
+        size = size_of(value)
+        budget = self.budget()
+        if size > budget:
+            self.invalidate(key)
+            return
+        value = copy_value(value, read_only)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > budget:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def remove(self, key):
+        # Callers hold the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+################################################################################
@@ -0,0 +1,225 @@
+"""
+Negative cache: loader misses remembered for a while
+
+When a loader has nothing for a series, get_time_series records it here
+with a reason code and the dates requested, and doesn't call the loader
+again for those dates, or any within them, until the entry expires. A
+request without a start or end date is unbounded on that side, so a miss
+for the whole series covers every range of it. The reason codes are:
+
+    empty   - the loader returned an empty result, e.g. a field that
+              bloomberg doesn't have for an equity
+    failed  - the loader returned None, e.g. the bloomberg session
+              couldn't be started
+
+Entries are appended to a journal file in the cache folder as length
+prefixed pickles (see spickle), so recording a miss is one small write
+and processes sharing the cache folder see each other's entries: each
+reads what's been appended since it last looked. A record cut short at
+the end (from a crash, or a write in progress) is read once it's whole.
+
+A new entry for an id replaces the entries of its dates or within them,
+and those expired when it's written. compact rewrites the journal with
+the entries that haven't expired, which is done on a put once the journal
+has more records than COMPACT_THRESHOLD and than there are entries, so
+the journal stays in proportion to the misses remembered. An entry
+appended by another process while it's rewritten may be lost, which costs
+one more loader call.
+"""
+import os
+import time
+import threading
+import cPickle as pickle
+
+from pyTimeSeries import spickle
+
+################################################################################
+
+JOURNAL_FILENAME = 'negative.journal'
+COMPACT_THRESHOLD = 1000
+
+EMPTY = 'empty'
+FAILED = 'failed'
+
+################################################################################
+
+def reason(result):
+    """
+    Reason code of a loader result that has nothing in it
+    """
+    return FAILED if result is None else EMPTY
+
+def covers(entry, start, end):
+    """
+    True if the dates from start to end are within those of the entry,
+    None standing for no bound
+    """
+    # Entries from before misses had dates cover the whole series
+    entry_start, entry_end = entry.get('start'), entry.get('end')
+    return ((entry_start is None or
+             (start is not None and entry_start <= start)) and
+            (entry_end is None or (end is not None and end <= entry_end)))
+
+################################################################################
+
+class NegativeCache(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        # Number of entries, over every id and interval
+        self.count = 0
+        # Identity of the journal file, how much of it has been read and
+        # the number of records in that
+        self.inode = None
+        self.offset = 0
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Read the records appended to the journal since the last call
+        """
+        # Callers hold the lock
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            self.reset(None)
+            return
+
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # Compacted or cleared since
+            self.reset(stat.st_ino)
+        if stat.st_size == self.offset:
+            return
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            while True:
+                try:
+                    record, found = spickle.s_load_elt_v2(f)
+                except (IOError, EOFError, pickle.UnpicklingError):
+                    break
+                if not found:
+                    break
+                self.apply(record)
+                self.offset = f.tell()
+                self.length += 1
+
+    def reset(self, inode):
+        # Callers hold the lock
+        self.entries = {}
+        self.count = 0
+        self.inode = inode
+        self.offset = 0
+        self.length = 0
+
+    def apply(self, record):
+        # entries holds the list of entries of each id, one per interval.
+        # A new entry replaces those within its dates, and those expired
+        # when it's written
+        id, entry = record
+        entries = self.entries.pop(id, [])
+        self.count -= len(entries)
+        if entry is not None:
+            entries = [e for e in entries
+                       if e['expires'] > entry['written'] and
+                       not covers(entry, e.get('start'), e.get('end'))]
+            entries.append(entry)
+            self.entries[id] = entries
+            self.count += len(entries)
+
+    def record(self, record):
+        # Callers hold the lock. The record is applied as it's read back,
+        # after any appended by other processes meanwhile
+        with open(self.filename, 'ab') as f:
+            spickle.s_dump_elt_v2(record, f)
+        self.refresh()
+        if self.length > max(COMPACT_THRESHOLD, self.count):
+            self.rewrite()
+
+    def get(self, id, start=None, end=None, now=None):
+        """
+        Return the entry of id covering the dates from start to end, a
+        dictionary of its loader, reason code, dates, and written and
+        expiry times, or None if it has none that's current
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.refresh()
+            entries = self.entries.get(id, [])
+        for entry in entries:
+            if entry['expires'] > now and covers(entry, start, end):
+                return entry
+        return None
+
+    def put(self, id, loader, reason, ttl, start=None, end=None, now=None):
+        """
+        Remember that loader has nothing for id from start to end, for
+        ttl seconds
+        """
+        if now is None:
+            now = time.time()
+        entry = {
+            'loader': loader,
+            'reason': reason,
+            'start': start,
+            'end': end,
+            'written': now,
+            'expires': now + ttl
+        }
+        with self.lock:
+            self.record((id, entry))
+
+    def remove(self, *ids):
+        """
+        Forget the entries of the ids, for every interval
+        """
+        with self.lock:
+            self.refresh()
+            for id in ids:
+                if id in self.entries:
+                    self.record((id, None))
+
+    def items(self, now=None):
+        """
+        List of the (id, entry) pairs that haven't expired
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.refresh()
+            return [(id, entry) for id, entries in self.entries.iteritems()
+                    for entry in entries if entry['expires'] > now]
+
+    def compact(self, now=None):
+        """
+        Rewrite the journal with the entries that haven't expired
+        """
+        with self.lock:
+            self.refresh()
+            self.rewrite(now)
+
+    def rewrite(self, now=None):
+        # Callers hold the lock, and have refreshed
+        if now is None:
+            now = time.time()
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            for id, entries in self.entries.iteritems():
+                for entry in entries:
+                    if entry['expires'] > now:
+                        spickle.s_dump_elt_v2((id, entry), f)
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp_filename, self.filename)
+        self.refresh()
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            self.refresh()
+
+################################################################################
@@ -0,0 +1,160 @@
+"""
+Columnar binary file format for cached time series
+
+The files have the extension '.tsn' in the cache: they aren't numpy .npy
+files, which hold a single array and can't be read by numpy.load.
+
+The file is a short header followed by fixed width arrays:
+
+    magic       8 bytes, 'PTSNPY01'
+    length      8 bytes, little endian length of the header
+    header      pickled dictionary describing the contents
+    arrays      for each series, int64 dates (microseconds since the
+                epoch) then float64 values, each 8 byte aligned
+
+Loading reads the header only and memory maps the arrays, so opening a
+long series is near instant and costs no heap until the values are used.
+
+The header records the kind of object stored:
+    series  - a single TimeSeries
+    records - a list of time series records (see data_structure), where
+              every key but the time series itself is kept in the header
+"""
+import struct
+import cPickle as pickle
+
+import numpy
+
+import data_structure
+from pyTimeSeries import timeseries
+
+################################################################################
+
+MAGIC = 'PTSNPY01'
+LENGTH_FORMAT = '<Q'
+ALIGNMENT = 8
+
+SERIES = 'series'
+RECORDS = 'records'
+
+DATES_DTYPE = numpy.dtype('<i8')
+VALUES_DTYPE = numpy.dtype('<f8')
+
+################################################################################
+
+def to_columnar(ts):
+    """
+    Convert a record's series to a TimeSeries, failing if it isn't numeric
+    """
+    try:
+        return timeseries.as_columnar(ts)
+    except (TypeError, ValueError) as e:
+        raise ValueError('npy files only store numeric time series: ' + str(e))
+
+
+def split(obj):
+    """
+    Return the header contents and the list of TimeSeries to store for obj
+    """
+    if timeseries.is_columnar(obj):
+        return {'kind': SERIES}, [obj]
+
+    if all(data_structure.is_time_series_record(r) for r in obj):
+        metadata = []
+        series = []
+        for record in obj:
+            metadata.append(dict((k, v) for k, v in record.iteritems()
+                                 if k != data_structure.TIMESERIES))
+            series.append(to_columnar(record[data_structure.TIMESERIES]))
+        return {'kind': RECORDS, 'records': metadata}, series
+
+    return {'kind': SERIES}, [to_columnar(obj)]
+
+################################################################################
+
+def aligned(offset):
+    return offset + (-offset % ALIGNMENT)
+
+
+def data_start(header_length):
+    return aligned(len(MAGIC) + struct.calcsize(LENGTH_FORMAT) + header_length)
+
+
+def dump(obj, filename):
+    """
+    Write obj (a TimeSeries, a list of (date, value) tuples or a list of
+    time series records) to filename
+    """
+    header, series = split(obj)
+
+    # Array offsets are relative to the aligned end of the header
+    offset = 0
+    layout = []
+    for s in series:
+        layout.append((offset, len(s), s.values.shape[1:]))
+        offset = aligned(offset + s.dates.nbytes)
+        offset = aligned(offset + s.values.nbytes)
+    header['arrays'] = layout
+    pickled_header = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+    start = data_start(len(pickled_header))
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack(LENGTH_FORMAT, len(pickled_header)))
+        f.write(pickled_header)
+        for s, (offset, _, _) in zip(series, layout):
+            f.seek(start + offset)
+            f.write(s.dates.astype(timeseries.DATE_DTYPE)
+                    .view(numpy.int64).astype(DATES_DTYPE).tobytes())
+            f.seek(start + aligned(offset + s.dates.nbytes))
+            f.write(numpy.ascontiguousarray(s.values, dtype=VALUES_DTYPE)
+                    .tobytes())
+
+################################################################################
+
+def read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise IOError('Not an npy time series file: bad magic {0!r}'.format(
+            magic))
+    length, = struct.unpack(LENGTH_FORMAT,
+                            f.read(struct.calcsize(LENGTH_FORMAT)))
+    return pickle.loads(f.read(length))
+
+
+def map_array(filename, dtype, offset, shape):
+    if numpy.prod(shape) == 0:
+        return numpy.empty(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                        shape=shape)
+
+
+def load(filename):
+    """
+    Load the object stored in filename. The time series arrays are read
+    only memory maps of the file
+    """
+    with open(filename, 'rb') as f:
+        header = read_header(f)
+        start = data_start(f.tell() - len(MAGIC) -
+                           struct.calcsize(LENGTH_FORMAT))
+
+    series = []
+    for offset, count, shape in header['arrays']:
+        dates = map_array(filename, DATES_DTYPE, start + offset, (count,))
+        values = map_array(filename, VALUES_DTYPE,
+                           start + aligned(offset + dates.nbytes),
+                           (count,) + shape)
+        series.append(timeseries.TimeSeries(
+            dates.view(timeseries.DATE_DTYPE), values))
+
+    if header['kind'] == RECORDS:
+        records = []
+        for metadata, ts in zip(header['records'], series):
+            record = dict(metadata)
+            record[data_structure.TIMESERIES] = ts
+            records.append(record)
+        return records
+    return series[0]
+
+################################################################################
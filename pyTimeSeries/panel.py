@@ -0,0 +1,153 @@
+"""
+Panels of time series: several series aligned onto one date index
+
+A panel is a TimeSeries whose values are a 2 dimensional array of
+dates x series, with NaN where a series has no value on a date.
+"""
+import numpy
+
+from pyTimeSeries import timeseries
+
+################################################################################
+
+INNER = 'inner'
+OUTER = 'outer'
+ASOF = 'asof'
+
+################################################################################
+
+def sorted_columnar(ts):
+    """
+    Return ts as a TimeSeries in ascending date order. Series that are
+    already sorted are returned as they are, without a copy
+    """
+    return timeseries.as_columnar(ts).sorted()
+
+################################################################################
+
+def contains(sorted_dates, dates):
+    """
+    Boolean mask of the dates that appear in the sorted_dates array
+    """
+    if len(sorted_dates) == 0:
+        return numpy.zeros(len(dates), dtype=bool)
+    idx = numpy.searchsorted(sorted_dates, dates)
+    idx[idx == len(sorted_dates)] = 0
+    return sorted_dates[idx] == dates
+
+
+def union_dates(series):
+    dates = numpy.concatenate([s.dates for s in series])
+    return numpy.unique(dates)
+
+
+def intersect_dates(series):
+    dates = series[0].dates
+    for s in series[1:]:
+        dates = dates[contains(s.dates, dates)]
+    return numpy.unique(dates)
+
+################################################################################
+
+def align(series, how=INNER):
+    """
+    Align a list of time series (lists of tuples or TimeSeries, each with
+    unique dates) onto a common date index and return a panel with one
+    column per input series, in input order.
+        inner - only the dates present in every series
+        outer - every date present in any series, NaN where missing
+        asof - every date present in any series, each series taking its
+               latest value on or before that date (NaN before its start)
+
+    Each series is located with a binary search of its sorted dates, so
+    there is no per point python work.
+    """
+    if len(series) == 0:
+        raise ValueError('Cannot align an empty list of series')
+
+    series = [sorted_columnar(s) for s in series]
+
+    if how == INNER:
+        dates = intersect_dates(series)
+    elif how in (OUTER, ASOF):
+        dates = union_dates(series)
+    else:
+        raise ValueError('Unrecognised join "{0}" in align. Use "{1}", "{2}" '
+                         'or "{3}"'.format(how, INNER, OUTER, ASOF))
+
+    values = numpy.empty((len(dates), len(series)), dtype=timeseries.VALUE_DTYPE)
+    values.fill(numpy.nan)
+    for col, s in enumerate(series):
+        if len(s) == 0:
+            continue
+        if how == ASOF:
+            idx = numpy.searchsorted(s.dates, dates, side='right') - 1
+            found = idx >= 0
+        else:
+            idx = numpy.searchsorted(s.dates, dates)
+            idx[idx == len(s)] = 0
+            found = s.dates[idx] == dates
+        values[found, col] = s.values[idx[found]]
+
+    return timeseries.TimeSeries(dates, values)
+
+################################################################################
+
+def forward_fill(values):
+    """
+    Replace each NaN with the latest valid value above it in its column.
+    NaNs before the first valid value are left as they are
+    """
+    n = len(values)
+    rows = numpy.arange(n).reshape((n,) + (1,) * (values.ndim - 1))
+    idx = numpy.where(numpy.isnan(values), -1, rows)
+    idx = numpy.maximum.accumulate(idx, axis=0)
+    filled = numpy.take_along_axis(values, numpy.maximum(idx, 0), axis=0)
+    filled[idx < 0] = numpy.nan
+    return filled
+
+################################################################################
+
+def price_ratios(p, horizon, fill_gaps):
+    if horizon < 1:
+        raise ValueError('Return horizon must be at least 1, got {0}'.format(
+            horizon))
+    p = timeseries.as_columnar(p)
+    values = forward_fill(p.values) if fill_gaps else p.values
+    base = values[:-horizon] if horizon < len(p) else values[:0]
+    return p.dates[horizon:], p.values[horizon:] / base
+
+################################################################################
+
+def returns(p, horizon=1, fill_gaps=False):
+    """
+    Simple returns Series(t)/Series(t - horizon) - 1 over every column of
+    a panel (or a single TimeSeries) at once.
+    A NaN at either end gives a NaN return. With fill_gaps, a missing
+    value at t - horizon is replaced by the latest valid value before it,
+    so the first point after a gap still gets a return
+    """
+    dates, ratios = price_ratios(p, horizon, fill_gaps)
+    return timeseries.TimeSeries(dates, ratios - 1.0)
+
+################################################################################
+
+def log_returns(p, horizon=1, fill_gaps=False):
+    """
+    Log returns log[Series(t)/Series(t - horizon)] over every column of a
+    panel at once. NaNs are handled as in returns
+    """
+    dates, ratios = price_ratios(p, horizon, fill_gaps)
+    return timeseries.TimeSeries(dates, numpy.log(ratios))
+
+################################################################################
+
+def multi_horizon_returns(p, horizons=(1, 5, 21), log=False, fill_gaps=False):
+    """
+    Returns over several horizons (in points, e.g. 1, 5 and 21 days) for
+    every column of a panel. Returns a dictionary of horizon to panel
+    """
+    f = log_returns if log else returns
+    return dict((h, f(p, h, fill_gaps)) for h in horizons)
+
+################################################################################
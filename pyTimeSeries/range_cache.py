@@ -0,0 +1,163 @@
+"""
+Date coverage bookkeeping for the incremental cache
+
+A cached series is stored once per series identity (loader and arguments
+other than the date range) along with the list of date intervals it has
+been fetched for. A request then only needs the parts of its range that
+no interval covers, and the fetched points are merged into the stored
+series. Loaders return either a list of time series records or a bare
+series (a TimeSeries, or a list of (date, value) tuples like the
+bloomberg loaders), see merge_results.
+
+Intervals are inclusive (start, end) pairs, like the loaders' start and
+end arguments, at a resolution of one day. Dates from today on are never
+covered, as their points may not be published yet, so they're fetched
+again until they're in the past (see covered_interval).
+"""
+import datetime
+
+import numpy
+
+import data_structure
+from pyTimeSeries import timeseries
+
+################################################################################
+
+RESOLUTION = datetime.timedelta(days=1)
+
+################################################################################
+
+def merge_intervals(intervals):
+    """
+    Sort a list of (start, end) intervals and join any that overlap or
+    are adjacent
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + RESOLUTION:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+################################################################################
+
+def add_interval(coverage, start, end):
+    """
+    Return the coverage with the interval from start to end added
+    """
+    return merge_intervals(list(coverage) + [(start, end)])
+
+################################################################################
+
+def covered_interval(start, end, now=None):
+    """
+    The part of a fetched interval from start to end to add to the
+    coverage: the dates before today, whether the loader had points for
+    them or not (e.g. a weekend). None if it's all today or later
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    end = min(end, datetime.datetime(now.year, now.month, now.day) -
+              RESOLUTION)
+    if end < start:
+        return None
+    return start, end
+
+################################################################################
+
+def missing_intervals(coverage, start, end):
+    """
+    List of the (start, end) intervals between start and end that the
+    coverage doesn't include
+    """
+    missing = []
+    for covered_start, covered_end in merge_intervals(coverage):
+        if covered_end < start:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > start:
+            missing.append((start, covered_start - RESOLUTION))
+        start = covered_end + RESOLUTION
+        if start > end:
+            return missing
+    missing.append((start, end))
+    return missing
+
+################################################################################
+
+def merge_series(old, new):
+    """
+    Merge two time series into one in ascending date order. Where both
+    have a value for a date, the one from new is kept
+    """
+    if timeseries.is_columnar(old) or timeseries.is_columnar(new):
+        old = timeseries.as_columnar(old)
+        new = timeseries.as_columnar(new)
+        if len(old) == 0:
+            return new.sorted()
+        if len(new) == 0:
+            return old.sorted()
+        dates = numpy.concatenate((new.dates, old.dates))
+        values = numpy.concatenate((new.values, old.values))
+        # The stable sort keeps the point from new first among equal dates
+        order = numpy.argsort(dates, kind='mergesort')
+        dates = dates[order]
+        keep = numpy.concatenate(([True], dates[1:] != dates[:-1]))
+        return timeseries.TimeSeries(dates[keep], values[order][keep])
+
+    merged = dict(old)
+    merged.update(new)
+    return sorted(merged.iteritems())
+
+################################################################################
+
+def is_series(obj):
+    """
+    True for a bare series, a TimeSeries or a list of (date, value)
+    tuples as the bloomberg loaders return, rather than a list of records
+    """
+    return timeseries.is_columnar(obj) or data_structure.is_point_list(obj)
+
+################################################################################
+
+def record_count(obj):
+    """
+    Number of records in a loader result, 1 for a bare series
+    """
+    return 1 if is_series(obj) else len(obj)
+
+################################################################################
+
+def merge_results(stored, fetched):
+    """
+    Merge a freshly fetched loader result into the stored one: a bare
+    series point by point (see merge_series), a list of records record by
+    record (see merge_records)
+    """
+    if is_series(stored) and is_series(fetched):
+        return merge_series(stored, fetched)
+    return merge_records(stored, fetched)
+
+################################################################################
+
+def merge_records(stored, fetched):
+    """
+    Merge freshly fetched time series records into the stored ones, record
+    by record. The metadata of the fetched records is kept
+    """
+    if len(stored) != len(fetched):
+        raise ValueError('Cannot merge {0} fetched records into {1} stored '
+                         'records'.format(len(fetched), len(stored)))
+
+    merged = []
+    for old, new in zip(stored, fetched):
+        record = dict(new)
+        record[data_structure.TIMESERIES] = merge_series(
+            old[data_structure.TIMESERIES], new[data_structure.TIMESERIES])
+        merged.append(record)
+    return merged
+
+################################################################################
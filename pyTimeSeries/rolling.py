@@ -0,0 +1,229 @@
+"""
+Rolling window versions of the timeseries statistics
+
+Each function takes a time series (list of tuples or TimeSeries) and a
+window length and returns a time series of the same form, with one point
+per full window dated at the last point of that window. All functions
+run in a single pass, O(n) regardless of the window length.
+"""
+import __builtin__
+import collections
+
+import numpy
+
+from pyTimeSeries import timeseries
+
+################################################################################
+
+def check_window(window):
+    if window < 1:
+        raise ValueError('Window length must be at least 1, got {0}'.format(
+            window))
+
+################################################################################
+
+def blocks(values, window, fill):
+    """
+    The values padded with fill to a whole number of blocks of window
+    points, as a blocks x window array (x columns for a 2 dimensional
+    series)
+    """
+    count = -(-len(values) // window)
+    padded = numpy.empty((count * window,) + values.shape[1:],
+                         dtype=values.dtype)
+    padded[:len(values)] = values
+    padded[len(values):] = fill
+    return padded.reshape((count, window) + values.shape[1:])
+
+
+def running(f, b, reverse=False):
+    """
+    f accumulated along each block of b, from its start or (reversed)
+    back from its end, flattened to one row per point
+    """
+    if reverse:
+        result = f.accumulate(b[:, ::-1], axis=1)[:, ::-1]
+    else:
+        result = f.accumulate(b, axis=1)
+    return result.reshape((-1,) + b.shape[2:])
+
+################################################################################
+
+def window_moments_columnar(values, window):
+    """
+    Return the mean and the sum of squared deviations from the mean of
+    each full window of the values array.
+
+    Each window is the tail of one block of window points and the head of
+    the next, so it is summed from a running sum back through one block
+    and forward through the other: every sum is over at most window
+    points, however long the series. Each block is centred on its first
+    value before summing, and the two parts of a window are combined as
+    for merging accumulators (see accumulators.StatsAccumulator.merge),
+    so the variance doesn't cancel out as the series drifts from its
+    start
+    """
+    count = len(values) - window + 1
+    b = blocks(values, window, 0.0)
+    shift = b[:, :1]
+    centred = b - shift
+    squares = centred * centred
+    shift = numpy.repeat(shift, window, axis=1).reshape(
+        (-1,) + values.shape[1:])
+
+    starts = numpy.arange(count)
+    ends = starts + window - 1
+    # Points of each window in the block it starts in, and in the next
+    n_a = (window - starts % window).astype(numpy.float64).reshape(
+        (count,) + (1,) * (values.ndim - 1))
+    n_b = window - n_a
+    split = n_b > 0
+
+    s_a = running(numpy.add, centred, reverse=True)[starts]
+    q_a = running(numpy.add, squares, reverse=True)[starts]
+    s_b = numpy.where(split, running(numpy.add, centred)[ends], 0.0)
+    q_b = numpy.where(split, running(numpy.add, squares)[ends], 0.0)
+
+    mean_a = shift[starts] + s_a / n_a
+    m2_a = q_a - s_a * s_a / n_a
+    mean_b = shift[ends] + s_b / numpy.maximum(n_b, 1.0)
+    m2_b = q_b - s_b * s_b / numpy.maximum(n_b, 1.0)
+
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / window
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / window
+    return mean, numpy.maximum(m2, 0.0)
+
+
+def window_moments(ts, window):
+    """
+    Generator over (date, value, mean, sd) for each full window of a list
+    of tuples. The mean and sum of squared deviations are updated as
+    points enter and leave the window (Welford's method), and computed
+    afresh from the window every window points so rounding errors don't
+    build up along the series, at O(1) per point
+    """
+    ave = 0.0
+    m2 = 0.0
+    for i in range(window - 1, len(ts)):
+        dte, val = ts[i]
+        if (i + 1) % window == 0:
+            values = [v for _, v in ts[i + 1 - window:i + 1]]
+            ave = sum(values) / float(window)
+            m2 = sum((v - ave) ** 2 for v in values)
+        else:
+            old = ts[i - window][1]
+            previous = ave
+            ave += (val - old) / float(window)
+            m2 += (val - old) * (val - ave + old - previous)
+        yield dte, val, ave, __builtin__.max(m2 / window, 0.0) ** 0.5
+
+################################################################################
+
+def mean(ts, window):
+    """
+    Rolling mean over the trailing window points
+    """
+    check_window(window)
+    if timeseries.is_columnar(ts):
+        if len(ts) < window:
+            return ts[:0]
+        ave, _ = window_moments_columnar(ts.values, window)
+        return timeseries.TimeSeries(ts.dates[window - 1:], ave)
+    return [(dte, ave) for dte, _, ave, _ in window_moments(ts, window)]
+
+################################################################################
+
+def sd(ts, window):
+    """
+    Rolling (population) standard deviation over the trailing window points
+    """
+    check_window(window)
+    if timeseries.is_columnar(ts):
+        if len(ts) < window:
+            return ts[:0]
+        _, m2 = window_moments_columnar(ts.values, window)
+        return timeseries.TimeSeries(ts.dates[window - 1:],
+                                     numpy.sqrt(m2 / window))
+    return [(dte, std) for dte, _, _, std in window_moments(ts, window)]
+
+################################################################################
+
+def zscore(ts, window):
+    """
+    Rolling zscore: the last point of each window measured against the
+    mean and standard deviation of that window
+    """
+    check_window(window)
+    if timeseries.is_columnar(ts):
+        if len(ts) < window:
+            return ts[:0]
+        ave, m2 = window_moments_columnar(ts.values, window)
+        return timeseries.TimeSeries(
+            ts.dates[window - 1:],
+            (ts.values[window - 1:] - ave) / numpy.sqrt(m2 / window))
+    return [(dte, (val - ave) / std)
+            for dte, val, ave, std in window_moments(ts, window)]
+
+################################################################################
+
+def extremes(values, window, better):
+    """
+    Generator over the index of the extreme value in each full window of
+    a list, using a monotonic deque of candidate indices. better(a, b) is
+    true if a should replace b as the extreme
+    """
+    candidates = collections.deque()
+    for i, val in enumerate(values):
+        while candidates and not better(values[candidates[-1]], val):
+            candidates.pop()
+        candidates.append(i)
+        if candidates[0] <= i - window:
+            candidates.popleft()
+        if i >= window - 1:
+            yield candidates[0]
+
+
+def window_extremes(values, window, f, fill):
+    """
+    f (numpy.minimum or numpy.maximum, with identity fill) over each full
+    window of the values array, from a running extreme back through the
+    block of window points each window starts in and forward through the
+    next (van Herk / Gil-Werman), in O(n) vectorised steps
+    """
+    b = blocks(values, window, fill)
+    return f(running(f, b, reverse=True)[:len(values) - window + 1],
+             running(f, b)[window - 1:len(values)])
+
+
+def rolling_extreme(ts, window, better, f, fill):
+    check_window(window)
+    if timeseries.is_columnar(ts):
+        if len(ts) < window:
+            return ts[:0]
+        return timeseries.TimeSeries(ts.dates[window - 1:],
+                                     window_extremes(ts.values, window, f,
+                                                     fill))
+    values = [v for _, v in ts]
+    return [(ts[i + window - 1][0], values[j])
+            for i, j in enumerate(extremes(values, window, better))]
+
+################################################################################
+
+def min(ts, window):
+    """
+    Rolling minimum over the trailing window points
+    """
+    return rolling_extreme(ts, window, lambda a, b: a < b, numpy.minimum,
+                           numpy.inf)
+
+################################################################################
+
+def max(ts, window):
+    """
+    Rolling maximum over the trailing window points
+    """
+    return rolling_extreme(ts, window, lambda a, b: a > b, numpy.maximum,
+                           -numpy.inf)
+
+################################################################################
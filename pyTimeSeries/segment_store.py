@@ -0,0 +1,182 @@
+"""
+Append-only log of new points for cached series
+
+New points for a cached series are appended to a log file next to it
+rather than rewriting the whole file, so an update costs the number of
+new points. Readers merge the log into the series they load, and
+compaction folds the log into the cached file.
+
+The log is a sequence of fixed width little endian records:
+
+    record   uint32, index of the series in the cached list of records,
+             0 for a bare series (a TimeSeries or list of tuples)
+    date     int64, microseconds since the epoch
+    value    float64
+
+Points later in the log replace earlier points on the same date. A record
+cut short at the end of the log (from a crash mid append) is ignored.
+
+To compact, the log is first renamed to a '.compacting' file, so appends
+made meanwhile start a new log and aren't lost. Readers merge both files.
+"""
+import numbers
+import os
+
+import numpy
+
+import data_structure
+from pyTimeSeries import timeseries
+from pyTimeSeries import range_cache
+
+################################################################################
+
+LOG_DTYPE = numpy.dtype([('record', '<u4'), ('date', '<i8'), ('value', '<f8')])
+COMPACTING_SUFFIX = '.compacting'
+
+################################################################################
+
+def can_append(stored, fetched):
+    """
+    True if the fetched result can go in the log of the stored one: both
+    are bare series, or lists of records that line up, and every series is
+    a single column of numbers
+    """
+    if range_cache.is_series(stored) or range_cache.is_series(fetched):
+        return (range_cache.is_series(stored) and
+                range_cache.is_series(fetched) and
+                is_single_column(stored, stored[:1]) and
+                is_single_column(fetched, fetched))
+    if not isinstance(stored, list) or len(stored) != len(fetched):
+        return False
+    for record in stored + fetched:
+        if not data_structure.is_time_series_record(record):
+            return False
+        ts = record[data_structure.TIMESERIES]
+        if not timeseries.is_columnar(ts) or ts.values.ndim != 1:
+            return False
+    return True
+
+
+def is_single_column(ts, points):
+    """
+    True if a bare series is a single column of numbers, judging a list of
+    tuples by the given points of it
+    """
+    if timeseries.is_columnar(ts):
+        return ts.values.ndim == 1
+    return all(len(point) == 2 and isinstance(point[1], numbers.Real)
+               for point in points)
+
+################################################################################
+
+def record_series(obj):
+    """
+    The series of a loader result as TimeSeries, in log record order: a
+    bare series is record 0
+    """
+    if range_cache.is_series(obj):
+        return [timeseries.as_columnar(obj)]
+    return [record[data_structure.TIMESERIES] for record in obj]
+
+################################################################################
+
+def to_log(series):
+    """
+    Log records of a list of TimeSeries, the i-th with record index i
+    """
+    entries = numpy.empty(sum(len(ts) for ts in series), dtype=LOG_DTYPE)
+    i = 0
+    for record, ts in enumerate(series):
+        n = len(ts)
+        entries['record'][i:i + n] = record
+        entries['date'][i:i + n] = ts.dates.astype(
+            timeseries.DATE_DTYPE).view(numpy.int64)
+        entries['value'][i:i + n] = ts.values
+        i += n
+    return entries
+
+################################################################################
+
+def append(filename, series):
+    """
+    Append the points of a list of TimeSeries, lined up with the cached
+    records, to the log
+    """
+    data = to_log(series).tobytes()
+    with open(filename, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+################################################################################
+
+def read(filename):
+    """
+    The log records in filename, or none if there's no such file
+    """
+    if not os.path.exists(filename):
+        return numpy.empty(0, dtype=LOG_DTYPE)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    whole = len(data) - len(data) % LOG_DTYPE.itemsize
+    return numpy.frombuffer(data[:whole], dtype=LOG_DTYPE)
+
+
+def read_all(filename):
+    """
+    The records of the log, including any log being compacted
+    """
+    return numpy.concatenate((read(filename + COMPACTING_SUFFIX),
+                              read(filename)))
+
+################################################################################
+
+def log_series(entries, record):
+    """
+    The TimeSeries of one record in the log, in date order, keeping the
+    latest point for each date
+    """
+    entries = entries[entries['record'] == record][::-1]
+    # The first of each date in the reversed log is the latest appended
+    dates, first = numpy.unique(entries['date'], return_index=True)
+    return timeseries.TimeSeries(dates.view(timeseries.DATE_DTYPE),
+                                 entries['value'][first])
+
+################################################################################
+
+def merge(stored, entries):
+    """
+    Merge the log records into the stored records (or a bare series,
+    which is record 0, returned in the form it was stored in)
+    """
+    if len(entries) == 0:
+        return stored
+    if range_cache.is_series(stored):
+        merged = range_cache.merge_series(stored, log_series(entries, 0))
+        if timeseries.is_columnar(stored):
+            return merged
+        return merged.to_tuples()
+
+    merged = []
+    records = set(entries['record'].tolist())
+    for i, record in enumerate(stored):
+        if i in records:
+            record = dict(record)
+            record[data_structure.TIMESERIES] = range_cache.merge_series(
+                record[data_structure.TIMESERIES], log_series(entries, i))
+        merged.append(record)
+    return merged
+
+################################################################################
+
+def start_compaction(filename):
+    """
+    Move the log aside for compaction, unless a previous compaction was
+    interrupted, and return the name of the log to compact
+    """
+    compacting = filename + COMPACTING_SUFFIX
+    if not os.path.exists(compacting) and os.path.exists(filename):
+        os.rename(filename, compacting)
+    return compacting
+
+################################################################################
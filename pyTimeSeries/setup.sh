@@ -1,5 +1,5 @@
 #!/bin/bash
 
-sudo apt-get install python-pip python-matplotlib python-wxgtk2.8 mongodb build-essential python-dev
+sudo apt-get install python-pip python-numpy python-matplotlib python-wxgtk2.8 mongodb build-essential python-dev
 
 sudo pip install pymongo
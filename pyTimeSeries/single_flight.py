@@ -0,0 +1,120 @@
+"""
+Coalescing of concurrent identical fetches
+
+SingleFlight makes one call at a time per key in a process: a thread
+asking for a key that's already being fetched waits for that fetch
+instead of making its own, and gets its result if it asked for the same
+thing.
+
+FileLock extends this across processes with an advisory lock on a file
+(fcntl on posix, msvcrt on windows): the process holding the lock
+fetches, the others wait for it and then find the result in the cache.
+"""
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+################################################################################
+
+class Flight(object):
+    """
+    A call in progress, whose outcome waiting threads share
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, tag, f):
+        """
+        Call f() and return its result, unless a call for key is already
+        in flight. Then wait for it, and return its result (or raise its
+        exception) if it was made with an equal tag, otherwise call f()
+        once it's done
+        """
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                if flight is None:
+                    flight = self.flights[key] = Flight(tag)
+                    break
+            flight.done.wait()
+            if flight.tag == tag:
+                if flight.error is not None:
+                    raise flight.error[0], flight.error[1], flight.error[2]
+                return flight.result
+
+        try:
+            flight.result = f()
+            return flight.result
+        except BaseException:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+################################################################################
+
+class FileLock(object):
+    """
+    Exclusive advisory lock on a file, held across processes. The file is
+    created if needed and left in place, as removing it could let two
+    processes lock different files of the same name
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+    def acquire(self):
+        self.f = open(self.filename, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            while True:
+                # LK_LOCK gives up after 10 seconds of retrying
+                try:
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+
+    def release(self):
+        """
+        Let go of the lock, from any thread
+        """
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            else:
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.f.close()
+            self.f = None
+
+################################################################################
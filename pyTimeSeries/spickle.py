@@ -3,24 +3,55 @@ de-serializing an iterable (e.g., list)
 
 Created on 2010-06-19 by Philip Guo
 
-Limitations:
+Two file formats are supported:
 
-  - Only works with ASCII-based pickles (protocol=0), since s_load reads
-  in one line at a time
+  - v1: ASCII-based pickles (protocol=0) separated by blank lines. s_load
+  reads in one line at a time, so a record that pickles to a blank line
+  (e.g. a string containing one) can't be read back
 
+  - v2 (the default for s_dump): a magic header, then each record as an
+  8 byte little endian length followed by a pickle in the highest
+  protocol. A zero length marks the end of the records, and is followed
+  by a table of record offsets for random access (see s_offsets and
+  s_load_at)
+
+s_load reads both formats, detecting which from the start of the file.
 """
 
+import struct
+
 try:
-    from cPickle import dumps, loads
+    from cPickle import dumps, loads, HIGHEST_PROTOCOL
 except ImportError:
-    from pickle import dumps, loads
+    from pickle import dumps, loads, HIGHEST_PROTOCOL
+
+V2_MAGIC = 'SPICKLE2'
+V2_TRAILER_MAGIC = 'SPKLIDX2'
+LENGTH_FORMAT = '<Q'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
 
 
-def s_dump(iterable_to_pickle, file_obj):
+def s_dump(iterable_to_pickle, file_obj, version=2):
     """dump contents of an iterable iterable_to_pickle to file_obj, a file
   opened in write mode"""
+    if version == 1:
+        for elt in iterable_to_pickle:
+            s_dump_elt(elt, file_obj)
+        return
+
+    file_obj.write(V2_MAGIC)
+    offsets = []
+    position = len(V2_MAGIC)
     for elt in iterable_to_pickle:
-        s_dump_elt(elt, file_obj)
+        offsets.append(position)
+        position += s_dump_elt_v2(elt, file_obj)
+
+    # End of records marker, then the offset table and where to find it
+    file_obj.write(struct.pack(LENGTH_FORMAT, 0))
+    index_position = position + LENGTH_SIZE
+    s_dump_elt_v2(offsets, file_obj)
+    file_obj.write(struct.pack(LENGTH_FORMAT, index_position))
+    file_obj.write(V2_TRAILER_MAGIC)
 
 
 def s_dump_elt(elt_to_pickle, file_obj):
@@ -32,9 +63,26 @@ def s_dump_elt(elt_to_pickle, file_obj):
     file_obj.write('\n\n')
 
 
+def s_dump_elt_v2(elt_to_pickle, file_obj):
+    """dumps one length prefixed element to file_obj, returning the number
+  of bytes written"""
+    pickled_elt_str = dumps(elt_to_pickle, HIGHEST_PROTOCOL)
+    file_obj.write(struct.pack(LENGTH_FORMAT, len(pickled_elt_str)))
+    file_obj.write(pickled_elt_str)
+    return LENGTH_SIZE + len(pickled_elt_str)
+
+
 def s_load(file_obj):
     """load contents from file_obj, returning a generator that yields one
   element at a time"""
+    magic = file_obj.read(len(V2_MAGIC))
+    if magic == V2_MAGIC:
+        return s_load_v2(file_obj)
+    file_obj.seek(0)
+    return s_load_v1(file_obj)
+
+
+def s_load_v1(file_obj):
     cur_elt = []
     for line in file_obj:
         cur_elt.append(line)
@@ -44,3 +92,46 @@ def s_load(file_obj):
             elt = loads(pickled_elt_str)
             cur_elt = []
             yield elt
+
+
+def s_load_v2(file_obj):
+    while True:
+        elt, found = s_load_elt_v2(file_obj)
+        if not found:
+            return
+        yield elt
+
+
+def s_load_elt_v2(file_obj):
+    """read one length prefixed element, returning (element, True), or
+  (None, False) at the end of the records"""
+    length_str = file_obj.read(LENGTH_SIZE)
+    if len(length_str) < LENGTH_SIZE:
+        raise IOError('spickle v2 file is truncated')
+    length, = struct.unpack(LENGTH_FORMAT, length_str)
+    if length == 0:
+        return None, False
+    pickled_elt_str = file_obj.read(length)
+    if len(pickled_elt_str) < length:
+        raise IOError('spickle v2 file is truncated')
+    return loads(pickled_elt_str), True
+
+
+def s_offsets(file_obj):
+    """return the list of record offsets of a v2 file, opened in binary
+  read mode"""
+    file_obj.seek(-(LENGTH_SIZE + len(V2_TRAILER_MAGIC)), 2)
+    index_position_str = file_obj.read(LENGTH_SIZE)
+    if file_obj.read(len(V2_TRAILER_MAGIC)) != V2_TRAILER_MAGIC:
+        raise IOError('no spickle v2 offset table found')
+    index_position, = struct.unpack(LENGTH_FORMAT, index_position_str)
+    file_obj.seek(index_position)
+    offsets, _ = s_load_elt_v2(file_obj)
+    return offsets
+
+
+def s_load_at(file_obj, offset):
+    """load the single record at offset (from s_offsets) of a v2 file"""
+    file_obj.seek(offset)
+    elt, _ = s_load_elt_v2(file_obj)
+    return elt
@@ -0,0 +1,255 @@
+"""
+Embedded SQLite store for cached time series
+
+An alternative to mongo that needs no server. Each cached series is a
+row of the series table, keyed by its cache id, and its points are rows
+of the points table:
+
+    series  id, loader, symbol, field, kind, records, coverage, written
+            records and coverage are pickled: the metadata of each record
+            (everything but its time series, as for npy files) and the
+            date intervals fetched
+    points  id, record, date, value
+            record is the index of the record the point belongs to, date
+            microseconds since the epoch
+
+Points are keyed on (id, record, date), so a date range of a series is
+read with an index range scan, and appending new points costs the
+number of new points. Series are found by (loader, symbol, field) through
+an index on the series table.
+
+The database runs in WAL mode, so readers in other threads and processes
+aren't blocked by a writer. Each thread gets its own connection.
+"""
+import time
+import threading
+import sqlite3
+import cPickle as pickle
+
+import numpy
+
+import data_structure
+from pyTimeSeries import npyfile
+from pyTimeSeries import timeseries
+
+################################################################################
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS series (
+           id TEXT PRIMARY KEY,
+           loader TEXT,
+           symbol TEXT,
+           field TEXT,
+           kind TEXT NOT NULL,
+           records BLOB,
+           coverage BLOB,
+           written REAL NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS series_loader
+           ON series (loader, symbol, field)''',
+    '''CREATE TABLE IF NOT EXISTS points (
+           id TEXT NOT NULL,
+           record INTEGER NOT NULL,
+           date INTEGER NOT NULL,
+           value REAL,
+           PRIMARY KEY (id, record, date)) WITHOUT ROWID'''
+]
+
+# Seconds a connection waits for another writer's lock
+TIMEOUT = 30
+
+POINT_DTYPE = numpy.dtype([('record', numpy.int64), ('date', numpy.int64),
+                           ('value', numpy.float64)])
+
+################################################################################
+
+def to_microseconds(date):
+    return int(numpy.datetime64(date, 'us').astype(numpy.int64))
+
+
+def to_points(id, series):
+    """
+    Generator of the (id, record, date, value) rows of a list of TimeSeries
+    """
+    for record, ts in enumerate(series):
+        if ts.values.ndim != 1:
+            raise ValueError('sqlite only stores single column series')
+        dates = ts.dates.astype(timeseries.DATE_DTYPE).view(numpy.int64)
+        for date, value in zip(dates.tolist(), ts.values.tolist()):
+            # NaN is stored as NULL
+            yield id, record, date, value if value == value else None
+
+################################################################################
+
+class SQLiteClient(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        The connection of the current thread, opened on first use
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def put(self, id, loader, loader_args, obj, coverage=None):
+        """
+        Store obj (a TimeSeries, a list of (date, value) tuples or a list
+        of time series records) under id, replacing what was there
+        """
+        header, series = npyfile.split(obj)
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM points WHERE id = ?', (id,))
+            conn.execute(
+                'INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (id, loader, loader_args.get('symbol'),
+                 loader_args.get('field'), header['kind'],
+                 self.dumps(header.get('records')), self.dumps(coverage),
+                 time.time()))
+            conn.executemany('INSERT INTO points VALUES (?, ?, ?, ?)',
+                             to_points(id, series))
+
+    def append(self, id, obj, coverage=None):
+        """
+        Add the points of obj, lined up with the records stored under id,
+        replacing stored points on the same dates. coverage, if given,
+        replaces the stored coverage
+        """
+        _, series = npyfile.split(obj)
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?)',
+                             to_points(id, series))
+            if coverage is not None:
+                conn.execute('UPDATE series SET coverage = ? WHERE id = ?',
+                             (self.dumps(coverage), id))
+
+    def set_coverage(self, id, coverage):
+        conn = self.connection()
+        with conn:
+            conn.execute('UPDATE series SET coverage = ? WHERE id = ?',
+                         (self.dumps(coverage), id))
+
+    def info(self, id):
+        """
+        Return (kind, record metadata, coverage) of the series stored
+        under id, or None
+        """
+        row = self.connection().execute(
+            'SELECT kind, records, coverage FROM series WHERE id = ?',
+            (id,)).fetchone()
+        if row is None:
+            return None
+        kind, records, coverage = row
+        return kind, self.loads(records), self.loads(coverage)
+
+    def record_count(self, id):
+        """
+        Number of records stored under id (1 for a bare series), or None
+        """
+        info = self.info(id)
+        if info is None:
+            return None
+        kind, records, _ = info
+        return len(records) if kind == npyfile.RECORDS else 1
+
+    def get(self, id, start=None, end=None):
+        """
+        Return the object stored under id, restricted to the dates from
+        start to end if given, or None
+        """
+        info = self.info(id)
+        if info is None:
+            return None
+        kind, records, _ = info
+        count = len(records) if kind == npyfile.RECORDS else 1
+
+        query = 'SELECT record, date, value FROM points WHERE id = ?'
+        params = [id]
+        if start is not None:
+            query += ' AND date >= ?'
+            params.append(to_microseconds(start))
+        if end is not None:
+            query += ' AND date <= ?'
+            params.append(to_microseconds(end))
+        query += ' ORDER BY record, date'
+        rows = self.connection().execute(query, params).fetchall()
+        # NULL, a stored NaN, comes back as None which numpy reads as NaN
+        points = numpy.array(rows, dtype=POINT_DTYPE)
+
+        bounds = numpy.searchsorted(points['record'], numpy.arange(count + 1))
+        series = [timeseries.TimeSeries(
+            points['date'][lo:hi].view(timeseries.DATE_DTYPE),
+            points['value'][lo:hi]) for lo, hi in zip(bounds, bounds[1:])]
+
+        if kind == npyfile.RECORDS:
+            merged = []
+            for metadata, ts in zip(records, series):
+                record = dict(metadata)
+                record[data_structure.TIMESERIES] = ts
+                merged.append(record)
+            return merged
+        return series[0]
+
+    def get_coverage(self, id):
+        info = self.info(id)
+        if info is None or info[2] is None:
+            return []
+        return info[2]
+
+    def find(self, loader=None, symbol=None, field=None):
+        """
+        Return the ids of the series stored for the loader, symbol and
+        field given
+        """
+        query = 'SELECT id FROM series'
+        criteria = [(column, value) for column, value in
+                    [('loader', loader), ('symbol', symbol), ('field', field)]
+                    if value is not None]
+        if criteria:
+            query += ' WHERE ' + ' AND '.join(
+                '{0} = ?'.format(column) for column, _ in criteria)
+        return [id for id, in self.connection().execute(
+            query, [value for _, value in criteria])]
+
+    def remove(self, id):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM points WHERE id = ?', (id,))
+            conn.execute('DELETE FROM series WHERE id = ?', (id,))
+
+    def clear(self):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM points')
+            conn.execute('DELETE FROM series')
+
+    @staticmethod
+    def dumps(obj):
+        if obj is None:
+            return None
+        return sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def loads(blob):
+        if blob is None:
+            return None
+        return pickle.loads(str(blob))
+
+################################################################################
@@ -6,6 +6,9 @@ from pyTimeSeries import log
 from pyTimeSeries import config
 from pyTimeSeries import data_retrieval
 
+# Requests given to get_time_series_many at a time
+REQUEST_CHUNK = 1000
+
 
 def test_spickle_vs_csv(index_list, start_date, end_date):
     for index in index_list:
@@ -162,9 +165,9 @@ def get_bbg_equdata(equ_list, start_date, end_date):
 
     random.shuffle(equ_list)
 
+    requests = []
     for equity in equ_list:
         equity += " Equity"
-        logger.info('working on equity <' + equity + '>')
 
         for field in fields:
             loader = 'download_bbg_timeseries';
@@ -174,8 +177,17 @@ def get_bbg_equdata(equ_list, start_date, end_date):
                 'end': end_date,
                 'field': field
                 }
-
-            ts = data_retrieval.get_time_series(loader, loader_args)
+            requests.append((loader, loader_args))
+
+    # Cache hits are looked up together, a chunk at a time so the series
+    # of only one chunk are held at once. The bloomberg session isn't
+    # shared between threads, so the misses are fetched one at a time
+    for i in range(0, len(requests), REQUEST_CHUNK):
+        chunk = requests[i:i + REQUEST_CHUNK]
+        results = data_retrieval.get_time_series_many(chunk, threads=1)
+        for (loader, loader_args), ts in zip(chunk, results):
+            equity = loader_args['symbol']
+            field = loader_args['field']
             if ts:
                 logger.info('  <' + equity + '><' + field + '>:' + str(len(ts)) + ' records')
             else:
@@ -12,6 +12,7 @@ import utils
 import data_retrieval
 import algorithms
 import charts
+import business_calendar
 
 
 
@@ -26,9 +27,8 @@ import charts
 
 def get_treasuries_series(series):
     data = data_loader.download_treasuries()
-    ts = data[series][data_loader.TIMESERIES]
-    cleaned = [(date, value) for date, value in ts if value != 'ND']
-    return zip(*cleaned)
+    cleaned = data[series][data_structure.TIMESERIES].dropna()
+    return cleaned.dates.astype(object), cleaned.values
 
 ################################################################################
 
@@ -62,19 +62,19 @@ def linear_reg():
             'end': datetime.datetime(2013, 11, 11)
         })
 
-    series = zip(*timeseries.common_dates(
-        ibm_data[data_structure.TIMESERIES],
-        spx_data[data_structure.TIMESERIES]))
+    series = timeseries.common_dates(
+        ibm_data[0][data_structure.TIMESERIES],
+        spx_data[0][data_structure.TIMESERIES]).dropna()
 
-    ibm = [float(val) for val in series[1]]
-    spx = [float(val) for val in series[2]]
+    ibm = series.values[:, 0]
+    spx = series.values[:, 1]
     slope, intercept, r_value, _, _ = algorithms.linreg(ibm, spx)
     print('Beta: {0}'.format(intercept))
     print('Slope: {0}'.format(slope))
     print('RSq: {0}'.format(r_value ** 2))
 
     series_for_charting = [('IBM', ibm), ('SPX', spx)]
-    charts.line(series[0], series_for_charting)
+    charts.line(series.dates.astype(object), series_for_charting)
     charts.scatter(series_for_charting)
 
 ################################################################################
@@ -170,10 +170,7 @@ def insert_to_mongo():
 ################################################################################
 
 def date_sequence(start, end):
-    dte = start
-    while dte <= end:
-        yield dte
-        dte = utils.offset(dte, 1)
+    return iter(business_calendar.weekdays().range(start, end))
 
 def generate_symbols(count):
     import hashlib
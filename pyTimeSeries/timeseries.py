@@ -2,15 +2,163 @@
 Using a list of tuples as a common time series object
 Each tuple has two elements, the first is a datetime.datetime object,
 the second is the value
+
+The TimeSeries class below is a columnar alternative: a datetime64 array
+of dates and a float64 array of values. Every function in this module
+accepts either form and returns the same form it was given.
 """
 import math
 
+import numpy
+
+################################################################################
+
+DATE_DTYPE = 'datetime64[us]'
+VALUE_DTYPE = numpy.float64
+
+################################################################################
+
+class TimeSeries(object):
+    """
+    Columnar time series: a datetime64 date array and a float64 value
+    array of the same length. Slicing returns a view on the underlying
+    arrays, no data is copied.
+
+    The values array may be 2 dimensional (dates x series), in which case
+    each element of the time series is a row of values
+
+    Missing values are stored as NaN, see valid and dropna
+    """
+
+    def __init__(self, dates, values):
+        self.dates = numpy.asarray(dates, dtype=DATE_DTYPE)
+        self.values = numpy.asarray(values, dtype=VALUE_DTYPE)
+        if len(self.dates) != len(self.values):
+            raise ValueError('Dates and values have different lengths: '
+                             '{0} and {1}'.format(len(self.dates),
+                                                  len(self.values)))
+
+    @classmethod
+    def from_tuples(cls, ts):
+        """
+        Build a TimeSeries from a list of (date, value) tuples
+        """
+        if len(ts) == 0:
+            return cls([], [])
+        dates, values = zip(*ts)
+        return cls(dates, values)
+
+    def to_tuples(self):
+        """
+        Return the series as a list of (date, value) tuples. If the series
+        holds several columns the tuples are (date, value1, value2, ...)
+        """
+        dates = self.dates.astype(object)
+        if self.values.ndim == 1:
+            return zip(dates, self.values.tolist())
+        return [(d,) + tuple(row)
+                for d, row in zip(dates, self.values.tolist())]
+
+    @property
+    def valid(self):
+        """
+        Boolean mask that is True where the series has a value
+        """
+        return ~numpy.isnan(self.values)
+
+    def dropna(self):
+        """
+        Return a copy of the series without the missing points. For a 2
+        dimensional series a row is dropped if any of its values is missing
+        """
+        keep = self.valid
+        if keep.ndim > 1:
+            keep = keep.all(axis=1)
+        return TimeSeries(self.dates[keep], self.values[keep])
+
+    def is_sorted(self):
+        return len(self) < 2 or bool((self.dates[1:] >= self.dates[:-1]).all())
+
+    def sorted(self):
+        """
+        Return the series in ascending date order. A series that's already
+        sorted is returned as it is, without a copy
+        """
+        if self.is_sorted():
+            return self
+        order = numpy.argsort(self.dates, kind='mergesort')
+        return TimeSeries(self.dates[order], self.values[order])
+
+    def between(self, start=None, end=None):
+        """
+        Return a view of the points with start <= date <= end, found by
+        binary search of the dates. The series must be sorted. None leaves
+        that end of the range open
+        """
+        i = 0
+        j = len(self)
+        if start is not None:
+            i = numpy.searchsorted(self.dates, numpy.datetime64(start, 'us'),
+                                   side='left')
+        if end is not None:
+            j = numpy.searchsorted(self.dates, numpy.datetime64(end, 'us'),
+                                   side='right')
+        return self[i:j]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TimeSeries(self.dates[key], self.values[key])
+        return self.dates[key].astype(object), self.values[key]
+
+    def __iter__(self):
+        return iter(self.to_tuples())
+
+    def __eq__(self, other):
+        if not isinstance(other, TimeSeries):
+            return NotImplemented
+        # Missing values compare equal to each other
+        valid = self.valid
+        return (numpy.array_equal(self.dates, other.dates) and
+                numpy.array_equal(valid, other.valid) and
+                numpy.array_equal(self.values[valid], other.values[valid]))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'TimeSeries({0!r}, {1!r})'.format(self.dates, self.values)
+
+################################################################################
+
+def is_columnar(ts):
+    """
+    True if ts is a TimeSeries rather than a list of tuples
+    """
+    return isinstance(ts, TimeSeries)
+
+
+def as_columnar(ts):
+    """
+    Return ts as a TimeSeries, converting from a list of tuples if needed
+    """
+    if is_columnar(ts):
+        return ts
+    return TimeSeries.from_tuples(ts)
+
 ################################################################################
 
 def returns(ts):
     """
     Compute return as Series(t+1)/Series(t) - 1
     """
+    if is_columnar(ts):
+        return TimeSeries(ts.dates[1:], ts.values[1:] / ts.values[:-1] - 1.0)
     return [(ts[i][0], (ts[i][1] / ts[i - 1][1]) - 1.0)
             for i in range(1, len(ts))]
 
@@ -20,17 +168,33 @@ def log_returns(ts):
     """
     Compute log return as log[Series(t+1)/Series(t)]
     """
+    if is_columnar(ts):
+        return TimeSeries(ts.dates[1:], numpy.log(ts.values[1:] / ts.values[:-1]))
     return [(ts[i][0], math.log(ts[i][1] / ts[i - 1][1]))
             for i in range(1, len(ts))]
 
 ################################################################################
 
+def valid_points(ts):
+    """
+    The series without its missing (NaN) points, which the statistics
+    below skip
+    """
+    if is_columnar(ts):
+        return ts.dropna()
+    return [point for point in ts if point[1] == point[1]]
+
+################################################################################
+
 def mean(ts):
     """
     The average of the input series
     Returns a time series object, with a date index given by the last time point
     and the value equal to the mean of the value elements
     """
+    ts = valid_points(ts)
+    if is_columnar(ts):
+        return TimeSeries(ts.dates[-1:], [ts.values.mean()])
     return [(ts[-1][0], sum(v for _, v in ts) / len(ts))]
 
 ################################################################################
@@ -41,6 +205,9 @@ def sd(ts):
     Returns a time series object, with a date index given by the last time point
     and the value equal to the standard deviation of the value elements
     """
+    ts = valid_points(ts)
+    if is_columnar(ts):
+        return TimeSeries(ts.dates[-1:], [ts.values.std()])
     _, ave = mean(ts)[0]
     return [(ts[-1][0], (sum((v - ave) ** 2 for _, v in ts) / len(ts)) ** 0.5)]
 
@@ -50,6 +217,11 @@ def zscore(ts):
     """
     Return the zscore of the input series as a time series object
     """
+    ts = valid_points(ts)
+    if is_columnar(ts):
+        ave = ts.values.mean()
+        std = ts.values.std()
+        return TimeSeries(ts.dates[-1:], [(ts.values[-1] - ave) / std])
     # Not reusing mean and sd to avoid recomputation of mean
     ave = sum(v for _, v in ts) / len(ts)
     std = (sum((v - ave) ** 2 for _, v in ts) / len(ts)) ** 0.5
@@ -62,6 +234,10 @@ def min(ts):
     """
     Return the min and date of min for the input timeseries as a timeseries object
     """
+    ts = valid_points(ts)
+    if is_columnar(ts):
+        i = ts.values.argmin()
+        return ts[i:i + 1]
     import __builtin__
     return [__builtin__.min(ts, key=lambda (_, v): v)]
 
@@ -71,16 +247,55 @@ def max(ts):
     """
     Return the max and date of max for the input timeseries as a timeseries object
     """
+    ts = valid_points(ts)
+    if is_columnar(ts):
+        i = ts.values.argmax()
+        return ts[i:i + 1]
     import __builtin__
     return [__builtin__.max(ts, key=lambda (_, v): v)]
 
 ################################################################################
 
+def summary(ts):
+    """
+    Return a dictionary of statistics for the input series, computed in a
+    single pass, skipping missing (NaN) points. The input doesn't need to
+    be sorted by date.
+        current, current_date - the value on the latest date
+        min, min_date - the min and date of min
+        max, max_date - the max and date of max
+        mean, sd, zscore - as the functions of the same name
+    """
+    from pyTimeSeries import accumulators
+    acc = accumulators.accumulate(ts)
+    return {
+        'current': acc.last_value,
+        'current_date': acc.last_date,
+        'min': acc.min_value,
+        'min_date': acc.min_date,
+        'max': acc.max_value,
+        'max_date': acc.max_date,
+        'mean': acc.mean,
+        'sd': acc.sd,
+        'zscore': acc.zscore
+    }
+
+################################################################################
+
 def common_dates(x, y):
     """
     Takes two input time series objects and returns a list of tuples, 
     [(date1, x1, y1),...] on a the intersection of the date ranges
+
+    For TimeSeries inputs the result is a two column TimeSeries
     """
+    if is_columnar(x) or is_columnar(y):
+        x = as_columnar(x)
+        y = as_columnar(y)
+        dates, xi, yi = numpy.intersect1d(x.dates, y.dates,
+                                          return_indices=True)
+        return TimeSeries(dates,
+                          numpy.column_stack((x.values[xi], y.values[yi])))
     xd = dict(x)
     yd = dict(y)
     dates = set(xd.keys()) & set(yd.keys())
@@ -2,9 +2,35 @@ import unittest
 import os
 import math
 import datetime
+import time
 import tempfile
+import copy
+import shutil
+import threading
+import functools
+import hashlib
+import multiprocessing
+
+import numpy
 
 from pyTimeSeries import timeseries
+from pyTimeSeries import rolling
+from pyTimeSeries import accumulators
+from pyTimeSeries import panel
+from pyTimeSeries import business_calendar
+from pyTimeSeries import spickle
+from pyTimeSeries import memory_cache
+from pyTimeSeries import range_cache
+from pyTimeSeries import cache_manifest
+from pyTimeSeries import cache_retention
+from pyTimeSeries import write_behind
+from pyTimeSeries import compression
+from pyTimeSeries import gorilla
+from pyTimeSeries import segment_store
+from pyTimeSeries import dateparse
+from pyTimeSeries import sqlite_db
+from pyTimeSeries import single_flight
+from pyTimeSeries import negative_cache
 import utils
 import data_loader
 import data_retrieval
@@ -44,6 +70,122 @@ class TestUtilsFunctions(unittest.TestCase):
             os.remove(tmpfile)
         self.assertEqual(data, result)
 
+    def test_spickle(self):
+        """
+        Round trip through both spickle formats, including a record with
+        a blank line in it that the v1 format can't handle, and read v2
+        records at random from the offset table
+        """
+        data = [
+            (datetime.datetime(2013, 11, 7), ('IBM', 'MSFT')),
+            (datetime.datetime(2013, 11, 8), 'two lines\n\nof text'),
+            (datetime.datetime(2013, 11, 11), 182.88),
+        ]
+        fd, tmpfile = tempfile.mkstemp(suffix='.spickle')
+        try:
+            with open(tmpfile, 'wb') as f:
+                spickle.s_dump(data, f)
+            with open(tmpfile, 'rb') as f:
+                self.assertEqual(data, list(spickle.s_load(f)))
+            with open(tmpfile, 'rb') as f:
+                offsets = spickle.s_offsets(f)
+                self.assertEqual(len(data), len(offsets))
+                self.assertEqual(data[2], spickle.s_load_at(f, offsets[2]))
+                self.assertEqual(data[0], spickle.s_load_at(f, offsets[0]))
+
+            # Files in the original format can still be read
+            v1_data = [data[0], data[2]]
+            with open(tmpfile, 'wb') as f:
+                spickle.s_dump(v1_data, f, version=1)
+            with open(tmpfile, 'rb') as f:
+                self.assertEqual(v1_data, list(spickle.s_load(f)))
+        finally:
+            os.close(fd)
+            os.remove(tmpfile)
+
+    @staticmethod
+    def npy_round_trip(data):
+        fd, tmpfile = tempfile.mkstemp(suffix='.tsn')
+        try:
+            utils.npy_serialise_obj(data, tmpfile)
+            # Copy out of the memory map so the file can be removed
+            result = utils.npy_deserialise_obj(tmpfile)
+            return copy.deepcopy(result)
+        finally:
+            os.close(fd)
+            os.remove(tmpfile)
+
+    def test_npy_serialise_deserialise_obj(self):
+        """
+        Round trip time series records, a bare series and a two column
+        panel through the npy format, and check the arrays are memory
+        mapped rather than read into memory
+        """
+        ts = timeseries.TimeSeries.from_tuples([
+            (datetime.datetime(2013, 11, 7), 6.32),
+            (datetime.datetime(2013, 11, 8, 12, 30), float('nan')),
+            (datetime.datetime(2013, 11, 11), 0.51),
+        ])
+        records = [
+            data_structure.create_time_series(
+                {'symbol': 'IBM', 'start': datetime.datetime(2013, 11, 7)},
+                ts, {}),
+            data_structure.create_time_series(
+                {'symbol': 'EMPTY'}, timeseries.TimeSeries([], []), {})
+        ]
+
+        self.assertEqual(records, self.npy_round_trip(records))
+        self.assertEqual(ts, self.npy_round_trip(ts))
+        two_columns = timeseries.common_dates(ts, ts)
+        self.assertEqual(two_columns, self.npy_round_trip(two_columns))
+
+        fd, tmpfile = tempfile.mkstemp(suffix='.tsn')
+        try:
+            utils.npy_serialise_obj(ts, tmpfile)
+            result = utils.npy_deserialise_obj(tmpfile)
+            self.assertIsInstance(result.values.base, numpy.memmap)
+            del result
+        finally:
+            os.close(fd)
+            os.remove(tmpfile)
+
+        # Non numeric series can't be stored
+        self.assertRaises(ValueError, utils.npy_serialise_obj,
+                          [(datetime.datetime(2013, 11, 7), ['IBM', 'MSFT'])],
+                          os.devnull)
+
+    def test_gorilla_serialise_deserialise_obj(self):
+        """
+        Round trip time series records and a bare series through the
+        gorilla format
+        """
+        ts = timeseries.TimeSeries.from_tuples([
+            (datetime.datetime(2013, 11, 7), 6.32),
+            (datetime.datetime(2013, 11, 8), float('nan')),
+            (datetime.datetime(2013, 11, 11), 0.51),
+            (datetime.datetime(2013, 11, 12), 0.51),
+        ])
+        records = [
+            data_structure.create_time_series(
+                {'symbol': 'IBM', 'start': datetime.datetime(2013, 11, 7)},
+                ts, {}),
+            data_structure.create_time_series(
+                {'symbol': 'EMPTY'}, timeseries.TimeSeries([], []), {})
+        ]
+
+        fd, tmpfile = tempfile.mkstemp(suffix='.gorilla')
+        try:
+            utils.gorilla_serialise_obj(records, tmpfile)
+            self.assertEqual(records, utils.gorilla_deserialise_obj(tmpfile))
+            utils.gorilla_serialise_obj(ts, tmpfile)
+            self.assertEqual(ts, utils.gorilla_deserialise_obj(tmpfile))
+        finally:
+            os.close(fd)
+            os.remove(tmpfile)
+
+        self.assertRaises(ValueError, utils.gorilla_serialise_obj,
+                          timeseries.common_dates(ts, ts), os.devnull)
+
     def test_offset(self):
         """
         Package together the properties we want for the date offset 
@@ -92,6 +234,16 @@ class TestUtilsFunctions(unittest.TestCase):
         result = utils.offset(datetime.datetime(2013, 11, 15), 1, 'y')
         self.assertEqual(result, datetime.datetime(2014, 11, 17))
 
+        # Check month moves carry across the year end in both directions
+        result = utils.offset(datetime.datetime(2013, 11, 12), 3, 'M')
+        self.assertEqual(result, datetime.datetime(2014, 2, 12))
+        result = utils.offset(datetime.datetime(2013, 2, 12), -14, 'M')
+        self.assertEqual(result, datetime.datetime(2011, 12, 12))
+
+        # Check a month move is clipped to the end of a shorter month
+        result = utils.offset(datetime.datetime(2014, 1, 31), 1, 'M')
+        self.assertEqual(result, datetime.datetime(2014, 2, 28))
+
         # Check exception is thrown if the period isn't recognised
         self.assertRaises(ValueError,
                           utils.offset,
@@ -99,6 +251,65 @@ class TestUtilsFunctions(unittest.TestCase):
 
 ################################################################################
 
+class TestBusinessCalendar(unittest.TestCase):
+    # Thanksgiving and Christmas 2013
+    holidays = [datetime.date(2013, 11, 28), datetime.date(2013, 12, 25)]
+
+    def test_offset(self):
+        cal = business_calendar.BusinessCalendar()
+
+        # Within a week, across a weekend and by whole weeks
+        self.assertEqual(cal.offset(datetime.datetime(2013, 11, 11), 1),
+                         datetime.datetime(2013, 11, 12))
+        self.assertEqual(cal.offset(datetime.datetime(2013, 11, 13), 3),
+                         datetime.datetime(2013, 11, 18))
+        self.assertEqual(cal.offset(datetime.datetime(2013, 11, 11), -7),
+                         datetime.datetime(2013, 10, 31))
+
+        # From a weekend: +1 is monday, -1 is friday and 0 rolls forward
+        saturday = datetime.date(2013, 11, 16)
+        self.assertEqual(cal.offset(saturday, 1), datetime.date(2013, 11, 18))
+        self.assertEqual(cal.offset(saturday, -1), datetime.date(2013, 11, 15))
+        self.assertEqual(cal.offset(saturday, 0), datetime.date(2013, 11, 18))
+
+        # The time of day is kept
+        self.assertEqual(cal.offset(datetime.datetime(2013, 11, 15, 16, 30), 1),
+                         datetime.datetime(2013, 11, 18, 16, 30))
+
+        self.assertRaises(ValueError, cal.offset, datetime.date(1900, 1, 1), 1)
+
+    def test_holidays(self):
+        cal = business_calendar.BusinessCalendar(self.holidays)
+        self.assertFalse(cal.is_business_day(datetime.date(2013, 11, 28)))
+        self.assertEqual(cal.offset(datetime.date(2013, 11, 27), 1),
+                         datetime.date(2013, 11, 29))
+        self.assertEqual(cal.count(datetime.date(2013, 11, 25),
+                                   datetime.date(2013, 12, 2)), 4)
+
+    def test_range_and_arrays(self):
+        cal = business_calendar.BusinessCalendar(self.holidays)
+        dates = cal.range(datetime.datetime(2013, 11, 22),
+                          datetime.datetime(2013, 12, 2))
+        self.assertEqual(dates, [
+            datetime.datetime(2013, 11, 22),
+            datetime.datetime(2013, 11, 25),
+            datetime.datetime(2013, 11, 26),
+            datetime.datetime(2013, 11, 27),
+            datetime.datetime(2013, 11, 29),
+            datetime.datetime(2013, 12, 2),
+        ])
+
+        # Vectorized offsets agree with the single date version, including
+        # from holidays and weekends
+        dates += [datetime.datetime(2013, 11, 28, 9, 0),
+                  datetime.datetime(2013, 11, 30)]
+        for off in (-6, -1, 0, 1, 3):
+            expected = [cal.offset(d, off) for d in dates]
+            result = cal.offset_array(dates, off)
+            self.assertEqual(expected, result.astype(object).tolist())
+
+################################################################################
+
 class TestTimeseriesFunctions(unittest.TestCase):
     def test_returns(self):
         ts = [
@@ -245,6 +456,34 @@ class TestTimeseriesFunctions(unittest.TestCase):
         expected_result = [(datetime.datetime(2013, 11, 7), 6.32)]
         self.assertEqual(ts_max, expected_result)
 
+    def test_summary(self):
+        """
+        The summary matches the individual functions, whether or not the
+        input is sorted
+        """
+        ts = [
+            (datetime.datetime(2013, 11, 7), 6.32),
+            (datetime.datetime(2013, 10, 31), 4.53),
+            (datetime.datetime(2013, 11, 13), 0.51),
+            (datetime.datetime(2013, 11, 4), -2.89),
+            (datetime.datetime(2013, 11, 12), -6.30),
+            (datetime.datetime(2013, 11, 1), 3.87),
+        ]
+        sorted_ts = sorted(ts)
+
+        for stats in (timeseries.summary(ts),
+                      timeseries.summary(timeseries.TimeSeries.from_tuples(ts))):
+            self.assertEqual(sorted_ts[-1], (stats['current_date'],
+                                             stats['current']))
+            self.assertEqual(timeseries.min(ts)[0], (stats['min_date'],
+                                                     stats['min']))
+            self.assertEqual(timeseries.max(ts)[0], (stats['max_date'],
+                                                     stats['max']))
+            self.assertAlmostEqual(timeseries.mean(ts)[0][1], stats['mean'])
+            self.assertAlmostEqual(timeseries.sd(ts)[0][1], stats['sd'])
+            self.assertAlmostEqual(timeseries.zscore(sorted_ts)[0][1],
+                                   stats['zscore'])
+
     def test_common_dates(self):
         """
         Test the common_dates correctly returns an ordered result on the
@@ -283,10 +522,333 @@ class TestTimeseriesFunctions(unittest.TestCase):
 
 ################################################################################
 
+class TestColumnarTimeSeries(unittest.TestCase):
+    ts = [
+        (datetime.datetime(2013, 10, 31), 4.53),
+        (datetime.datetime(2013, 11, 1), 3.87),
+        (datetime.datetime(2013, 11, 4), -2.89),
+        (datetime.datetime(2013, 11, 5), -0.18),
+        (datetime.datetime(2013, 11, 6), 1.36),
+        (datetime.datetime(2013, 11, 7), 6.32),
+        (datetime.datetime(2013, 11, 8), 0.51),
+        (datetime.datetime(2013, 11, 11), -5.98),
+        (datetime.datetime(2013, 11, 12), -6.30),
+        (datetime.datetime(2013, 11, 13), 0.51),
+    ]
+
+    def assert_series_almost_equal(self, expected, result):
+        self.assertEqual(len(expected), len(result))
+        for (d1, v1), (d2, v2) in zip(expected, result):
+            self.assertEqual(d1, d2)
+            self.assertAlmostEqual(v1, v2)
+
+    def test_round_trip(self):
+        """
+        Converting to and from the list of tuples format is lossless
+        """
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        self.assertEqual(len(self.ts), len(columnar))
+        self.assertEqual(self.ts, columnar.to_tuples())
+        self.assertEqual(self.ts[3], columnar[3])
+
+    def test_slice_is_view(self):
+        """
+        Slicing shares memory with the parent series
+        """
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        sliced = columnar[2:5]
+        self.assertEqual(self.ts[2:5], sliced.to_tuples())
+        sliced.values[0] = 100.0
+        self.assertEqual(100.0, columnar.values[2])
+
+    def test_between(self):
+        """
+        Range slicing returns a view of the inclusive date range
+        """
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        result = columnar.between(datetime.datetime(2013, 11, 2),
+                                  datetime.datetime(2013, 11, 8))
+        self.assertEqual(self.ts[2:7], result.to_tuples())
+        self.assertTrue(numpy.shares_memory(result.values, columnar.values))
+
+        self.assertEqual(self.ts[:3], columnar.between(
+            end=datetime.datetime(2013, 11, 4)).to_tuples())
+        self.assertEqual(self.ts[-1:], columnar.between(
+            start=datetime.datetime(2013, 11, 13)).to_tuples())
+        self.assertEqual(0, len(columnar.between(
+            datetime.datetime(2014, 1, 1), datetime.datetime(2014, 2, 1))))
+
+    def test_sorted(self):
+        columnar = timeseries.TimeSeries.from_tuples(self.ts[::-1])
+        self.assertFalse(columnar.is_sorted())
+        self.assertEqual(self.ts, columnar.sorted().to_tuples())
+
+    def test_functions_match_tuple_version(self):
+        """
+        Every timeseries function gives the same answer for both forms
+        """
+        prices = [(d, abs(v)) for d, v in self.ts]
+        columnar = timeseries.TimeSeries.from_tuples(prices)
+        for f in (timeseries.returns, timeseries.log_returns):
+            result = f(columnar)
+            self.assertTrue(timeseries.is_columnar(result))
+            self.assert_series_almost_equal(f(prices), result.to_tuples())
+
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        for f in (timeseries.mean, timeseries.sd, timeseries.zscore,
+                  timeseries.min, timeseries.max):
+            result = f(columnar)
+            self.assertTrue(timeseries.is_columnar(result))
+            self.assert_series_almost_equal(f(self.ts), result.to_tuples())
+
+    def test_common_dates(self):
+        x = self.ts[::2]
+        y = self.ts[1::3] + self.ts[::4]
+        expected = timeseries.common_dates(x, y)
+        result = timeseries.common_dates(
+            timeseries.TimeSeries.from_tuples(x),
+            timeseries.TimeSeries.from_tuples(sorted(y)))
+        self.assertEqual(expected, result.to_tuples())
+
+################################################################################
+
+class TestRollingFunctions(unittest.TestCase):
+    ts = TestColumnarTimeSeries.ts
+    window = 4
+
+    def test_rolling_matches_full_window(self):
+        """
+        Each rolling point equals the full series function applied to
+        the trailing window, for both time series forms
+        """
+        pairs = [
+            (rolling.mean, timeseries.mean),
+            (rolling.sd, timeseries.sd),
+            (rolling.zscore, timeseries.zscore),
+            (rolling.min, lambda w: [(w[-1][0], timeseries.min(w)[0][1])]),
+            (rolling.max, lambda w: [(w[-1][0], timeseries.max(w)[0][1])]),
+        ]
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        for rolling_f, f in pairs:
+            expected = [f(self.ts[i - self.window:i])[0]
+                        for i in range(self.window, len(self.ts) + 1)]
+            for result in (rolling_f(self.ts, self.window),
+                           rolling_f(columnar, self.window).to_tuples()):
+                self.assertEqual(len(expected), len(result))
+                for (d1, v1), (d2, v2) in zip(expected, result):
+                    self.assertEqual(d1, d2)
+                    self.assertAlmostEqual(v1, v2)
+
+    def test_long_series(self):
+        """
+        The rolling sd of a long series far from its first value keeps
+        its precision, and the extremes of each window are exact
+        """
+        window = 50
+        random = numpy.random.RandomState(0)
+        values = 1e9 + numpy.cumsum(random.normal(0, 1e4, 100000))
+        columnar = timeseries.TimeSeries(
+            numpy.arange(len(values)).astype('M8[D]'), values)
+        windows = numpy.lib.stride_tricks.as_strided(
+            values, shape=(len(values) - window + 1, window),
+            strides=(values.strides[0],) * 2)
+
+        numpy.testing.assert_allclose(windows.std(axis=1),
+                                      rolling.sd(columnar, window).values,
+                                      rtol=1e-9)
+        numpy.testing.assert_allclose(
+            windows.std(axis=1)[:2000],
+            [v for _, v in rolling.sd(columnar[:2049].to_tuples(), window)],
+            rtol=1e-9)
+        numpy.testing.assert_array_equal(windows.min(axis=1),
+                                         rolling.min(columnar, window).values)
+        numpy.testing.assert_array_equal(windows.max(axis=1),
+                                         rolling.max(columnar, window).values)
+
+    def test_short_series(self):
+        columnar = timeseries.TimeSeries.from_tuples(self.ts[:2])
+        self.assertEqual([], rolling.mean(self.ts[:2], self.window))
+        self.assertEqual(0, len(rolling.max(columnar, self.window)))
+        self.assertRaises(ValueError, rolling.sd, self.ts, 0)
+
+################################################################################
+
+class TestStatsAccumulator(unittest.TestCase):
+    ts = TestColumnarTimeSeries.ts
+
+    def assert_matches_series(self, acc, ts):
+        self.assertEqual(len(ts), acc.count)
+        self.assertAlmostEqual(timeseries.mean(ts)[0][1], acc.mean)
+        self.assertAlmostEqual(timeseries.sd(ts)[0][1], acc.sd)
+        self.assertAlmostEqual(timeseries.zscore(ts)[0][1], acc.zscore)
+        self.assertEqual(timeseries.min(ts)[0], (acc.min_date, acc.min_value))
+        self.assertEqual(timeseries.max(ts)[0], (acc.max_date, acc.max_value))
+        self.assertEqual(ts[-1], (acc.last_date, acc.last_value))
+
+    def test_update(self):
+        acc = accumulators.StatsAccumulator()
+        for dte, val in self.ts:
+            acc.update(dte, val)
+        self.assert_matches_series(acc, self.ts)
+
+        columnar = timeseries.TimeSeries.from_tuples(self.ts)
+        self.assert_matches_series(accumulators.accumulate(columnar), self.ts)
+
+    def test_merge(self):
+        """
+        Merging accumulators built on partitions of the series gives the
+        same result as a single accumulator, regardless of order
+        """
+        later = accumulators.accumulate(self.ts[6:])
+        earlier = accumulators.accumulate(
+            timeseries.TimeSeries.from_tuples(self.ts[:6]))
+        acc = later.merge(earlier).merge(accumulators.StatsAccumulator())
+        self.assert_matches_series(acc, self.ts)
+
+    def test_missing(self):
+        """
+        Missing (NaN) points are skipped alike by the accumulators and the
+        statistics of tuple and columnar series
+        """
+        nan = float('nan')
+        ts = list(self.ts)
+        ts.insert(3, (ts[2][0], nan))
+        ts.append((ts[-1][0] + datetime.timedelta(days=1), nan))
+        columnar = timeseries.TimeSeries.from_tuples(ts)
+        for series in (ts, columnar):
+            acc = accumulators.accumulate(series)
+            self.assert_matches_series(acc, self.ts)
+            summary = timeseries.summary(series)
+            self.assertFalse(any(v != v for v in summary.values()))
+            for f in (timeseries.mean, timeseries.sd, timeseries.zscore,
+                      timeseries.min, timeseries.max):
+                self.assertAlmostEqual(f(self.ts)[0][1], f(series)[0][1])
+            self.assertEqual(timeseries.min(self.ts)[0][0],
+                             timeseries.min(series)[0][0])
+
+    def test_to_from_dict(self):
+        acc = accumulators.accumulate(self.ts)
+        copy = accumulators.StatsAccumulator.from_dict(acc.to_dict())
+        self.assertEqual(acc.to_dict(), copy.to_dict())
+
+################################################################################
+
+class TestPanelFunctions(unittest.TestCase):
+    x = [
+        (datetime.datetime(2013, 10, 31), 4.53),
+        (datetime.datetime(2013, 11, 4), -2.89),
+        (datetime.datetime(2013, 11, 5), -0.18),
+        (datetime.datetime(2013, 11, 7), 6.32),
+    ]
+    # Deliberately out of order
+    y = [
+        (datetime.datetime(2013, 11, 1), -9.87),
+        (datetime.datetime(2013, 11, 5), 1.18),
+        (datetime.datetime(2013, 10, 31), 8.53),
+        (datetime.datetime(2013, 11, 7), -6.32),
+    ]
+    z = [
+        (datetime.datetime(2013, 10, 31), 1.0),
+        (datetime.datetime(2013, 11, 5), 2.0),
+        (datetime.datetime(2013, 11, 7), 3.0),
+    ]
+
+    def assert_panel_equal(self, expected, result):
+        self.assertEqual(len(expected), len(result))
+        for row, result_row in zip(expected, result.to_tuples()):
+            self.assertEqual(row[0], result_row[0])
+            for v1, v2 in zip(row[1:], result_row[1:]):
+                if v1 is None:
+                    self.assertTrue(math.isnan(v2))
+                else:
+                    self.assertEqual(v1, v2)
+
+    def test_inner(self):
+        result = panel.align([self.x, self.y], panel.INNER)
+        self.assertEqual(timeseries.common_dates(self.x, self.y),
+                         result.to_tuples())
+
+        result = panel.align([timeseries.TimeSeries.from_tuples(self.x),
+                              self.y, self.z])
+        expected = [
+            (datetime.datetime(2013, 10, 31), 4.53, 8.53, 1.0),
+            (datetime.datetime(2013, 11, 5), -0.18, 1.18, 2.0),
+            (datetime.datetime(2013, 11, 7), 6.32, -6.32, 3.0),
+        ]
+        self.assertEqual(expected, result.to_tuples())
+
+    def test_outer(self):
+        result = panel.align([self.x, self.y, self.z], panel.OUTER)
+        expected = [
+            (datetime.datetime(2013, 10, 31), 4.53, 8.53, 1.0),
+            (datetime.datetime(2013, 11, 1), None, -9.87, None),
+            (datetime.datetime(2013, 11, 4), -2.89, None, None),
+            (datetime.datetime(2013, 11, 5), -0.18, 1.18, 2.0),
+            (datetime.datetime(2013, 11, 7), 6.32, -6.32, 3.0),
+        ]
+        self.assert_panel_equal(expected, result)
+
+    def test_asof(self):
+        result = panel.align([self.x, self.y[:2]], panel.ASOF)
+        expected = [
+            (datetime.datetime(2013, 10, 31), 4.53, None),
+            (datetime.datetime(2013, 11, 1), 4.53, -9.87),
+            (datetime.datetime(2013, 11, 4), -2.89, -9.87),
+            (datetime.datetime(2013, 11, 5), -0.18, 1.18),
+            (datetime.datetime(2013, 11, 7), 6.32, 1.18),
+        ]
+        self.assert_panel_equal(expected, result)
+
+        self.assertRaises(ValueError, panel.align, [self.x], 'left')
+
+    def test_returns(self):
+        """
+        Panel returns match the single series returns column by column,
+        with NaN where there's a gap unless the gap is filled
+        """
+        prices = [(d, abs(v)) for d, v in self.x]
+        p = panel.align([prices, self.z], panel.OUTER)
+
+        result = panel.returns(p)
+        self.assertEqual(len(p) - 1, len(result))
+        expected = timeseries.returns(prices)
+        for row, (dte, ret) in zip(result.to_tuples(), expected):
+            self.assertEqual(dte, row[0])
+            self.assertAlmostEqual(ret, row[1])
+        # z is missing on 4 Nov so both returns around it are NaN
+        self.assertTrue(math.isnan(result.values[0, 1]))
+        self.assertTrue(math.isnan(result.values[1, 1]))
+
+        filled = panel.log_returns(p, fill_gaps=True)
+        self.assertTrue(math.isnan(filled.values[0, 1]))
+        self.assertAlmostEqual(math.log(2.0), filled.values[1, 1])
+
+        multi = panel.multi_horizon_returns(p, horizons=(1, 3))
+        self.assertEqual(set([1, 3]), set(multi.keys()))
+        self.assertAlmostEqual(6.32 / 4.53 - 1, multi[3].values[0, 0])
+        self.assertRaises(ValueError, panel.returns, p, 0)
+
+################################################################################
+
 class TestDataLoaderFunctions(unittest.TestCase):
 
     data_folder = './testdata'
 
+    @staticmethod
+    def typed(ts):
+        """
+        The stored results hold the raw strings in the order of the
+        source, the transforms now parse them into a TimeSeries with NaN
+        for missing values, sorted by date
+        """
+        def parse(raw):
+            if raw in ('', 'ND'):
+                return float('nan')
+            return float(raw)
+
+        return timeseries.TimeSeries(
+            [dte for dte, _ in ts], [parse(raw) for _, raw in ts]).sorted()
+
     def test_transform_treasuries_data(self):
         """
         Test the transformation of the raw data received from the fed
@@ -300,6 +862,9 @@ class TestDataLoaderFunctions(unittest.TestCase):
         test_result = os.path.join(self.data_folder,
                                    'test_transform_treasuries_data.result.py')
         base_result = utils.deserialise_obj(test_result)
+        for series in base_result:
+            series[data_structure.TIMESERIES] = self.typed(
+                series[data_structure.TIMESERIES])
 
         self.assertEqual(result, base_result)
 
@@ -315,7 +880,7 @@ class TestDataLoaderFunctions(unittest.TestCase):
 
         test_result = os.path.join(self.data_folder,
                                    'test_transform_yahoo_timeseries.result.py')
-        base_result = utils.deserialise_obj(test_result)
+        base_result = self.typed(utils.deserialise_obj(test_result))
 
         self.assertEqual(result, base_result)
 
@@ -331,12 +896,36 @@ class TestDataLoaderFunctions(unittest.TestCase):
 
         test_result = os.path.join(self.data_folder,
                                    'test_transform_google_timeseries.result.py')
-        base_result = utils.deserialise_obj(test_result)
+        base_result = self.typed(utils.deserialise_obj(test_result))
 
         self.assertEqual(result, base_result)
 
 ################################################################################
 
+def fetch_in_process(cache_folder, write_behind, calls_filename, loader,
+                     loader_args):
+    """
+    get_time_series in a process of its own, appending a line to
+    calls_filename for each call of the loader, which takes a while
+    """
+    config.CACHE_FOLDER = cache_folder
+    config.WRITE_BEHIND = write_behind
+    # The thread of a queue inherited from the parent doesn't run here
+    data_retrieval.write_behind_queue = None
+    f = getattr(data_loader, loader)
+
+    def logged(**kwargs):
+        with open(calls_filename, 'a') as calls:
+            calls.write('call\n')
+        time.sleep(0.2)
+        return f(**kwargs)
+
+    setattr(data_loader, loader, logged)
+    data_retrieval.get_time_series(loader, loader_args)
+    # as at interpreter exit, which a multiprocessing child skips
+    data_retrieval.flush_cache_writes()
+
+
 class TestDataRetrievalFunctions(unittest.TestCase):
     # Set a cache folder for the unit test and a cache file that we
     # can remove in tearDown in case the test fails prior to clearing 
@@ -353,17 +942,53 @@ class TestDataRetrievalFunctions(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         config.DB = cls.restore_db
+        for f in (cache_manifest.MANIFEST_FILENAME,
+                  cache_manifest.JOURNAL_FILENAME,
+                  cache_manifest.LOCK_FILENAME,
+                  negative_cache.JOURNAL_FILENAME):
+            if os.path.exists(os.path.join(cls.cache_folder, f)):
+                os.remove(os.path.join(cls.cache_folder, f))
+        # and the subdirectories of the sharded layout
+        for f in os.listdir(cls.cache_folder):
+            if os.path.isdir(os.path.join(cls.cache_folder, f)):
+                shutil.rmtree(os.path.join(cls.cache_folder, f))
+        data_retrieval.manifests.pop(os.path.abspath(cls.cache_folder), None)
+
+    # Mock loaders whose calls are recorded by the tests
+    mock_loaders = ('download_mock_daily_series',
+                    'download_mock_daily_tuples')
 
     def setUp(self):
         self.restore_cache_folder = config.CACHE_FOLDER
         config.CACHE_FOLDER = self.cache_folder
 
+        # (symbol, start, end) of each call of a mock loader. A result in
+        # mock_results for the symbol is returned instead of the loader's,
+        # and once release is set, calls wait for it
+        self.calls = []
+        self.mock_results = {}
+        self.release = None
+        self.restore_loaders = {}
+        for loader in self.mock_loaders:
+            self.restore_loaders[loader] = getattr(data_loader, loader)
+            setattr(data_loader, loader,
+                    functools.partial(self.call_mock_loader, loader))
+
     def tearDown(self):
-        cache_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
-        if os.path.exists(cache_file):
-            os.remove(cache_file)
+        for loader, f in self.restore_loaders.iteritems():
+            setattr(data_loader, loader, f)
+        if self.cache_id:
+            data_retrieval.clear_cache(self.cache_id)
         config.CACHE_FOLDER = self.restore_cache_folder
 
+    def call_mock_loader(self, loader, symbol, start, end):
+        self.calls.append((symbol, start, end))
+        if self.release is not None:
+            self.release.wait()
+        if symbol in self.mock_results:
+            return self.mock_results[symbol]
+        return self.restore_loaders[loader](symbol, start, end)
+
     def test_get_time_series(self):
         """
         End to end test of the following functions
@@ -407,6 +1032,1700 @@ class TestDataRetrievalFunctions(unittest.TestCase):
         # Check it's gone
         self.assertFalse(data_retrieval.get_from_cache(loader, loader_args))
 
+    def test_series_key(self):
+        """
+        With the mongo db, series are keyed in process without the
+        explicit cache id, which needs a field argument
+        """
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        restore = (config.DB, config.FILEID_TYPE)
+        config.DB = data_retrieval.MONGO_DB
+        config.FILEID_TYPE = 'explicit'
+        try:
+            self.assertEqual(
+                data_retrieval.get_sha1_id('download_mock_series',
+                                           loader_args),
+                data_retrieval.get_series_key('download_mock_series',
+                                              loader_args))
+        finally:
+            config.DB, config.FILEID_TYPE = restore
+
+    def test_memory_tier(self):
+        """
+        Reads after the first are served from memory, until the series is
+        written or cleared
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        data_retrieval.get_time_series(loader, loader_args)
+
+        data_retrieval.get_from_cache(loader, loader_args)
+        hits = data_retrieval.memory_tier.stats()['hits']
+
+        # Remove the file behind the cache's back: still served from memory
+        os.remove(data_retrieval.get_cache_filename_pickle(self.cache_id))
+        cached = data_retrieval.get_from_cache(loader, loader_args)
+        self.assertEqual(loader_args, cached[0][data_structure.ID])
+        self.assertEqual(hits + 1, data_retrieval.memory_tier.stats()['hits'])
+
+        # Writing invalidates the memory copy
+        data_retrieval.write_to_cache(loader, loader_args, cached)
+        self.assertIsNone(data_retrieval.memory_tier.get(self.cache_id))
+
+        data_retrieval.clear_cache(self.cache_id)
+        self.assertFalse(data_retrieval.get_from_cache(loader, loader_args))
+
+    def test_get_time_series_range(self):
+        """
+        Only the dates not already in the cache are fetched, and the fetched
+        points are merged into the cached series
+        """
+        loader = 'download_mock_daily_series'
+
+        def args(start, end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(*start),
+                'end': datetime.datetime(*end)
+            }
+
+        self.cache_id = data_retrieval.get_id(loader,
+                                              args((2013, 1, 1), (2013, 1, 1)))
+
+        result = data_retrieval.get_time_series(
+            loader, args((2013, 1, 10), (2013, 1, 20)))
+        self.assertEqual(11, len(result[0][data_structure.TIMESERIES]))
+
+        # Extend on both sides: only the two gaps are fetched
+        del self.calls[:]
+        result = data_retrieval.get_time_series(
+            loader, args((2013, 1, 5), (2013, 1, 25)))
+        self.assertEqual([
+            ('TGTT', datetime.datetime(2013, 1, 5),
+             datetime.datetime(2013, 1, 9)),
+            ('TGTT', datetime.datetime(2013, 1, 21),
+             datetime.datetime(2013, 1, 25))], self.calls)
+        ts = result[0][data_structure.TIMESERIES]
+        self.assertEqual(21, len(ts))
+        self.assertTrue(ts.is_sorted())
+        self.assertEqual(range(5, 26), ts.values.tolist())
+
+        # A sub range is served from the cache alone
+        del self.calls[:]
+        result = data_retrieval.get_time_series(
+            loader, args((2013, 1, 7), (2013, 1, 8)))
+        self.assertEqual([], self.calls)
+        self.assertEqual([7.0, 8.0],
+            result[0][data_structure.TIMESERIES].values.tolist())
+
+        data_retrieval.clear_cache(self.cache_id)
+        self.assertEqual([], data_retrieval.get_coverage(self.cache_id))
+
+    def test_get_time_series_range_tuples(self):
+        """
+        Loaders returning (date, value) tuples, like the bloomberg
+        historical data request, have their ranges extended and sliced,
+        in the file cache and in sqlite
+        """
+        loader = 'download_mock_daily_tuples'
+
+        def args(start, end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, start),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        def days(result):
+            return [dte.day for dte, _ in result]
+
+        self.cache_id = data_retrieval.get_id(loader, args(1, 1))
+        folder = tempfile.mkdtemp()
+        restore = (config.DB, config.SQLITE_FILE)
+        config.SQLITE_FILE = os.path.join(folder, 'test.sqlite')
+        try:
+            for database in (self.file_db, data_retrieval.SQLITE_DB):
+                config.DB = database
+                del self.calls[:]
+                self.assertEqual(range(10, 21), days(
+                    data_retrieval.get_time_series(loader, args(10, 20))))
+                self.assertEqual(range(5, 26), days(
+                    data_retrieval.get_time_series(loader, args(5, 25))))
+                self.assertEqual(3, len(self.calls))
+
+                result = data_retrieval.get_time_series(loader, args(7, 8))
+                self.assertEqual(3, len(self.calls))
+                self.assertEqual([7, 8], days(result))
+                self.assertEqual([7.0, 8.0], [v for _, v in result])
+                data_retrieval.clear_cache(self.cache_id)
+        finally:
+            data_retrieval.get_sqlite().close()
+            config.DB, config.SQLITE_FILE = restore
+            shutil.rmtree(folder)
+
+    def test_range_coverage_limits(self):
+        """
+        Dates from today on aren't marked as fetched, so they're asked for
+        again, while an empty interval in the past isn't, in the file
+        cache and in sqlite
+        """
+        loader = 'download_mock_daily_series'
+        now = datetime.datetime.now()
+        today = datetime.datetime(now.year, now.month, now.day)
+        day = datetime.timedelta(days=1)
+
+        def args(start, end):
+            return {'symbol': 'TGTT', 'start': start, 'end': end}
+
+        self.cache_id = data_retrieval.get_id(loader, args(today, today))
+        folder = tempfile.mkdtemp()
+        restore = (config.DB, config.SQLITE_FILE)
+        config.SQLITE_FILE = os.path.join(folder, 'test.sqlite')
+        try:
+            for database in (self.file_db, data_retrieval.SQLITE_DB):
+                config.DB = database
+                del self.calls[:]
+                for _ in range(2):
+                    data_retrieval.get_time_series(
+                        loader, args(today - 5 * day, today + 5 * day))
+                self.assertEqual([('TGTT', today - 5 * day, today + 5 * day),
+                                  ('TGTT', today, today + 5 * day)],
+                                 self.calls)
+                self.assertEqual([(today - 5 * day, today - day)],
+                                 data_retrieval.get_coverage(self.cache_id))
+
+                # Nothing before: asked for once
+                self.mock_results['TGTT'] = []
+                del self.calls[:]
+                for _ in range(3):
+                    data_retrieval.get_time_series(
+                        loader, args(today - 8 * day, today - 2 * day))
+                self.assertEqual([('TGTT', today - 8 * day, today - 6 * day)],
+                                 self.calls)
+                self.assertEqual([(today - 8 * day, today - day)],
+                                 data_retrieval.get_coverage(self.cache_id))
+                del self.mock_results['TGTT']
+                data_retrieval.clear_cache(self.cache_id)
+        finally:
+            data_retrieval.get_sqlite().close()
+            config.DB, config.SQLITE_FILE = restore
+            shutil.rmtree(folder)
+
+    def test_series_log(self):
+        """
+        Points fetched for a cached series are appended to its log without
+        rewriting it, read back merged, and folded in by compaction
+        """
+        loader = 'download_mock_daily_series'
+
+        def args(end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, 1),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        self.cache_id = data_retrieval.get_id(loader, args(1))
+        cache_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
+        log_file = data_retrieval.get_cache_filename_log(self.cache_id)
+
+        data_retrieval.get_time_series(loader, args(10))
+        log = data_retrieval.read_log(self.cache_id)
+        self.assertEqual((0, segment_store.LOG_DTYPE), (len(log), log.dtype))
+        size = os.path.getsize(cache_file)
+        for end in (11, 12):
+            result = data_retrieval.get_time_series(loader, args(end))
+        self.assertEqual(size, os.path.getsize(cache_file))
+        self.assertEqual(2 * segment_store.LOG_DTYPE.itemsize,
+                         os.path.getsize(log_file))
+
+        data_retrieval.memory_tier.clear()
+        result = data_retrieval.get_time_series(loader, args(12))
+        self.assertEqual(range(1, 13),
+            result[0][data_structure.TIMESERIES].values.tolist())
+
+        data_retrieval.compact_logs()
+        self.assertFalse(os.path.exists(log_file))
+        self.assertIsNone(
+            data_retrieval.get_manifest().get(self.cache_id, 'log'))
+        self.assertEqual(range(1, 13), data_retrieval.get_from_file_cache(
+            self.cache_id)[0][data_structure.TIMESERIES].values.tolist())
+
+    def test_series_log_tuples(self):
+        """
+        A bare list of tuples, as the bloomberg loaders return, is logged
+        as record 0 and read back as a list of tuples
+        """
+        loader = 'download_mock_daily_tuples'
+
+        def args(end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, 1),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        self.cache_id = data_retrieval.get_id(loader, args(1))
+        cache_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
+        log_file = data_retrieval.get_cache_filename_log(self.cache_id)
+
+        data_retrieval.get_time_series(loader, args(10))
+        size = os.path.getsize(cache_file)
+        data_retrieval.get_time_series(loader, args(12))
+        self.assertEqual(size, os.path.getsize(cache_file))
+        self.assertEqual([0, 0], data_retrieval.read_log(
+            self.cache_id)['record'].tolist())
+
+        expected = data_loader.download_mock_daily_tuples(
+            'TGTT', datetime.datetime(2013, 1, 1),
+            datetime.datetime(2013, 1, 12))
+        data_retrieval.memory_tier.clear()
+        self.assertEqual(expected, data_retrieval.get_time_series(
+            loader, args(12)))
+        data_retrieval.compact_logs()
+        self.assertFalse(os.path.exists(log_file))
+        self.assertEqual(expected,
+                         data_retrieval.get_from_file_cache(self.cache_id))
+
+    def test_sqlite_range(self):
+        """
+        With the sqlite database, only the dates not already stored are
+        fetched and the requested range is read back
+        """
+        loader = 'download_mock_daily_series'
+
+        def args(start, end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, start),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        folder = tempfile.mkdtemp()
+        restore_db = config.DB
+        restore_sqlite_file = config.SQLITE_FILE
+        config.DB = data_retrieval.SQLITE_DB
+        config.SQLITE_FILE = os.path.join(folder, 'test.sqlite')
+        try:
+            result = data_retrieval.get_time_series(loader, args(10, 20))
+            self.assertEqual(11, len(result[0][data_structure.TIMESERIES]))
+
+            del self.calls[:]
+            result = data_retrieval.get_time_series(loader, args(5, 12))
+            self.assertEqual([('TGTT', datetime.datetime(2013, 1, 5),
+                               datetime.datetime(2013, 1, 9))], self.calls)
+            self.assertEqual(range(5, 13), result[0][
+                data_structure.TIMESERIES].values.tolist())
+
+            del self.calls[:]
+            data_retrieval.get_time_series(loader, args(6, 7))
+            self.assertEqual([], self.calls)
+            self.assertEqual(16, len(data_retrieval.get_from_cache(
+                loader, args(1, 1))[0][data_structure.TIMESERIES]))
+            data_retrieval.clear_cache()
+        finally:
+            data_retrieval.get_sqlite().close()
+            config.DB = restore_db
+            config.SQLITE_FILE = restore_sqlite_file
+            shutil.rmtree(folder)
+
+    def test_get_time_series_many(self):
+        """
+        Results come back in request order, repeated requests are fetched
+        once, and cached series aren't fetched again
+        """
+        loader = 'download_mock_daily_series'
+
+        def request(symbol):
+            return (loader, {
+                'symbol': symbol,
+                'start': datetime.datetime(2013, 1, 1),
+                'end': datetime.datetime(2013, 1, 10)
+            })
+
+        symbols = ['A', 'BB', 'A', 'CCC']
+        try:
+            results = data_retrieval.get_time_series_many(
+                [request(symbol) for symbol in symbols])
+            self.assertEqual(['A', 'BB', 'CCC'],
+                             sorted(symbol for symbol, _, _ in self.calls))
+            self.assertEqual(symbols, [r[0][data_structure.ID]['symbol']
+                                       for r in results])
+
+            del self.calls[:]
+            results = data_retrieval.get_time_series_many(
+                [request(symbol) for symbol in reversed(symbols)], threads=1)
+            self.assertEqual([], self.calls)
+            self.assertEqual(['CCC', 'A', 'BB', 'A'],
+                             [r[0][data_structure.ID]['symbol']
+                              for r in results])
+        finally:
+            for symbol in set(symbols):
+                data_retrieval.clear_cache(data_retrieval.get_id(
+                    *request(symbol)))
+
+        documents = [{'id': {'symbol': 'A', 'field': 'PX_LAST'}},
+                     {'id': {'symbol': 'B', 'field': 'PX_LAST'}},
+                     {'id': {'symbol': 'A'}}]
+        self.assertEqual(('A', 'PX_LAST'), data_retrieval.query_values(
+            documents[0], ('id.symbol', 'id.field')))
+        self.assertIsNone(data_retrieval.query_values(
+            documents[2], ('id.field',)))
+        index = data_retrieval.index_documents(documents, ('id.symbol',))
+        self.assertEqual([documents[0], documents[2]], index[('A',)])
+        self.assertEqual([documents[1]], index[('B',)])
+
+    def test_single_flight(self):
+        """
+        Concurrent requests for a series that isn't cached call the loader
+        once
+        """
+        loader = 'download_mock_daily_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2013, 1, 1),
+            'end': datetime.datetime(2013, 1, 10)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        self.release = threading.Event()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            data_retrieval.get_time_series(loader, loader_args)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while not self.calls:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(4, len(results))
+        self.assertTrue(all(len(r[0][data_structure.TIMESERIES]) == 10
+                            for r in results))
+
+        # The lock file is shared with other series, not left beside the
+        # series files
+        lock_file = data_retrieval.get_lock_filename(self.cache_id)
+        self.assertTrue(os.path.exists(lock_file))
+        digest = hashlib.sha1(self.cache_id).hexdigest()
+        self.assertEqual(
+            os.path.join(data_retrieval.LOCK_FOLDER, digest[:2] + '.lock'),
+            os.path.relpath(lock_file, self.cache_folder))
+        self.assertFalse(os.path.exists(
+            data_retrieval.get_cache_path(self.cache_id) +
+            data_retrieval.CACHE_EXT_LOCK))
+
+    def test_single_flight_processes(self):
+        """
+        Processes requesting a series that isn't cached call the loader
+        once: the others wait for its lock file and find it in the cache,
+        including when it's written behind
+        """
+        loader = 'download_mock_daily_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2013, 1, 1),
+            'end': datetime.datetime(2013, 1, 10)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        folder = tempfile.mkdtemp()
+        try:
+            for write_behind in (False, True):
+                data_retrieval.clear_cache(self.cache_id)
+                calls_filename = os.path.join(folder, str(write_behind))
+                processes = [multiprocessing.Process(
+                    target=fetch_in_process,
+                    args=(self.cache_folder, write_behind, calls_filename,
+                          loader, loader_args)) for _ in range(2)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                self.assertEqual([0, 0], [p.exitcode for p in processes])
+                with open(calls_filename) as calls:
+                    self.assertEqual(1, len(calls.readlines()))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_negative_cache(self):
+        """
+        A series the loader has nothing for isn't asked for again until
+        its negative cache entry expires or is cleared
+        """
+        loader = 'download_mock_daily_series'
+        self.mock_results = {'TGTT': [], 'FAIL': None}
+
+        def args(symbol, start=None):
+            return {
+                'symbol': symbol,
+                'start': start,
+                'end': datetime.datetime(2013, 1, 10) if start else None
+            }
+
+        def called():
+            return [symbol for symbol, _, _ in self.calls]
+
+        restore_negative_ttl = config.NEGATIVE_TTL
+        config.NEGATIVE_TTL = {negative_cache.EMPTY: 100,
+                               negative_cache.FAILED: 0}
+        try:
+            for _ in range(2):
+                self.assertIsNone(data_retrieval.get_time_series(
+                    loader, args('TGTT')))
+                self.assertIsNone(data_retrieval.get_time_series(
+                    loader, args('TGTT', datetime.datetime(2013, 1, 1))))
+                self.assertIsNone(data_retrieval.get_time_series(
+                    loader, args('FAIL')))
+            self.assertEqual(['TGTT', 'FAIL', 'FAIL'], called())
+
+            miss = data_retrieval.get_negative_cache().get(
+                data_retrieval.get_id(loader, args('TGTT')))
+            self.assertEqual(negative_cache.EMPTY, miss['reason'])
+
+            data_retrieval.clear_misses(negative_cache.EMPTY)
+            self.assertIsNone(data_retrieval.get_time_series(
+                loader, args('TGTT')))
+            self.assertEqual(['TGTT', 'FAIL', 'FAIL', 'TGTT'], called())
+            data_retrieval.clear_misses()
+
+            # A miss for a range only covers requests within it
+            self.mock_results['GAP'] = []
+            del self.calls[:]
+            for start, end in [(1, 31), (5, 10), (1, 31)]:
+                self.assertIsNone(data_retrieval.get_time_series(loader, {
+                    'symbol': 'GAP',
+                    'start': datetime.datetime(2013, 1, start),
+                    'end': datetime.datetime(2013, 1, end)
+                }))
+            self.assertIsNone(data_retrieval.get_time_series(loader, {
+                'symbol': 'GAP',
+                'start': datetime.datetime(2013, 6, 1),
+                'end': datetime.datetime(2013, 6, 30)
+            }))
+            self.assertEqual([datetime.datetime(2013, 1, 1),
+                              datetime.datetime(2013, 6, 1)],
+                             [start for _, start, _ in self.calls])
+            data_retrieval.clear_misses()
+        finally:
+            config.NEGATIVE_TTL = restore_negative_ttl
+
+    def test_manifest(self):
+        """
+        The manifest tracks writes and removals, clear_cache works from
+        another directory, and a rebuild picks up changes made by hand
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        data_retrieval.get_time_series(loader, loader_args)
+
+        entry = data_retrieval.get_manifest().get(self.cache_id, 'pickle')
+        cache_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
+        self.assertEqual(os.path.getsize(cache_file), entry['size'])
+        self.assertEqual(loader, entry['loader'])
+        self.assertEqual([(loader_args['start'], loader_args['end'])],
+                         entry['coverage'])
+        self.assertIn(((self.cache_id, 'pickle'), entry),
+                      data_retrieval.list_cache('pickle'))
+        self.assertTrue(data_retrieval.cache_stats()['files'] >= 2)
+        self.assertEqual([], data_retrieval.verify_cache())
+
+        # Drift: the file is removed by hand, then a rebuild catches up
+        os.remove(cache_file)
+        self.assertEqual([(self.cache_id, 'pickle')],
+                         data_retrieval.verify_cache())
+        data_retrieval.rebuild_manifest()
+        self.assertIsNone(
+            data_retrieval.get_manifest().get(self.cache_id, 'pickle'))
+        # ...but keeps the coverage from the file next to the series
+        self.assertIsNotNone(
+            data_retrieval.get_manifest().get(self.cache_id, 'coverage'))
+
+        # Rewrite the series and clear everything from another directory
+        data_retrieval.get_time_series(loader, loader_args)
+        cwd = os.getcwd()
+        config.CACHE_FOLDER = os.path.abspath(self.cache_folder)
+        os.chdir(tempfile.gettempdir())
+        try:
+            data_retrieval.clear_cache()
+        finally:
+            os.chdir(cwd)
+            config.CACHE_FOLDER = self.cache_folder
+        data_retrieval.manifests.clear()
+        self.assertFalse(os.path.exists(cache_file))
+        self.assertEqual(0, data_retrieval.cache_stats()['files'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_folder, 'dummy_test_file.py')))
+
+    def test_retention(self):
+        """
+        Expired series are cache misses, and the byte cap evicts the least
+        recently read series
+        """
+        loader = 'download_mock_series'
+
+        def args(symbol):
+            return {
+                'symbol': symbol,
+                'start': datetime.datetime(2012, 11, 11),
+                'end': datetime.datetime(2013, 11, 11)
+            }
+
+        restore = (config.CACHE_TTL, config.CACHE_MAX_BYTES)
+        ids = [data_retrieval.get_id(loader, args(s)) for s in 'ABC']
+        try:
+            for symbol in 'ABC':
+                data_retrieval.get_time_series(loader, args(symbol))
+            manifest = data_retrieval.get_manifest()
+
+            # B was read least recently
+            for id in ids:
+                for format in ('pickle', 'coverage'):
+                    entry = dict(manifest.get(id, format))
+                    entry['written'] = entry['accessed'] = 0
+                    manifest.put(id, format, entry)
+            data_retrieval.memory_tier.clear()
+            manifest.touch(ids[0], 'pickle', 1000)
+            manifest.touch(ids[2], 'pickle', 500)
+
+            sizes = [manifest.get(id, 'pickle')['size'] +
+                     manifest.get(id, 'coverage')['size'] for id in ids]
+            config.CACHE_MAX_BYTES = sum(sizes) - 1
+            self.assertEqual([ids[1]], data_retrieval.enforce_retention(2000))
+            self.assertFalse(data_retrieval.get_from_cache(loader, args('B')))
+            self.assertTrue(data_retrieval.get_from_cache(loader, args('A')))
+
+            config.CACHE_MAX_BYTES = 0
+            config.CACHE_TTL = {loader: 60}
+            data_retrieval.memory_tier.clear()
+            self.assertFalse(data_retrieval.get_from_cache(loader, args('C')))
+            self.assertIsNone(manifest.get(ids[2], 'coverage'))
+        finally:
+            config.CACHE_TTL, config.CACHE_MAX_BYTES = restore
+            for id in ids:
+                data_retrieval.clear_cache(id)
+
+    def test_retention_appended(self):
+        """
+        A series expires on the latest write of any of its files, so
+        points appended to its log keep it current for reads and for the
+        retention pass alike
+        """
+        loader = 'download_mock_daily_series'
+
+        def args(end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, 1),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        restore = config.CACHE_TTL
+        self.cache_id = data_retrieval.get_id(loader, args(1))
+        try:
+            data_retrieval.get_time_series(loader, args(10))
+            data_retrieval.get_time_series(loader, args(12))
+            manifest = data_retrieval.get_manifest()
+            self.assertIsNotNone(manifest.get(self.cache_id, 'log'))
+            entry = dict(manifest.get(self.cache_id, config.SERIALISER))
+            entry['written'] = 0
+            manifest.put(self.cache_id, config.SERIALISER, entry)
+            data_retrieval.memory_tier.clear()
+
+            config.CACHE_TTL = {loader: 60}
+            self.assertEqual([], data_retrieval.enforce_retention())
+            self.assertTrue(data_retrieval.get_from_cache(loader, args(12)))
+            self.assertIsNotNone(
+                manifest.get(self.cache_id, config.SERIALISER))
+        finally:
+            config.CACHE_TTL = restore
+            data_retrieval.clear_cache(self.cache_id)
+
+    def test_write_behind(self):
+        """
+        With write behind on, a series is readable straight after it's
+        fetched and is on disk once the writes are flushed
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        config.WRITE_BEHIND = True
+        try:
+            data_retrieval.get_time_series(loader, loader_args)
+            data_retrieval.memory_tier.clear()
+            cached = data_retrieval.get_from_cache(loader, loader_args)
+            self.assertEqual(loader_args, cached[0][data_structure.ID])
+
+            data_retrieval.flush_cache_writes()
+            self.assertIsNone(data_retrieval.get_pending_write(self.cache_id))
+            self.assertTrue(os.path.exists(
+                data_retrieval.get_cache_filename_pickle(self.cache_id)))
+            self.assertEqual(
+                [(loader_args['start'], loader_args['end'])],
+                data_retrieval.get_coverage(self.cache_id))
+        finally:
+            config.WRITE_BEHIND = False
+
+    def test_write_behind_latency(self):
+        """
+        A fetch written behind returns without waiting for the series to
+        be serialised, and lets go of its lock file once it's on disk
+        """
+        loader = 'download_mock_daily_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2013, 1, 1),
+            'end': datetime.datetime(2013, 1, 10)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        serialise = data_retrieval.utils.serialise_obj
+        written = threading.Event()
+
+        def slow_serialise(*args, **kwargs):
+            written.wait(5)
+            return serialise(*args, **kwargs)
+
+        data_retrieval.utils.serialise_obj = slow_serialise
+        config.WRITE_BEHIND = True
+        try:
+            begin = time.time()
+            data_retrieval.get_time_series(loader, loader_args)
+            self.assertLess(time.time() - begin, 1)
+            self.assertIsNotNone(
+                data_retrieval.get_pending_write(self.cache_id))
+
+            acquired = threading.Event()
+
+            def lock():
+                with single_flight.FileLock(
+                        data_retrieval.get_lock_filename(self.cache_id)):
+                    acquired.set()
+
+            thread = threading.Thread(target=lock)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+            written.set()
+            self.assertTrue(acquired.wait(5))
+            thread.join()
+            self.assertTrue(os.path.exists(
+                data_retrieval.get_cache_filename_pickle(self.cache_id)))
+        finally:
+            written.set()
+            data_retrieval.flush_cache_writes()
+            data_retrieval.utils.serialise_obj = serialise
+            config.WRITE_BEHIND = False
+
+    def test_shard_layout(self):
+        """
+        Cache files go in subdirectories named after the id's hash, found
+        by a rebuild of the manifest, and a cache can be moved between
+        layouts
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        ts = data_loader.download_mock_series(**loader_args)
+        cache_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
+        digest = hashlib.sha1(self.cache_id).hexdigest()
+        self.assertEqual(os.path.join(self.cache_folder, digest[:2],
+                                      digest[2:4], self.cache_id + '.pickle'),
+                         cache_file)
+
+        data_retrieval.write_to_cache(loader, loader_args, ts)
+        self.assertTrue(os.path.exists(cache_file))
+        data_retrieval.rebuild_manifest()
+        self.assertEqual(ts, data_retrieval.get_from_cache(loader, loader_args))
+
+        config.CACHE_SHARD_LEVELS = 0
+        try:
+            self.assertEqual(1, data_retrieval.migrate_cache())
+            flat_file = data_retrieval.get_cache_filename_pickle(self.cache_id)
+            self.assertTrue(os.path.exists(flat_file))
+            self.assertFalse(os.path.exists(os.path.join(self.cache_folder,
+                                                         digest[:2])))
+            data_retrieval.memory_tier.clear()
+            self.assertEqual(ts, data_retrieval.get_from_cache(loader,
+                                                               loader_args))
+        finally:
+            config.CACHE_SHARD_LEVELS = 2
+        self.assertEqual(1, data_retrieval.migrate_cache())
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertEqual(0, data_retrieval.migrate_cache())
+
+    def test_npy_extension(self):
+        """
+        npy cache files aren't named like numpy's own files, and files with
+        the old extension are found and renamed by a migration
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        ts = [data_structure.create_time_series(
+            {'symbol': 'TGTT'}, TestColumnarTimeSeries.ts, {})]
+        cache_file = data_retrieval.get_cache_filename_npy(self.cache_id)
+        self.assertTrue(cache_file.endswith('.tsn'))
+
+        legacy_file = os.path.splitext(cache_file)[0] + '.npy'
+        data_retrieval.make_cache_dir(legacy_file)
+        utils.npy_serialise_obj(ts, legacy_file)
+        data_retrieval.rebuild_manifest()
+        self.assertEqual(1, data_retrieval.migrate_cache())
+        self.assertFalse(os.path.exists(legacy_file))
+        self.assertEqual(timeseries.TimeSeries.from_tuples(
+            TestColumnarTimeSeries.ts), utils.npy_deserialise_obj(
+                cache_file)[0][data_structure.TIMESERIES])
+
+    def test_compression(self):
+        """
+        Series are written with the configured codec, read back with the
+        codec they were written with, and rewritten files replace files
+        with another codec
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        ts = data_loader.download_mock_series(**loader_args)
+        gz_file = (data_retrieval.get_cache_filename_pickle(self.cache_id) +
+                   '.gz')
+        config.COMPRESSION = compression.GZIP
+        try:
+            data_retrieval.write_to_cache(loader, loader_args, ts)
+        finally:
+            config.COMPRESSION = compression.NONE
+        self.assertTrue(os.path.exists(gz_file))
+
+        data_retrieval.rebuild_manifest()
+        self.assertEqual(ts, data_retrieval.get_from_cache(loader, loader_args))
+
+        data_retrieval.write_to_cache(loader, loader_args, ts)
+        self.assertFalse(os.path.exists(gz_file))
+        self.assertEqual(ts, data_retrieval.get_from_cache(loader, loader_args))
+
+    def test_stats_cache(self):
+        """
+        The statistics accumulator round trips through the file cache
+        """
+        loader = 'download_mock_series'
+        loader_args = {
+            'symbol': 'TGTT',
+            'start': datetime.datetime(2012, 11, 11),
+            'end': datetime.datetime(2013, 11, 11)
+        }
+        self.cache_id = data_retrieval.get_id(loader, loader_args)
+        self.assertIsNone(
+            data_retrieval.get_stats_from_cache(loader, loader_args))
+
+        acc = accumulators.accumulate(TestColumnarTimeSeries.ts)
+        data_retrieval.write_stats_to_cache(loader, loader_args, acc)
+        cached = data_retrieval.get_stats_from_cache(loader, loader_args)
+        self.assertEqual(acc.to_dict(), cached.to_dict())
+
+        data_retrieval.clear_cache(self.cache_id)
+        self.assertIsNone(
+            data_retrieval.get_stats_from_cache(loader, loader_args))
+
+    def test_stats_follow_series(self):
+        """
+        The statistics accumulator is updated with points appended to the
+        series, removed if they don't come after it, and recomputed when
+        the series is rewritten
+        """
+        loader = 'download_mock_daily_series'
+
+        def args(start, end):
+            return {
+                'symbol': 'TGTT',
+                'start': datetime.datetime(2013, 1, start),
+                'end': datetime.datetime(2013, 1, end)
+            }
+
+        def stats():
+            return data_retrieval.get_stats_from_cache(loader, args(1, 1))
+
+        def series(start, end):
+            return data_retrieval.get_from_cache(
+                loader, args(start, end))[0][data_structure.TIMESERIES]
+
+        self.cache_id = data_retrieval.get_id(loader, args(1, 1))
+        data_retrieval.get_time_series(loader, args(5, 10))
+        data_retrieval.write_stats_to_cache(
+            loader, args(1, 1), accumulators.accumulate(series(5, 10)))
+
+        data_retrieval.get_time_series(loader, args(5, 12))
+        self.assertTrue(os.path.exists(
+            data_retrieval.get_cache_filename_log(self.cache_id)))
+        self.assertEqual(accumulators.accumulate(series(5, 12)).to_dict(),
+                         stats().to_dict())
+
+        data_retrieval.get_time_series(loader, args(1, 12))
+        self.assertIsNone(stats())
+
+        data_retrieval.write_stats_to_cache(
+            loader, args(1, 1), accumulators.StatsAccumulator())
+        rewritten = data_loader.download_mock_daily_series(
+            'TGTT', datetime.datetime(2013, 1, 1),
+            datetime.datetime(2013, 1, 20))
+        data_retrieval.write_to_cache(loader, args(1, 20), rewritten)
+        self.assertEqual(accumulators.accumulate(
+            rewritten[0][data_structure.TIMESERIES]).to_dict(),
+            stats().to_dict())
+
+
+class TestDataStructureFunctions(unittest.TestCase):
+    def test_slice_time_series(self):
+        ts = timeseries.TimeSeries.from_tuples(TestColumnarTimeSeries.ts)
+        records = [
+            data_structure.create_time_series({'symbol': 'A'}, ts, {}),
+            data_structure.create_time_series({'symbol': 'B'}, [], {})
+        ]
+        result = data_structure.slice_time_series(
+            records, datetime.datetime(2013, 11, 6), None)
+
+        self.assertEqual(ts.between(datetime.datetime(2013, 11, 6)),
+                         result[0][data_structure.TIMESERIES])
+        self.assertEqual(records[0][data_structure.ID],
+                         result[0][data_structure.ID])
+        self.assertEqual(records[1], result[1])
+        # The original records are untouched
+        self.assertEqual(len(ts), len(records[0][data_structure.TIMESERIES]))
+
+        # Lists of (date, value) tuples are sliced too, bare or in records
+        tuples = TestColumnarTimeSeries.ts
+        start = datetime.datetime(2013, 11, 4)
+        end = datetime.datetime(2013, 11, 7)
+        self.assertEqual(tuples[2:6], data_structure.slice_time_series(
+            tuples, start, end))
+        self.assertEqual(tuples[2:6], data_structure.slice_time_series(
+            [data_structure.create_time_series({}, tuples, {})], start,
+            end)[0][data_structure.TIMESERIES])
+        self.assertEqual(ts[2:6], data_structure.slice_time_series(
+            ts, start, end))
+
+    def test_slice_tuples(self):
+        """
+        Lists of tuples are sliced by binary search of the dates
+        """
+        class Points(list):
+            reads = 0
+
+            def __getitem__(self, i):
+                Points.reads += 1
+                return list.__getitem__(self, i)
+
+        first = datetime.datetime(2000, 1, 1)
+        tuples = Points((first + datetime.timedelta(days=n), float(n))
+                        for n in range(100000))
+        self.assertTrue(data_structure.is_point_list(tuples))
+        Points.reads = 0
+        result = data_structure.slice_series(
+            tuples, first + datetime.timedelta(days=10, hours=1),
+            first + datetime.timedelta(days=20))
+        self.assertEqual(range(11, 21), [v for _, v in result])
+        self.assertLess(Points.reads, 50)
+
+        self.assertEqual(tuples[99990:], data_structure.slice_series(
+            tuples, first + datetime.timedelta(days=99990), None))
+        self.assertEqual(tuples[:1], data_structure.slice_series(
+            tuples, None, first))
+        self.assertEqual([], data_structure.slice_series(
+            tuples, datetime.datetime(2500, 1, 1), None))
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        """
+        The least recently used entries are evicted to stay in budget
+        """
+        value = 'x' * 1000
+        size = memory_cache.size_of(value)
+        cache = memory_cache.LRUCache(max_bytes=3 * size)
+
+        for key in 'abc':
+            cache.put(key, value)
+        self.assertEqual(value, cache.get('a'))
+
+        # b is now the least recently used
+        cache.put('d', value)
+        self.assertIsNone(cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(value, cache.get(key))
+
+        cache.invalidate('c')
+        self.assertIsNone(cache.get('c'))
+
+        # Too large to ever fit
+        cache.put('e', value * 10)
+        self.assertIsNone(cache.get('e'))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual(2 * size, stats['bytes'])
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+
+        cache.clear()
+        self.assertEqual(0, cache.stats()['bytes'])
+
+    def test_size_of_timeseries(self):
+        ts = timeseries.TimeSeries.from_tuples(TestColumnarTimeSeries.ts)
+        self.assertTrue(memory_cache.size_of(ts) >=
+                        ts.dates.nbytes + ts.values.nbytes)
+
+    def test_isolation(self):
+        """
+        Changing a value put in or got from the cache doesn't change the
+        cached value, and cached arrays are read only
+        """
+        ts = timeseries.TimeSeries.from_tuples(TestColumnarTimeSeries.ts)
+        value = [data_structure.create_time_series({'symbol': 'A'}, ts, {}),
+                 list(TestColumnarTimeSeries.ts)]
+        expected = copy.deepcopy(value)
+        cache = memory_cache.LRUCache(max_bytes=1 << 20)
+        cache.put('a', value)
+
+        ts.values[0] = 100.0
+        value[1].append(value[1][0])
+        got = cache.get('a')
+        self.assertEqual(expected, got)
+
+        got[0][data_structure.ID]['symbol'] = 'B'
+        del got[1][:]
+        self.assertEqual(expected, cache.get('a'))
+        cached = cache.get('a')[0][data_structure.TIMESERIES]
+        self.assertRaises(ValueError, cached.values.__setitem__, 0, 1.0)
+
+        # Points aren't copied, only the lists holding them
+        got = cache.get('a')
+        self.assertIsNot(got[1], cache.get('a')[1])
+        self.assertIs(got[1][0], cache.get('a')[1][0])
+
+
+class TestRangeCache(unittest.TestCase):
+    d = [datetime.datetime(2013, 1, n) for n in range(1, 32)]
+
+    def test_merge_intervals(self):
+        d = self.d
+        self.assertEqual([(d[0], d[9]), (d[20], d[25])],
+                         range_cache.merge_intervals(
+                             [(d[20], d[25]), (d[5], d[9]), (d[0], d[4]),
+                              (d[2], d[3])]))
+
+    def test_missing_intervals(self):
+        d = self.d
+        coverage = [(d[5], d[9]), (d[15], d[19])]
+        self.assertEqual([(d[0], d[4]), (d[10], d[14]), (d[20], d[25])],
+                         range_cache.missing_intervals(coverage, d[0], d[25]))
+        self.assertEqual([], range_cache.missing_intervals(coverage,
+                                                           d[6], d[8]))
+        self.assertEqual([(d[10], d[12])],
+                         range_cache.missing_intervals(coverage, d[7], d[12]))
+        self.assertEqual([(d[0], d[3])],
+                         range_cache.missing_intervals([], d[0], d[3]))
+
+    def test_covered_interval(self):
+        d = self.d
+        now = datetime.datetime(2013, 1, 10, 15, 30)
+        self.assertEqual((d[0], d[4]),
+                         range_cache.covered_interval(d[0], d[4], now))
+        self.assertEqual((d[0], d[8]),
+                         range_cache.covered_interval(d[0], d[20], now))
+        self.assertIsNone(range_cache.covered_interval(d[9], d[20], now))
+
+    def test_merge_series(self):
+        d = self.d
+        old = timeseries.TimeSeries(d[0:3], [1.0, 2.0, 3.0])
+        new = timeseries.TimeSeries(d[2:4], [30.0, 4.0])
+        merged = range_cache.merge_series(old, new)
+        self.assertEqual(d[0:4], [dt for dt, v in merged])
+        self.assertEqual([1.0, 2.0, 30.0, 4.0], merged.values.tolist())
+
+        self.assertEqual([(d[0], 'a'), (d[1], 'c')],
+                         range_cache.merge_series([(d[0], 'a'), (d[1], 'b')],
+                                                  [(d[1], 'c')]))
+
+
+class TestCacheManifest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def entry(self, size):
+        return {'path': 'x', 'format': 'pickle', 'size': size,
+                'checksum': 0, 'loader': None, 'coverage': None,
+                'written': 0, 'accessed': 0}
+
+    def test_journal(self):
+        """
+        Changes are replayed from the journal, ignoring a partial record
+        at its end
+        """
+        manifest = cache_manifest.Manifest(self.folder)
+        manifest.put('a', 'pickle', self.entry(10))
+        manifest.put('a', 'stats', self.entry(1))
+        manifest.put('b', 'pickle', self.entry(20))
+        manifest.remove('b', 'pickle')
+        self.assertFalse(manifest.exists())
+
+        with open(manifest.journal_filename(), 'ab') as f:
+            f.write('\x05\x00')
+
+        reread = cache_manifest.Manifest(self.folder)
+        reread.load()
+        self.assertEqual(manifest.entries, reread.entries)
+        self.assertEqual({'files': 2, 'bytes': 11,
+                          'formats': {'pickle': {'files': 1, 'bytes': 10},
+                                      'stats': {'files': 1, 'bytes': 1}}},
+                         reread.stats())
+
+        self.assertEqual(11, reread.bytes)
+
+        # Reads update access times once per ACCESS_RESOLUTION, in memory
+        length = reread.journal_length
+        reread.touch('a', 'pickle', 100)
+        reread.touch('a', 'pickle', 101)
+        self.assertEqual(100, reread.get('a', 'pickle')['accessed'])
+        self.assertEqual(length, reread.journal_length)
+
+        # The partial record is dropped by the next write, so the other
+        # instance reads past it when a lookup misses
+        reread.put('c', 'pickle', self.entry(30))
+        self.assertEqual(30, manifest.get('c', 'pickle')['size'])
+        self.assertEqual(0, manifest.get('a', 'pickle')['accessed'])
+
+        # and access times are written with the next snapshot
+        reread.touch('a', 'pickle', 100 + cache_manifest.ACCESS_RESOLUTION)
+        reread.compact()
+        manifest.update()
+        self.assertEqual(100 + cache_manifest.ACCESS_RESOLUTION,
+                         manifest.get('a', 'pickle')['accessed'])
+
+        self.assertEqual(2, len(reread.remove_id('a')))
+        self.assertEqual(['c'], [id for (id, _), _ in reread.items()])
+
+    def test_compact(self):
+        manifest = cache_manifest.Manifest(self.folder)
+        for i in range(cache_manifest.COMPACT_THRESHOLD + 1):
+            manifest.put(str(i), 'pickle', self.entry(i))
+        self.assertTrue(manifest.exists())
+        self.assertFalse(os.path.exists(manifest.journal_filename()))
+
+        manifest.clear()
+        reread = cache_manifest.Manifest(self.folder)
+        reread.load()
+        self.assertEqual({}, reread.entries)
+
+    def test_shared(self):
+        """
+        Changes made through another instance, as by another process, are
+        seen by lookups and kept by snapshots
+        """
+        manifest = cache_manifest.Manifest(self.folder)
+        other = cache_manifest.Manifest(self.folder)
+        manifest.put('a', 'pickle', self.entry(10))
+        other.put('b', 'pickle', self.entry(20))
+        self.assertEqual(20, manifest.get('b', 'pickle')['size'])
+        self.assertEqual(10, other.get('a', 'pickle')['size'])
+
+        manifest.compact()
+        other.put('c', 'pickle', self.entry(30))
+        other.remove('a', 'pickle')
+        self.assertEqual(['b', 'c'],
+                         sorted(id for (id, _), _ in manifest.items()))
+        self.assertEqual(50, manifest.bytes)
+
+        other.compact()
+        manifest.put('d', 'pickle', self.entry(40))
+        reread = cache_manifest.Manifest(self.folder)
+        reread.load()
+        self.assertEqual(manifest.entries, reread.entries)
+        self.assertEqual(manifest.entries, dict(other.items()))
+
+    def test_checksum(self):
+        filename = os.path.join(self.folder, 'f')
+        with open(filename, 'wb') as f:
+            f.write('abc')
+        self.assertEqual(0x352441c2, cache_manifest.file_checksum(filename))
+
+
+class TestCacheRetention(unittest.TestCase):
+    def item(self, id, format, loader, size, written, accessed):
+        return ((id, format), {'loader': loader, 'size': size,
+                               'written': written, 'accessed': accessed})
+
+    def test_select_evictions(self):
+        ttls = {'yahoo': 100}
+        ttl = lambda loader: ttls.get(loader, 0)
+        items = [
+            self.item('a', 'pickle', 'yahoo', 10, 0, 50),
+            self.item('a', 'stats', None, 1, 0, 50),
+            self.item('b', 'pickle', 'bbg', 10, 0, 10),
+            self.item('c', 'pickle', 'bbg', 10, 0, 30),
+            self.item('d', 'pickle', 'yahoo', 10, 150, 20),
+        ]
+        # a has expired, b has no time to live
+        self.assertEqual(['a'],
+                         cache_retention.select_evictions(items, 200, 0, ttl))
+        # then least recently accessed first, b before d, until they fit
+        # in LOW_WATER of the cap
+        self.assertEqual(['a', 'b', 'd'], sorted(
+            cache_retention.select_evictions(items, 200, 12, ttl)))
+        # b, c and d fit in 30 bytes; once over, they're brought down to
+        # LOW_WATER of the cap, not just under it
+        self.assertEqual(['a'],
+                         cache_retention.select_evictions(items, 200, 30, ttl))
+        self.assertEqual(['a', 'b'], sorted(
+            cache_retention.select_evictions(items, 200, 29, ttl)))
+
+        ttl = lambda loader: ttls.get(loader, 150)
+        self.assertEqual(['a', 'b', 'c'], sorted(
+            cache_retention.select_evictions(items, 200, 0, ttl)))
+
+    def test_compactor(self):
+        passes = []
+        done = threading.Event()
+
+        def compaction_pass():
+            passes.append(1)
+            if len(passes) == 2:
+                done.set()
+            raise IOError('failing passes are logged and retried')
+
+        compactor = cache_retention.Compactor(compaction_pass, 0.01)
+        compactor.start()
+        self.assertTrue(done.wait(5))
+        compactor.stop()
+        compactor.join(5)
+        self.assertFalse(compactor.is_alive())
+
+
+class TestWriteBehind(unittest.TestCase):
+    def test_queue(self):
+        """
+        Queued values are readable until written, and a failing write
+        doesn't stop the queue
+        """
+        queue = write_behind.WriteBehindQueue(2)
+        release = threading.Event()
+        written = []
+
+        def write(value):
+            release.wait(5)
+            written.append(value)
+
+        def fail():
+            raise IOError('disk full')
+
+        queue.put('a', 1, fail)
+        queue.put('a', 2, functools.partial(write, 2))
+        queue.put('b', 3, functools.partial(write, 3))
+        self.assertEqual(2, queue.get('a'))
+        self.assertEqual(3, queue.get('b'))
+
+        release.set()
+        queue.flush()
+        self.assertEqual([2, 3], written)
+        self.assertIsNone(queue.get('a'))
+        self.assertIsNone(queue.get('b'))
+
+    def test_atomic_serialise(self):
+        """
+        A failed write leaves the previous file as it was
+        """
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'obj.pickle')
+            utils.atomic_serialise(utils.serialise_obj, [1, 2], filename)
+
+            def fail(obj, filename):
+                with open(filename, 'wb') as f:
+                    f.write('trunc')
+                raise IOError('crash')
+
+            self.assertRaises(IOError, utils.atomic_serialise, fail, [3],
+                              filename)
+            self.assertEqual([1, 2], utils.deserialise_obj(filename))
+            self.assertEqual(['obj.pickle'], os.listdir(folder))
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        """
+        Every serialiser reads back what it wrote with every codec
+        """
+        ts = [(datetime.datetime(2013, 11, d), float(d)) for d in range(1, 20)]
+        csv_ts = [(d, (repr(v),)) for d, v in ts]
+        serialisers = [
+            (utils.serialise_obj, utils.deserialise_obj, ts),
+            (utils.s_serialise_obj, utils.s_deserialise_obj, ts),
+            (utils.serialise_csv, utils.deserialise_csv, csv_ts)
+        ]
+        folder = tempfile.mkdtemp()
+        try:
+            for codec in compression.available_codecs():
+                opener = compression.opener(codec)
+                for i, (serialise, deserialise, obj) in enumerate(serialisers):
+                    filename = os.path.join(
+                        folder, str(i) + compression.extension(codec))
+                    serialise(obj, filename, opener=opener)
+                    self.assertEqual(obj, deserialise(filename, opener))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_extensions(self):
+        self.assertEqual(('a.pickle', compression.GZIP),
+                         compression.split_extension('a.pickle.gz'))
+        self.assertEqual(('a.pickle', compression.NONE),
+                         compression.split_extension('a.pickle'))
+        self.assertRaises(ValueError, compression.opener, 'zip')
+
+
+class TestGorilla(unittest.TestCase):
+    def round_trip(self, dates, values, unit=1):
+        encoder = gorilla.Encoder(unit)
+        for d, v in zip(dates, values):
+            encoder.append(d, v)
+        decoded = list(gorilla.decode(encoder.getvalue(), len(dates), unit))
+        self.assertEqual(dates, [d for d, _ in decoded])
+        self.assertEqual([gorilla.float_bits(v) for v in values],
+                         [v for _, v in decoded])
+        return encoder.getvalue()
+
+    def test_encode_decode(self):
+        """
+        Every size of date gap and every kind of float round trips
+        """
+        gaps = [1, 1, 3, 1, -70, 300, 4000, 2 ** 40, 1, 0]
+        dates = [-5]
+        for gap in gaps:
+            dates.append(dates[-1] + gap)
+        values = [1.0, 1.0, 1.5, float('nan'), float('inf'), -0.0, 1e-300,
+                  1e300, 1e300, 2.0, -3.25]
+        self.round_trip(dates, values)
+
+        self.assertRaises(ValueError, self.round_trip, [0, 3], [1.0, 1.0], 2)
+
+    def test_compact(self):
+        """
+        A regular series of repeated values costs a bit per date and value
+        """
+        day = 86400 * 10 ** 6
+        n = 1000
+        encoded = self.round_trip([i * day for i in range(n)], [1.5] * n, day)
+        # The first point in full, then a 9 bit first delta, then 1 bit for
+        # each unchanged delta and value
+        bits = 9 + 1 + 2 * (n - 2)
+        self.assertEqual(16 + int(math.ceil(bits / 8.0)), len(encoded))
+
+    def test_decimal_places(self):
+        self.assertEqual(2, gorilla.decimal_places(
+            numpy.array([123.45, 0.1, float('nan'), 7.0])))
+        self.assertEqual(0, gorilla.decimal_places(numpy.array([1.0, 2.0])))
+        self.assertIsNone(gorilla.decimal_places(numpy.array([math.pi])))
+
+
+class TestSegmentStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'series.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def series(self, days, values):
+        return timeseries.TimeSeries(
+            [datetime.datetime(2013, 1, d) for d in days], values)
+
+    def test_append_read(self):
+        """
+        Later points replace earlier ones on the same date, and a record cut
+        short at the end of the log is ignored
+        """
+        segment_store.append(self.filename, [self.series([1, 2], [1.0, 2.0])])
+        segment_store.append(self.filename, [self.series([2, 3], [5.0, 3.0])])
+        with open(self.filename, 'ab') as f:
+            f.write('\x00' * 7)
+
+        entries = segment_store.read_all(self.filename)
+        self.assertEqual(4, len(entries))
+        ts = segment_store.log_series(entries, 0)
+        self.assertEqual(self.series([1, 2, 3], [1.0, 5.0, 3.0]), ts)
+
+    def test_merge(self):
+        """
+        Logged points are merged into the records they line up with, and a
+        log being compacted is still read
+        """
+        records = [
+            data_structure.create_time_series(
+                {'symbol': s}, self.series([1, 2], [1.0, 2.0]), {})
+            for s in ('A', 'B')]
+        segment_store.append(self.filename, [self.series([3], [3.0]),
+                                             self.series([], [])])
+        compacting = segment_store.start_compaction(self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+        segment_store.append(self.filename, [self.series([2], [4.0]),
+                                             self.series([], [])])
+
+        merged = segment_store.merge(
+            records, segment_store.read_all(self.filename))
+        self.assertEqual(self.series([1, 2, 3], [1.0, 4.0, 3.0]),
+                         merged[0][data_structure.TIMESERIES])
+        self.assertIs(records[1], merged[1])
+        self.assertEqual(1, len(segment_store.read(compacting)))
+
+        self.assertTrue(segment_store.can_append(records, records))
+        self.assertFalse(segment_store.can_append(records, records[:1]))
+
+
+class TestDateParse(unittest.TestCase):
+    def test_parse(self):
+        """
+        The fast parsers agree with strptime on each of their formats,
+        including single digit google days and two digit years either side
+        of the century pivot
+        """
+        texts = {
+            dateparse.ISO_DATETIME: ['2013-11-11 00:00:00',
+                                     '1999-02-28 23:59:59'],
+            dateparse.ISO_DATE: ['2013-11-11', '1962-01-02'],
+            dateparse.DAY_MONTH_YEAR: ['11-Nov-13', '8-Nov-13', '1-Jan-69',
+                                       '31-Dec-68'],
+            '%d/%m/%Y': ['11/11/2013']
+        }
+        for format, column in texts.iteritems():
+            expected = [datetime.datetime.strptime(text, format)
+                        for text in column]
+            parse = dateparse.parser(format)
+            self.assertEqual(expected, [parse(text) for text in column])
+            self.assertEqual(expected, [parse(text) for text in column])
+            self.assertEqual(expected,
+                             dateparse.parse_array(column, format).tolist())
+
+    def test_invalid(self):
+        """
+        Invalid dates raise ValueError, as for strptime
+        """
+        for text, format in [('2013-02-29', dateparse.ISO_DATE),
+                             ('2013-11-11', dateparse.ISO_DATETIME),
+                             ('2013-11-11 24:00:00', dateparse.ISO_DATETIME),
+                             ('11-Foo-13', dateparse.DAY_MONTH_YEAR)]:
+            self.assertRaises(ValueError, dateparse.parse, text, format)
+            self.assertRaises(ValueError, dateparse.parse_array,
+                              ['2013-01-01', text], format)
+
+
+class TestSQLiteDB(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.client = sqlite_db.SQLiteClient(
+            os.path.join(self.folder, 'test.sqlite'))
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.folder)
+
+    def records(self, days, values):
+        return [data_structure.create_time_series(
+            {'symbol': 'TGTT'}, timeseries.TimeSeries(
+                [datetime.datetime(2013, 1, d) for d in days], values), {})]
+
+    def test_put_get(self):
+        """
+        Records round trip, NaNs included, and date ranges are filtered
+        in the query
+        """
+        records = self.records([1, 2, 3], [1.0, float('nan'), 3.0])
+        self.client.put('a', 'loader', {'symbol': 'TGTT'}, records,
+                        [(datetime.datetime(2013, 1, 1),
+                          datetime.datetime(2013, 1, 3))])
+        result = self.client.get('a')
+        self.assertEqual({'symbol': 'TGTT'}, result[0][data_structure.ID])
+        ts = result[0][data_structure.TIMESERIES]
+        self.assertEqual(records[0][data_structure.TIMESERIES].dates.tolist(),
+                         ts.dates.tolist())
+        self.assertTrue(math.isnan(ts.values[1]))
+
+        ts = self.client.get('a', datetime.datetime(2013, 1, 2),
+                             datetime.datetime(2013, 1, 3))[0][
+                                 data_structure.TIMESERIES]
+        self.assertEqual(2, len(ts))
+        self.assertEqual(1, self.client.record_count('a'))
+        self.assertEqual(1, len(self.client.get_coverage('a')))
+        self.assertEqual(['a'], self.client.find(loader='loader',
+                                                 symbol='TGTT'))
+        self.assertIsNone(self.client.get('b'))
+
+    def test_append(self):
+        """
+        Appended points are added to the stored ones, replacing those on
+        the same dates
+        """
+        self.client.put('a', 'loader', {}, self.records([1, 2], [1.0, 2.0]))
+        self.client.append('a', self.records([2, 3], [5.0, 3.0]))
+        self.assertEqual([1.0, 5.0, 3.0], self.client.get('a')[0][
+            data_structure.TIMESERIES].values.tolist())
+
+        self.client.remove('a')
+        self.assertIsNone(self.client.get('a'))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_coalesce(self):
+        """
+        Calls for a key in flight wait for it and share its result if
+        they have the same tag, and make their own call otherwise
+        """
+        flights = single_flight.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def f(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value
+
+        def request(tag):
+            return lambda: results.append(
+                flights.do('key', tag, functools.partial(f, tag)))
+
+        leader = self.run_threads([request('a')])
+        started.wait()
+        followers = self.run_threads([request('a'), request('a'),
+                                      request('b')])
+        release.set()
+        for thread in leader + followers:
+            thread.join()
+        self.assertEqual(['a', 'b'], calls)
+        self.assertEqual(['a', 'a', 'a', 'b'], sorted(results))
+
+    def test_error(self):
+        """
+        The exception of the call is raised in the waiting threads too
+        """
+        flights = single_flight.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def f():
+            started.set()
+            release.wait()
+            raise IOError('loader failed')
+
+        def request():
+            try:
+                flights.do('key', 'a', f)
+            except IOError as e:
+                errors.append(e)
+
+        threads = self.run_threads([request])
+        started.wait()
+        threads += self.run_threads([request])
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, len(errors))
+
+    def test_file_lock(self):
+        """
+        A second holder of the lock file waits for the first to release it
+        """
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'series.lock')
+            events = []
+
+            def second():
+                with single_flight.FileLock(filename):
+                    events.append('second')
+
+            with single_flight.FileLock(filename):
+                thread = threading.Thread(target=second)
+                thread.start()
+                thread.join(0.2)
+                events.append('first')
+            thread.join()
+            self.assertEqual(['first', 'second'], events)
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder,
+                                     negative_cache.JOURNAL_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_expiry(self):
+        """
+        Entries are current until their TTL is up, and are dropped by
+        compaction after
+        """
+        misses = negative_cache.NegativeCache(self.filename)
+        misses.put('a', 'loader', negative_cache.EMPTY, 100, now=1000)
+        misses.put('b', 'loader', negative_cache.FAILED, 10, now=1000)
+        self.assertEqual(negative_cache.EMPTY,
+                         misses.get('a', now=1050)['reason'])
+        self.assertIsNone(misses.get('b', now=1050))
+        self.assertIsNone(misses.get('c', now=1050))
+
+        misses.compact(now=1050)
+        self.assertEqual(['a'], [id for id, _ in misses.items(now=0)])
+        misses.remove('a')
+        self.assertEqual([], misses.items(now=0))
+
+    def test_intervals(self):
+        """
+        An entry covers the requests within its dates, and an entry
+        without dates covers every request
+        """
+        misses = negative_cache.NegativeCache(self.filename)
+        jan = datetime.datetime(2013, 1, 1), datetime.datetime(2013, 1, 31)
+        jun = datetime.datetime(2013, 6, 1), datetime.datetime(2013, 6, 30)
+        misses.put('a', 'loader', negative_cache.EMPTY, 100, *jan, now=1000)
+        self.assertIsNotNone(misses.get('a', *jan, now=1000))
+        self.assertIsNotNone(misses.get(
+            'a', datetime.datetime(2013, 1, 5), jan[1], now=1000))
+        self.assertIsNone(misses.get('a', *jun, now=1000))
+        self.assertIsNone(misses.get('a', jan[0], None, now=1000))
+        self.assertIsNone(misses.get('a', now=1000))
+
+        # Entries of other dates are kept, one of the same dates replaced
+        misses.put('a', 'loader', negative_cache.FAILED, 100, *jun, now=1000)
+        misses.put('a', 'loader', negative_cache.FAILED, 100, *jan, now=1000)
+        self.assertEqual(2, len(misses.items(now=1000)))
+        self.assertEqual(negative_cache.FAILED,
+                         misses.get('a', *jan, now=1000)['reason'])
+
+        misses.put('a', 'loader', negative_cache.EMPTY, 100, now=1000)
+        self.assertIsNotNone(misses.get('a', *jun, now=1000))
+        self.assertIsNotNone(misses.get('a', now=1000))
+        misses.remove('a')
+        self.assertEqual([], misses.items(now=0))
+
+    def test_superseded(self):
+        """
+        A new entry replaces the entries within its dates and those expired
+        when it's written
+        """
+        misses = negative_cache.NegativeCache(self.filename)
+        jan = datetime.datetime(2013, 1, 1), datetime.datetime(2013, 1, 31)
+        jun = datetime.datetime(2013, 6, 1), datetime.datetime(2013, 6, 30)
+        misses.put('a', 'loader', negative_cache.EMPTY, 10, *jan, now=1000)
+        misses.put('a', 'loader', negative_cache.EMPTY, 100, *jun, now=1000)
+        misses.put('a', 'loader', negative_cache.EMPTY, 100,
+                   datetime.datetime(2013, 5, 1), None, now=1050)
+        self.assertEqual([(None, 1150)], [(e['end'], e['expires'])
+                                          for _, e in misses.items(now=0)])
+        self.assertEqual(1, misses.count)
+
+    def test_auto_compact(self):
+        """
+        The journal is rewritten on a put once it has more records than
+        the threshold and than there are entries
+        """
+        misses = negative_cache.NegativeCache(self.filename)
+        now = time.time()
+        for i in range(negative_cache.COMPACT_THRESHOLD):
+            misses.put('a', 'loader', negative_cache.EMPTY, 100, now=now)
+        self.assertEqual(negative_cache.COMPACT_THRESHOLD, misses.length)
+        misses.put('b', 'loader', negative_cache.EMPTY, 100, now=now)
+        self.assertEqual(2, misses.length)
+
+        reader = negative_cache.NegativeCache(self.filename)
+        self.assertEqual(['a', 'b'],
+                         sorted(id for id, _ in reader.items(now=now)))
+
+    def test_shared(self):
+        """
+        Entries written through one instance (as by another process) are
+        seen by another, once any record cut short is complete
+        """
+        writer = negative_cache.NegativeCache(self.filename)
+        reader = negative_cache.NegativeCache(self.filename)
+        writer.put('a', 'loader', negative_cache.EMPTY, 100, now=1000)
+        self.assertIsNotNone(reader.get('a', now=1000))
+
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        writer.put('b', 'loader', negative_cache.EMPTY, 100, now=1000)
+        with open(self.filename, 'rb') as f:
+            record = f.read()[len(data):]
+        with open(self.filename, 'wb') as f:
+            f.write(data + record[:5])
+        self.assertIsNone(reader.get('b', now=1000))
+        with open(self.filename, 'wb') as f:
+            f.write(data + record)
+        self.assertIsNotNone(reader.get('b', now=1000))
+
+        writer.clear()
+        self.assertIsNone(reader.get('a', now=1000))
+
+
+class TestTransformTuple(unittest.TestCase):
+    def test_timeseries_round_trip(self):
+        """
+        TimeSeries objects survive the mongo document transform
+        """
+        transform = db.TransformTuple()
+        ts = timeseries.TimeSeries.from_tuples([
+            (datetime.datetime(2013, 11, 7), 6.32),
+            (datetime.datetime(2013, 11, 8), float('nan')),
+        ])
+        doc = data_structure.create_time_series({'symbol': 'IBM'}, ts, {})
+        encoded = transform.transform_incoming(doc, 'test')
+        self.assertFalse(timeseries.is_columnar(
+            encoded[data_structure.TIMESERIES]))
+        decoded = transform.transform_outgoing(encoded, 'test')
+        self.assertEqual(doc, decoded)
 
 class TestMongoDataRetrievalFunctions(unittest.TestCase):
     mongo_folder = './testdata/mongo'
@@ -1,11 +1,16 @@
 import pickle
 import logging
 import datetime
+import calendar
 import time
 import csv
 import os
+import thread
 
 from pyTimeSeries import spickle
+from pyTimeSeries import npyfile
+from pyTimeSeries import gorilla
+from pyTimeSeries import dateparse
 
 ################################################################################
 
@@ -18,22 +23,23 @@ def isiterable(obj):
 
 ################################################################################
 
-def s_serialise_obj(obj, filename):
+def s_serialise_obj(obj, filename, opener=open):
     """
-    Use pickle to store obj in binary format in target filename
+    Use pickle to store obj in binary format in target filename. The file
+    is opened with opener (see compression.opener)
     """
     logging.debug('Serialising object to file ' + filename)
-    with open(filename, 'wb') as f:
+    with opener(filename, 'wb') as f:
         spickle.s_dump(obj, f)
 
 
-def s_deserialise_obj(filename):
+def s_deserialise_obj(filename, opener=open):
     """
     Use pickle to deserialise object that's been saved in binary format
     """
     logging.debug('Deserialising object from file ' + filename)
     results = list()
-    with open(filename, 'rb') as f:
+    with opener(filename, 'rb') as f:
         for element in spickle.s_load(f):
             if isiterable(element[1]):
                 results.append((element[0], tuple(element[1])))
@@ -43,25 +49,82 @@ def s_deserialise_obj(filename):
 
 ################################################################################
 
-def serialise_obj(obj, filename):
+def npy_serialise_obj(obj, filename):
     """
-    Use pickle to store obj in binary format in target filename
+    Store a time series or list of time series records in the columnar
+    npy format
+    """
+    logging.debug('Serialising object to npy file ' + filename)
+    npyfile.dump(obj, filename)
+
+
+def npy_deserialise_obj(filename):
+    """
+    Load an npy file, memory mapping the time series arrays
+    """
+    logging.debug('Deserialising object from npy file ' + filename)
+    return npyfile.load(filename)
+
+################################################################################
+
+def gorilla_serialise_obj(obj, filename):
+    """
+    Store a time series or list of time series records in the compressed
+    gorilla format
+    """
+    logging.debug('Serialising object to gorilla file ' + filename)
+    gorilla.dump(obj, filename)
+
+
+def gorilla_deserialise_obj(filename):
+    logging.debug('Deserialising object from gorilla file ' + filename)
+    return gorilla.load(filename)
+
+################################################################################
+
+def serialise_obj(obj, filename, opener=open):
+    """
+    Use pickle to store obj in binary format in target filename. The file
+    is opened with opener (see compression.opener)
     """
     logging.debug('Serialising object to file ' + filename)
-    with open(filename, 'wb') as f:
+    with opener(filename, 'wb') as f:
         pickle.dump(obj, f)
 
 
-def deserialise_obj(filename):
+def deserialise_obj(filename, opener=open):
     """
     Use pickle to deserialise object that's been saved in binary format
     """
     logging.debug('Deserialising object from file ' + filename)
-    with open(filename, 'rb') as f:
+    with opener(filename, 'rb') as f:
         return pickle.load(f)
 
 ################################################################################
 
+def atomic_serialise(serialise, obj, filename):
+    """
+    Call serialise(obj, filename) on a temporary file next to filename,
+    sync it to disk and rename it over filename. A crash mid write leaves
+    the previous file (or none), never a truncated one
+    """
+    tmp_filename = '{0}.{1}.{2}.tmp'.format(filename, os.getpid(),
+                                           thread.get_ident())
+    try:
+        serialise(obj, tmp_filename)
+        with open(tmp_filename, 'rb+') as f:
+            os.fsync(f.fileno())
+        # rename doesn't replace an existing file on windows
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+################################################################################
+
 def flatten(seq):
     for x in seq:
         try:
@@ -75,10 +138,10 @@ def flatten(seq):
 
 ################################################################################
 
-def serialise_csv(obj, filename):
+def serialise_csv(obj, filename, opener=open):
     if not os.path.isfile(filename):
         logging.debug('Serialising object to CSV file ' + filename)
-        with open(filename, 'wb') as csvfile:
+        with opener(filename, 'wb') as csvfile:
             csvwr = csv.writer(csvfile, quoting=csv.QUOTE_ALL, dialect='excel')
             if (obj):
                 for line in obj:
@@ -86,14 +149,15 @@ def serialise_csv(obj, filename):
 
 ################################################################################
 
-def deserialise_csv(filename):
+def deserialise_csv(filename, opener=open):
     ts = list()
     if os.path.isfile(filename):
         logging.debug('Deserialising object from CSV file ' + filename)
-        with open(filename, 'r') as csvfile:
+        parse_date = dateparse.parser(dateparse.ISO_DATETIME)
+        with opener(filename, 'r') as csvfile:
             csvrd = csv.reader(csvfile, quoting=csv.QUOTE_ALL, dialect='excel')
             for csvrow in csvrd:
-                csvrow_date = datetime.datetime.strptime(csvrow[0], '%Y-%m-%d %H:%M:%S')
+                csvrow_date = parse_date(csvrow[0])
                 ts.append ((csvrow_date, tuple(csvrow[1:])))
 
     return ts
@@ -158,7 +222,13 @@ def offset(dte, off, period='BD'):
             days_offset = off % 5
             return dte + datetime.timedelta(days=days_offset, weeks=week_offset)
         elif period_uc == 'M':
-            return datetime.datetime(dte.year, dte.month + off, dte.day)
+            # Carry whole years and clip the day to the end of the month,
+            # e.g. 31st Jan + 1M is 28th (or 29th) Feb
+            year, month = divmod(dte.month - 1 + off, 12)
+            year += dte.year
+            month += 1
+            day = min(dte.day, calendar.monthrange(year, month)[1])
+            return datetime.datetime(year, month, day)
         elif period_uc == 'Y':
             return datetime.datetime(dte.year + off, dte.month, dte.day)
         else:
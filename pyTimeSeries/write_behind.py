@@ -0,0 +1,107 @@
+"""
+Write-behind queue for cache writes
+
+Writes are handed to a background thread, so the caller doesn't wait for
+serialisation and disk. Until a write is done its value can be read back
+from the queue by key, so a read following a write sees it. The queue is
+bounded: once it holds max_pending writes, adding another blocks until
+the thread catches up. Pending writes are flushed, and the thread
+stopped, at interpreter exit.
+"""
+import atexit
+import logging
+import threading
+import Queue
+
+################################################################################
+
+class WriteBehindQueue(object):
+    """
+    Queue of writes drained by a daemon thread
+    """
+
+    def __init__(self, max_pending):
+        self.queue = Queue.Queue(max_pending)
+        self.pending = {}
+        # Functions to call once the pending writes of a key are done
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run,
+                                       name='cache-write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, key, value, write):
+        """
+        Queue write() to be called in the background. Until it's done,
+        get(key) returns value. Blocks while the queue is full
+        """
+        token = object()
+        with self.lock:
+            self.pending[key] = (token, value)
+        self.queue.put((key, token, write))
+
+    def get(self, key):
+        """
+        Return the value of the latest pending write for key, or None
+        """
+        with self.lock:
+            item = self.pending.get(key)
+        return None if item is None else item[1]
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            key, token, write = item
+            try:
+                write()
+            except Exception:
+                logging.exception('Write behind failed for {0}'.format(key))
+            finally:
+                callbacks = []
+                with self.lock:
+                    # Leave the value of a later write to the same key
+                    if key in self.pending and self.pending[key][0] is token:
+                        del self.pending[key]
+                        callbacks = self.callbacks.pop(key, [])
+                for f in callbacks:
+                    try:
+                        f()
+                    except Exception:
+                        logging.exception('Callback failed for {0}'.format(key))
+                self.queue.task_done()
+
+    def after(self, key, f):
+        """
+        Call f() once the pending writes for key are done, from the
+        queue's thread, or at once if there are none
+        """
+        with self.lock:
+            if key in self.pending:
+                self.callbacks.setdefault(key, []).append(f)
+                return
+        f()
+
+    def flush(self):
+        """
+        Wait for every queued write to be done. From the queue's own
+        thread (a write that triggers a flush) this returns at once, as
+        it would otherwise wait for itself
+        """
+        if threading.current_thread() is self.thread:
+            return
+        self.queue.join()
+
+    def close(self):
+        """
+        Flush the queue and stop the thread
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+################################################################################